@@ -0,0 +1,647 @@
+#!/usr/bin/env python3
+################################################################################
+##
+## This file is part of BetterPonymotes.
+## Copyright (c) 2015 Typhos.
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or (at your
+## option) any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+################################################################################
+
+import gzip
+import hashlib
+import math
+import os
+import re
+import zlib
+
+import arrow
+import sqlalchemy
+import werkzeug.exceptions
+import werkzeug.http
+from sqlalchemy import LargeBinary, func
+from sqlalchemy.orm import joinedload
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+import bpm.cache
+import bpm.diff
+import bpm.json
+import bpm.search
+import bpm.serialize
+import bpm.tiles
+from bpm.database import Subreddit, Update, Stylesheet, StylesheetDetail, EmoteChange
+
+# The web API's resources, independent of the server. bpm.webapi (Flask) and
+# bpm.asgi parse requests into the arguments these functions take, and turn
+# what they return into responses; see bpm.webapi for the routes.
+#
+# Bad requests and missing objects raise werkzeug's HTTP exceptions.
+
+# Resources addressed by ID or sequence number never change once written, so
+# they're cacheable forever. Everything else (listings, "latest" data) changes
+# when a new update lands and has to be revalidated on every use, which is
+# cheap thanks to the ETags.
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "public, no-cache"
+
+# Response compression, best first. Brotli is optional.
+if brotli is not None:
+    ENCODINGS = ["br", "gzip", "identity"]
+else:
+    ENCODINGS = ["gzip", "identity"]
+
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 9
+
+# A cacheable response, before conditional requests and content negotiation.
+# The ETag must be cheap to compute: the point is to avoid doing the
+# serialization (and most of the queries) that build() will do.
+#
+# build() returns the uncompressed body, either as bytes or as an iterator of
+# bytes to be streamed. precompressed(encoding), if given, can supply a stored
+# body instead. Tags name the data a response depends on beyond what the ETag
+# covers; their generations (see bpm.cache) are added to it.
+#
+# JSON responses use weak ETags, since the same data may be encoded in more
+# than one way. Resources that can be read by byte range (with
+# read_range(start, stop)) need a strong one.
+class Resource:
+    def __init__(self, etag, cache_control, build, tags=(), mimetype="application/json", weak=True,
+                 precompressed=None, last_modified=None, length=None, read_range=None):
+        self.etag = etag
+        self.cache_control = cache_control
+        self.build = build
+        self.tags = tags
+        self.mimetype = mimetype
+        self.weak = weak
+        self.precompressed = precompressed
+        self.last_modified = last_modified
+        self.length = length
+        self.read_range = read_range
+
+# What to send back. The body is bytes, or an iterator of bytes.
+class Reply:
+    def __init__(self, status, body=b"", mimetype=None, headers=None, content_length=None):
+        self.status = status
+        self.body = body
+        self.mimetype = mimetype
+        self.headers = headers or []
+        self.content_length = content_length
+
+# The request headers that decide how a resource is sent, as parsed by
+# werkzeug.http.
+class Conditions:
+    def __init__(self, full_path, accept_encodings, if_none_match, if_modified_since=None, range=None, if_range=None):
+        self.full_path = full_path
+        self.accept_encodings = accept_encodings
+        self.if_none_match = if_none_match
+        self.if_modified_since = if_modified_since
+        self.range = range
+        self.if_range = if_range
+
+# Works out the reply to a request for a resource: a 304 if the client
+# already has this version, a byte range if it asked for one, or else the
+# whole body in the best encoding it accepts. Bodies are kept in the cache
+# under the request path and ETag, so each is only produced once. Ranges are
+# read straight from the resource, uncompressed.
+def respond(cache, s, resource, conditions):
+    etag = resource.etag
+    if resource.tags:
+        etag = "%s-%s" % (etag, bpm.cache.tag_generations(s, resource.tags))
+
+    if resource.read_range is not None:
+        byte_range = _byte_range(resource, conditions)
+        if byte_range == "unsatisfiable":
+            return Reply(416, headers=[("Content-Range", "bytes */%s" % (resource.length))])
+        elif byte_range is not None:
+            start, stop = byte_range
+            reply = Reply(206, resource.read_range(start, stop), resource.mimetype, content_length=stop - start)
+            reply.headers.append(("Content-Range", "bytes %s-%s/%s" % (start, stop - 1, resource.length)))
+            reply.headers.append(("ETag", werkzeug.http.quote_etag(etag)))
+            reply.headers.append(("Cache-Control", resource.cache_control))
+            reply.headers.append(("Last-Modified", werkzeug.http.http_date(resource.last_modified)))
+            reply.headers.append(("Accept-Ranges", "bytes"))
+            return reply
+
+    encoding = conditions.accept_encodings.best_match(ENCODINGS, default="identity")
+    if not resource.weak and encoding != "identity":
+        # Strong ETags have to differ between encodings.
+        etag = "%s-%s" % (etag, encoding)
+
+    if conditions.if_none_match.contains_weak(etag) or _not_modified_since(resource, conditions):
+        reply = Reply(304)
+    else:
+        key = "%s %s" % (conditions.full_path, etag)
+        body = _get_body(cache, key, encoding, resource.build, resource.precompressed)
+        reply = Reply(200, body, resource.mimetype)
+        if encoding != "identity":
+            reply.headers.append(("Content-Encoding", encoding))
+        else:
+            reply.content_length = resource.length
+    reply.headers.append(("ETag", werkzeug.http.quote_etag(etag, resource.weak)))
+    reply.headers.append(("Cache-Control", resource.cache_control))
+    reply.headers.append(("Vary", "Accept-Encoding"))
+    if resource.last_modified is not None:
+        reply.headers.append(("Last-Modified", werkzeug.http.http_date(resource.last_modified)))
+    if resource.read_range is not None:
+        reply.headers.append(("Accept-Ranges", "bytes"))
+    return reply
+
+# If-Modified-Since only counts when there's no If-None-Match.
+def _not_modified_since(resource, conditions):
+    since = conditions.if_modified_since
+    if resource.last_modified is None or since is None or conditions.if_none_match:
+        return False
+    # HTTP dates only go down to the second.
+    return resource.last_modified.replace(microsecond=0) <= since
+
+# Returns the requested (start, stop) byte range, "unsatisfiable", or None to
+# send the whole thing. Ranges are ignored if If-Range doesn't match, and
+# multiple ranges aren't supported.
+def _byte_range(resource, conditions):
+    request_range = conditions.range
+    if request_range is None or len(request_range.ranges) != 1:
+        return None
+
+    if_range = conditions.if_range
+    if if_range is not None:
+        if if_range.etag is not None and if_range.etag != resource.etag:
+            return None
+        if if_range.date is not None and if_range.date != resource.last_modified.replace(microsecond=0):
+            return None
+
+    byte_range = request_range.range_for_length(resource.length)
+    if byte_range is None:
+        return "unsatisfiable"
+    return byte_range
+
+def _get_body(cache, key, encoding, build, precompressed):
+    encoded_key = "%s %s" % (key, encoding)
+    body = cache.get(encoded_key)
+    if body is not None:
+        return body
+
+    if precompressed is not None:
+        body = precompressed(encoding)
+    if body is None:
+        if encoding == "identity":
+            body = build()
+        else:
+            body = compress(_get_body(cache, key, "identity", build, precompressed), encoding)
+
+    if isinstance(body, bytes):
+        cache.put(encoded_key, body)
+    else:
+        body = _tee_to_cache(cache, encoded_key, body)
+    return body
+
+# Bodies may be streamed (as an iterator of bytes), in which case they're
+# compressed on the fly and saved to the cache once complete, provided they
+# aren't too big for it.
+def compress(body, encoding):
+    if not isinstance(body, bytes):
+        return _compress_stream(body, encoding)
+    if encoding == "gzip":
+        return gzip.compress(body, GZIP_LEVEL)
+    elif encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    raise ValueError("Unknown encoding", encoding)
+
+def _compress_stream(chunks, encoding):
+    if encoding == "gzip":
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        process, flush = compressor.compress, compressor.flush
+    elif encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        process, flush = compressor.process, compressor.finish
+    else:
+        raise ValueError("Unknown encoding", encoding)
+
+    for chunk in chunks:
+        data = process(chunk)
+        if data:
+            yield data
+    yield flush()
+
+def _tee_to_cache(cache, key, chunks):
+    saved = []
+    size = 0
+    for chunk in chunks:
+        if saved is not None:
+            size += len(chunk)
+            if size > cache.max_entry_bytes:
+                saved = None
+            else:
+                saved.append(chunk)
+        yield chunk
+    if saved is not None:
+        cache.put(key, b"".join(saved))
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Streams a JSON object from bpm.serialize.stream_*() pairs, in reasonably
+# sized chunks.
+def _stream_json(pairs):
+    buf = []
+    size = 0
+    for chunk in bpm.json.iterencode_pairs(pairs):
+        buf.append(chunk)
+        size += len(chunk)
+        if size >= STREAM_CHUNK_SIZE:
+            yield "".join(buf).encode("ascii")
+            buf = []
+            size = 0
+    if buf:
+        yield "".join(buf).encode("ascii")
+
+# Precomputed detail JSON for a stylesheet, if it's stored in this encoding.
+def _materialized_detail(s, ss, encoding):
+    if encoding == "identity":
+        column = StylesheetDetail.json
+    elif encoding == "gzip":
+        column = StylesheetDetail.json_gzip
+    else:
+        return None
+    return s.query(column).filter_by(stylesheet_id=ss.stylesheet_id).scalar()
+
+def _or_404(obj):
+    if obj is None:
+        raise werkzeug.exceptions.NotFound()
+    return obj
+
+DEFAULT_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 100
+
+# History listings are paged by keyset on the sequence number, newest first:
+# ?before=<seq> continues where the previous page's "next" left off. This
+# walks the (subreddit_name, *_seq) unique index, so every page costs the same
+# however far back it is. ?since= and ?until= restrict by timestamp.
+class Page:
+    def __init__(self, limit=DEFAULT_PAGE_SIZE, before=None, since=None, until=None):
+        self.limit = limit
+        self.before = before
+        self.since = since
+        self.until = until
+
+# Parses page arguments from the query string.
+def page_args(args):
+    try:
+        limit = int(args.get("limit", DEFAULT_PAGE_SIZE))
+        before = int(args["before"]) if "before" in args else None
+        since = arrow.get(args["since"]) if "since" in args else None
+        until = arrow.get(args["until"]) if "until" in args else None
+    except (TypeError, ValueError, arrow.parser.ParserError):
+        raise werkzeug.exceptions.BadRequest()
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise werkzeug.exceptions.BadRequest()
+    return Page(limit, before, since, until)
+
+def paginate(q, seq_column, time_column, page):
+    if page.before is not None:
+        q = q.filter(seq_column < page.before)
+    if page.since is not None:
+        q = q.filter(time_column >= page.since)
+    if page.until is not None:
+        q = q.filter(time_column < page.until)
+
+    # Fetch one extra row to find out whether there's another page.
+    rows = q.order_by(seq_column.desc()).limit(page.limit + 1).all()
+    if len(rows) > page.limit:
+        rows = rows[:page.limit]
+        next = getattr(rows[-1], seq_column.key)
+    else:
+        next = None
+    return (rows, next)
+
+MAX_BATCH_SIZE = 100
+
+# Batch lookups take a repeated query parameter, e.g. ?id=1&id=2.
+def batch_args(values, type=str):
+    try:
+        values = {type(value) for value in values}
+    except ValueError:
+        raise werkzeug.exceptions.BadRequest()
+    if not 1 <= len(values) <= MAX_BATCH_SIZE:
+        raise werkzeug.exceptions.BadRequest()
+    return sorted(values)
+
+# Batch results depend only on which objects were found (and, for
+# subreddits, their latest updates).
+def batch_etag(keys):
+    return hashlib.sha1(repr(sorted(keys)).encode("utf8")).hexdigest()
+
+# Version of the whole set of subreddits and their latest updates. Any change
+# either adds a subreddit or moves a latest update ID (which only ever goes up,
+# barring manual rollbacks).
+def subreddits_etag(s):
+    count, max_id, sum_id = s.query(
+        func.count(Subreddit.subreddit_name),
+        func.max(Subreddit.latest_update_id),
+        func.sum(Subreddit.latest_update_id)).one()
+    return "%s-%s-%s" % (count, max_id, sum_id)
+
+def subreddits(s):
+    def build():
+        return _stream_json(bpm.serialize.stream_subreddits(s))
+
+    return Resource(subreddits_etag(s), REVALIDATE, build, tags=[bpm.cache.SUBREDDITS_TAG])
+
+def subreddit(s, subreddit_name):
+    sr = _or_404(s.query(Subreddit).get(subreddit_name))
+
+    def build():
+        data = bpm.serialize.serialize_subreddit(sr, detail_latest=True)
+        return bpm.serialize.encode_json(data)
+
+    return Resource(str(sr.latest_update_id), REVALIDATE, build, tags=[bpm.cache.subreddit_tag(subreddit_name)])
+
+def subreddit_updates(s, subreddit_name, page):
+    sr = _or_404(s.query(Subreddit).get(subreddit_name))
+
+    def build():
+        q = s.query(Update).filter_by(subreddit_name=subreddit_name).options(joinedload(Update.stylesheet))
+        updates, next = paginate(q, Update.update_seq, Update.created, page)
+        data = {"updates": [], "next": next}
+        for update in updates:
+            data["updates"].append(bpm.serialize.serialize_update(update, detail=False))
+        return bpm.serialize.encode_json(data)
+
+    return Resource(str(sr.latest_update_id), REVALIDATE, build, tags=[bpm.cache.subreddit_tag(subreddit_name)])
+
+def update(s, update_id):
+    # The ETag comes straight from the URL, so revalidation doesn't touch the
+    # database at all.
+    def build():
+        update = _or_404(s.query(Update).get(update_id))
+        data = bpm.serialize.serialize_update(update, detail=True)
+        return bpm.serialize.encode_json(data)
+
+    return Resource(str(update_id), IMMUTABLE, build)
+
+def subreddit_update(s, subreddit_name, update_seq):
+    update = _or_404(s.query(Update).filter_by(subreddit_name=subreddit_name, update_seq=update_seq).first())
+
+    def build():
+        data = bpm.serialize.serialize_update(update, detail=True)
+        return bpm.serialize.encode_json(data)
+
+    return Resource(str(update.update_id), IMMUTABLE, build)
+
+def subreddit_update_diff(s, subreddit_name, old_seq, new_seq):
+    q = s.query(Update).filter_by(subreddit_name=subreddit_name).options(joinedload(Update.stylesheet))
+    old = _or_404(q.filter_by(update_seq=old_seq).first())
+    new = _or_404(q.filter_by(update_seq=new_seq).first())
+
+    def build():
+        data = bpm.diff.diff_updates(s, old, new)
+        data["old_update_id"] = old.update_id
+        data["new_update_id"] = new.update_id
+        return bpm.serialize.encode_json(data)
+
+    return Resource("%s-%s" % (old.update_id, new.update_id), IMMUTABLE, build)
+
+def _changes_body(q, page):
+    changes, next = paginate(q, EmoteChange.change_id, EmoteChange.created, page)
+    data = {"changes": [bpm.serialize.serialize_change(c) for c in changes], "next": next}
+    return bpm.serialize.encode_json(data)
+
+def changes(s, page):
+    def build():
+        return _changes_body(s.query(EmoteChange), page)
+
+    return Resource(subreddits_etag(s), REVALIDATE, build, tags=[bpm.cache.SUBREDDITS_TAG])
+
+def subreddit_changes(s, subreddit_name, emote_name, page):
+    sr = _or_404(s.query(Subreddit).get(subreddit_name))
+
+    def build():
+        q = s.query(EmoteChange).filter_by(subreddit_name=subreddit_name)
+        if emote_name is not None:
+            q = q.filter_by(emote_name=emote_name)
+        return _changes_body(q, page)
+
+    return Resource(str(sr.latest_update_id), REVALIDATE, build, tags=[bpm.cache.subreddit_tag(subreddit_name)])
+
+def subreddit_stylesheets(s, subreddit_name, page):
+    max_seq = s.query(func.max(Stylesheet.stylesheet_seq)).filter_by(subreddit_name=subreddit_name).one()[0]
+
+    def build():
+        q = s.query(Stylesheet).filter_by(subreddit_name=subreddit_name)
+        stylesheets, next = paginate(q, Stylesheet.stylesheet_seq, Stylesheet.downloaded, page)
+        data = {"stylesheets": [], "next": next}
+        for ss in stylesheets:
+            data["stylesheets"].append(bpm.serialize.serialize_stylesheet(ss, detail=False))
+        return bpm.serialize.encode_json(data)
+
+    return Resource(str(max_seq), REVALIDATE, build, tags=[bpm.cache.subreddit_tag(subreddit_name)])
+
+def _stylesheet_detail(s, ss):
+    def build():
+        return _stream_json(bpm.serialize.stream_stylesheet(s, ss))
+
+    def precompressed(encoding):
+        return _materialized_detail(s, ss, encoding)
+
+    return Resource(ss.css_hash, IMMUTABLE, build, precompressed=precompressed)
+
+def stylesheet(s, stylesheet_id):
+    ss = _or_404(s.query(Stylesheet).get(stylesheet_id))
+    return _stylesheet_detail(s, ss)
+
+def subreddit_stylesheet(s, subreddit_name, stylesheet_seq):
+    ss = _or_404(s.query(Stylesheet).filter_by(subreddit_name=subreddit_name, stylesheet_seq=stylesheet_seq).first())
+    return _stylesheet_detail(s, ss)
+
+CSS_CHUNK_SIZE = 256 * 1024
+
+# The stored CSS as UTF-8 bytes, so it can be measured and sliced by byte in
+# the database.
+def css_octets(s):
+    if s.bind.dialect.name == "postgresql":
+        return func.convert_to(Stylesheet.css, "UTF8")
+    else:
+        return sqlalchemy.cast(Stylesheet.css, LargeBinary)
+
+# Reads bytes [start, stop) of a stylesheet's CSS, a chunk at a time, without
+# ever loading the whole thing.
+def _stream_css(s, stylesheet_id, start, stop):
+    octets = css_octets(s)
+    while start < stop:
+        length = min(CSS_CHUNK_SIZE, stop - start)
+        q = s.query(func.substr(octets, start + 1, length)).filter(Stylesheet.stylesheet_id == stylesheet_id)
+        yield bytes(q.scalar())
+        start += length
+
+# Raw CSS, which can be requested by byte range. Whole responses are cached
+# and compressed like any other.
+def _css(s, q):
+    row = _or_404(q.with_entities(Stylesheet.stylesheet_id, Stylesheet.css_hash, Stylesheet.downloaded, func.length(css_octets(s))).first())
+    stylesheet_id, css_hash, downloaded, length = row
+
+    def build():
+        return _stream_css(s, stylesheet_id, 0, length)
+
+    def read_range(start, stop):
+        return _stream_css(s, stylesheet_id, start, stop)
+
+    return Resource(css_hash, IMMUTABLE, build, mimetype="text/css", weak=False,
+                    last_modified=downloaded.datetime, length=length, read_range=read_range)
+
+def stylesheet_css(s, stylesheet_id):
+    return _css(s, s.query(Stylesheet).filter_by(stylesheet_id=stylesheet_id))
+
+def subreddit_stylesheet_css(s, subreddit_name, stylesheet_seq):
+    return _css(s, s.query(Stylesheet).filter_by(subreddit_name=subreddit_name, stylesheet_seq=stylesheet_seq))
+
+# Where tile images are served from; see bpm.tiles.
+tile_dir = bpm.tiles.TILE_DIR
+
+tile_filename_regexp = re.compile(r"^[0-9a-f]{64}\.(png|jpg)$")
+
+# Tiles are made in the background and appear over time, so these lists are
+# versioned by which tiles they contain. tile_url(filename) says where the
+# server has them.
+def _tiles(s, ss, tile_url):
+    data = bpm.serialize.serialize_stylesheet_tiles(s, ss, tile_url)
+    urls = [tile["url"] for tiles in data["tiles"].values() for tile in tiles]
+    return Resource(batch_etag(urls), REVALIDATE, lambda: bpm.serialize.encode_json(data))
+
+def stylesheet_tiles(s, stylesheet_id, tile_url):
+    ss = _or_404(s.query(Stylesheet).get(stylesheet_id))
+    return _tiles(s, ss, tile_url)
+
+def subreddit_tiles(s, subreddit_name, tile_url):
+    sr = _or_404(s.query(Subreddit).get(subreddit_name))
+    ss = _or_404(sr.latest_update).stylesheet
+    return _tiles(s, ss, tile_url)
+
+# Path to a tile image. Named by content, so they never change.
+def tile_file(filename):
+    if not tile_filename_regexp.match(filename):
+        raise werkzeug.exceptions.NotFound()
+    path = os.path.abspath(bpm.tiles.tile_path(filename, tile_dir))
+    if not os.path.exists(path):
+        raise werkzeug.exceptions.NotFound()
+    return path
+
+def batch_subreddits(s, names):
+    q = s.query(Subreddit).options(joinedload(Subreddit.latest_update).joinedload(Update.stylesheet))
+    subreddits = q.filter(Subreddit.subreddit_name.in_(names)).all()
+    etag = batch_etag((sr.subreddit_name, sr.latest_update_id) for sr in subreddits)
+
+    def build():
+        found = bpm.serialize.serialize_subreddits_detail(s, subreddits)
+        data = {"subreddits": found, "missing": [name for name in names if name not in found]}
+        return bpm.serialize.encode_json(data)
+
+    tags = [bpm.cache.SUBREDDITS_TAG] + [bpm.cache.subreddit_tag(name) for name in names]
+    return Resource(etag, REVALIDATE, build, tags=tags)
+
+def batch_updates(s, ids):
+    q = s.query(Update).options(joinedload(Update.stylesheet))
+    updates = q.filter(Update.update_id.in_(ids)).all()
+    etag = batch_etag(update.update_id for update in updates)
+
+    def build():
+        found = bpm.serialize.serialize_updates_detail(s, updates)
+        data = {"updates": found, "missing": [id for id in ids if id not in found]}
+        return bpm.serialize.encode_json(data)
+
+    return Resource(etag, REVALIDATE, build)
+
+def batch_stylesheets(s, ids):
+    stylesheets = s.query(Stylesheet).filter(Stylesheet.stylesheet_id.in_(ids)).all()
+    etag = batch_etag(ss.stylesheet_id for ss in stylesheets)
+
+    def build():
+        found = bpm.serialize.serialize_stylesheets_detail(s, stylesheets)
+        data = {"stylesheets": found, "missing": [id for id in ids if id not in found]}
+        return bpm.serialize.encode_json(data)
+
+    return Resource(etag, REVALIDATE, build)
+
+# Parses (query, mode, limit) for an emote search.
+def search_args(args):
+    query = args.get("q")
+    mode = args.get("mode", "prefix")
+    try:
+        limit = int(args.get("limit", bpm.search.DEFAULT_LIMIT))
+    except ValueError:
+        raise werkzeug.exceptions.BadRequest()
+    if not query or mode not in bpm.search.MODES or not 1 <= limit <= MAX_PAGE_SIZE:
+        raise werkzeug.exceptions.BadRequest()
+    return (query, mode, limit)
+
+def emotes_search(s, query, mode, limit):
+    def build():
+        results = []
+        for row in bpm.search.search_emotes(s, query, mode, limit):
+            results.append({
+                "name": row.emote_name,
+                "subreddit_name": row.subreddit_name,
+                "emote_id": row.emote_id,
+                "stylesheet_id": row.stylesheet_id
+            })
+        return bpm.serialize.encode_json({"results": results})
+
+    return Resource(subreddits_etag(s), REVALIDATE, build, tags=[bpm.cache.SUBREDDITS_TAG])
+
+# The change feed. Waiting for updates is up to the server (see
+# bpm.feed.broadcaster); these are the parts around it.
+
+FEED_TIMEOUT = 30
+MAX_FEED_TIMEOUT = 60
+FEED_BATCH_SIZE = 100
+FEED_HEARTBEAT = 15
+# Event streams end after this long; clients reconnect with Last-Event-ID.
+FEED_STREAM_TIME = 600
+
+def feed_timeout(args):
+    try:
+        timeout = float(args.get("timeout", FEED_TIMEOUT))
+    except ValueError:
+        raise werkzeug.exceptions.BadRequest()
+    # NaN would wait forever (nothing compares less than it).
+    if not math.isfinite(timeout) or timeout < 0:
+        raise werkzeug.exceptions.BadRequest()
+    return min(timeout, MAX_FEED_TIMEOUT)
+
+def parse_cursor(after):
+    try:
+        return int(after)
+    except ValueError:
+        raise werkzeug.exceptions.BadRequest()
+
+# For clients without a cursor, so they start from now.
+def latest_cursor(s):
+    return s.query(func.max(Update.update_id)).scalar() or 0
+
+def feed_updates(s, after):
+    q = s.query(Update).options(joinedload(Update.stylesheet)).filter(Update.update_id > after)
+    return q.order_by(Update.update_id).limit(FEED_BATCH_SIZE).all()
+
+# [(update_id, serialized update)] after the cursor
+def serialize_feed(s, after):
+    return [(u.update_id, bpm.serialize.serialize_update(u, detail=False)) for u in feed_updates(s, after)]
+
+def feed_body(updates, cursor):
+    data = {"updates": [data for (update_id, data) in updates], "cursor": cursor}
+    return bpm.serialize.encode_json(data)
+
+def feed_event(update_id, data):
+    return "id: %s\nevent: update\ndata: %s\n\n" % (update_id, bpm.serialize.encode_json(data).decode("ascii"))
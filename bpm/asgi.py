@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+################################################################################
+##
+## This file is part of BetterPonymotes.
+## Copyright (c) 2015 Typhos.
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or (at your
+## option) any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+################################################################################
+
+
+"""
+Async (ASGI) variant of the web API.
+
+This serves the same routes and JSON as bpm.webapi, but on an async database
+driver with a connection pool, so that slow queries and slow clients don't tie
+up a whole worker. Run it with any ASGI server, e.g.:
+
+    uvicorn bpm.asgi:app
+
+The database is configured with setup(), or else from the BPM_DATABASE and
+BPM_POOL_SIZE environment variables when the server starts. Workers started
+with BPM_METRICS_DIR set combine their metrics there (see bpm.metrics).
+
+Handlers are ordinary synchronous ORM code, run through
+AsyncSession.run_sync(). They can use bpm.serialize as-is, while all database
+I/O still goes through the async driver without blocking the event loop.
+Handlers that wait (the feed) are coroutines instead, and open sessions only
+while they need them.
+"""
+
+import asyncio
+import contextlib
+import os
+import re
+import urllib.parse
+
+import logbook
+import sqlalchemy
+import werkzeug.exceptions
+import werkzeug.http
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+import bpm.api
+import bpm.database
+import bpm.feed
+import bpm.metrics
+import bpm.serialize
+import bpm.webapi
+
+log = logbook.Logger(__name__)
+
+DEFAULT_POOL_SIZE = 10
+
+_engine = None
+_session_factory = None
+_database_uri = None
+_listener_engine = None
+
+def setup(database_uri=None, pool_size=DEFAULT_POOL_SIZE, debug=False):
+    global _engine, _session_factory, _database_uri
+
+    _database_uri = database_uri
+    uri = bpm.database.async_database_uri(database_uri)
+    options = {}
+    if uri.startswith("postgresql"):
+        options["pool_size"] = pool_size
+        options["max_overflow"] = pool_size
+    _engine = create_async_engine(uri, echo=debug, **options)
+    _session_factory = sessionmaker(_engine, class_=AsyncSession, expire_on_commit=False)
+    bpm.metrics.instrument_engine(_engine.sync_engine)
+    return _engine
+
+class Request:
+    def __init__(self, scope):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.root_path = scope.get("root_path", "")
+        self.query_string = scope["query_string"].decode("latin-1")
+        self.args = dict(urllib.parse.parse_qsl(self.query_string))
+        self._arg_lists = urllib.parse.parse_qs(self.query_string)
+        self.headers = {}
+        for (name, value) in scope["headers"]:
+            self.headers[name.decode("latin-1").lower()] = value.decode("latin-1")
+
+    @property
+    def full_path(self):
+        return self.path + "?" + self.query_string
+
+    # Every value of a repeated query parameter
+    def getlist(self, name):
+        return self._arg_lists.get(name, [])
+
+# The body is bytes, or an async iterator of bytes to be streamed.
+class Response:
+    def __init__(self, status, body=b"", mimetype=None):
+        self.status = status
+        self.body = body
+        self.headers = []
+        if mimetype is not None:
+            self.headers.append(("Content-Type", mimetype))
+
+# Routing, with the same URL patterns as Flask.
+
+_routes = [] # [(pattern, regexp, int params, handler)]
+
+_converters = {"int": r"(?P<%s>\d+)", "string": r"(?P<%s>[^/]+)"}
+
+def route(pattern):
+    def _convert(m):
+        return _converters[m.group(1)] % (m.group(2))
+    regexp = re.compile("^" + re.sub(r"<(\w+):(\w+)>", _convert, pattern) + "$")
+    ints = set(re.findall(r"<int:(\w+)>", pattern))
+
+    def decorator(fn):
+        _routes.append((pattern, regexp, ints, fn))
+        return fn
+    return decorator
+
+def _match(path):
+    for (pattern, regexp, ints, handler) in _routes:
+        m = regexp.match(path)
+        if m:
+            params = {}
+            for (name, value) in m.groupdict().items():
+                params[name] = int(value) if name in ints else urllib.parse.unquote(value)
+            return (pattern, handler, params)
+    return (None, None, None)
+
+# Adapters between these requests and responses and bpm.api. Handlers run
+# inside AsyncSession.run_sync(), so streamed bodies are read in full there
+# (and saved to the same cache as bpm.webapi's, so that its size and
+# statistics cover both).
+
+def _conditions(req):
+    return bpm.api.Conditions(
+        req.full_path,
+        werkzeug.http.parse_accept_header(req.headers.get("accept-encoding")),
+        werkzeug.http.parse_etags(req.headers.get("if-none-match")),
+        werkzeug.http.parse_date(req.headers.get("if-modified-since")),
+        werkzeug.http.parse_range_header(req.headers.get("range")),
+        werkzeug.http.parse_if_range_header(req.headers.get("if-range")))
+
+def _respond(s, req, resource):
+    reply = bpm.api.respond(bpm.webapi.cache, s, resource, _conditions(req))
+    body = reply.body
+    if not isinstance(body, bytes):
+        body = b"".join(body)
+    response = Response(reply.status, body, reply.mimetype)
+    response.headers.extend(reply.headers)
+    return response
+
+def _page(req):
+    return bpm.api.page_args(req.args)
+
+def _tile_url(req):
+    return lambda filename: "%s/tiles/%s" % (req.root_path, filename)
+
+# Runs fn(session, *args) in a session of its own, for coroutine handlers.
+async def _run(fn, *args):
+    async with _session_factory() as session:
+        return await session.run_sync(fn, *args)
+
+# Routes. See bpm.webapi for details.
+
+@route("/subreddits")
+def subreddits(s, req):
+    return _respond(s, req, bpm.api.subreddits(s))
+
+@route("/r/<string:subreddit_name>")
+def r_subreddit(s, req, subreddit_name):
+    return _respond(s, req, bpm.api.subreddit(s, subreddit_name))
+
+@route("/r/<string:subreddit_name>/updates")
+def r_subreddit_updates(s, req, subreddit_name):
+    return _respond(s, req, bpm.api.subreddit_updates(s, subreddit_name, _page(req)))
+
+@route("/updates/<int:update_id>")
+def update(s, req, update_id):
+    return _respond(s, req, bpm.api.update(s, update_id))
+
+@route("/r/<string:subreddit_name>/updates/<int:update_seq>")
+def r_subreddit_update(s, req, subreddit_name, update_seq):
+    return _respond(s, req, bpm.api.subreddit_update(s, subreddit_name, update_seq))
+
+@route("/r/<string:subreddit_name>/updates/<int:old_seq>/diff/<int:new_seq>")
+def r_subreddit_update_diff(s, req, subreddit_name, old_seq, new_seq):
+    return _respond(s, req, bpm.api.subreddit_update_diff(s, subreddit_name, old_seq, new_seq))
+
+@route("/changes")
+def changes(s, req):
+    return _respond(s, req, bpm.api.changes(s, _page(req)))
+
+@route("/r/<string:subreddit_name>/changes")
+def r_subreddit_changes(s, req, subreddit_name):
+    return _respond(s, req, bpm.api.subreddit_changes(s, subreddit_name, req.args.get("emote"), _page(req)))
+
+@route("/r/<string:subreddit_name>/stylesheets")
+def r_subreddit_stylesheets(s, req, subreddit_name):
+    return _respond(s, req, bpm.api.subreddit_stylesheets(s, subreddit_name, _page(req)))
+
+@route("/stylesheets/<int:stylesheet_id>")
+def stylesheet(s, req, stylesheet_id):
+    return _respond(s, req, bpm.api.stylesheet(s, stylesheet_id))
+
+@route("/r/<string:subreddit_name>/stylesheets/<int:stylesheet_seq>")
+def r_subreddit_stylesheet(s, req, subreddit_name, stylesheet_seq):
+    return _respond(s, req, bpm.api.subreddit_stylesheet(s, subreddit_name, stylesheet_seq))
+
+@route("/stylesheet/<int:stylesheet_id>/css")
+def stylesheet_css(s, req, stylesheet_id):
+    return _respond(s, req, bpm.api.stylesheet_css(s, stylesheet_id))
+
+@route("/r/<string:subreddit_name>/stylesheets/<int:stylesheet_seq>/css")
+def r_subreddit_stylesheet_css(s, req, subreddit_name, stylesheet_seq):
+    return _respond(s, req, bpm.api.subreddit_stylesheet_css(s, subreddit_name, stylesheet_seq))
+
+@route("/stylesheets/<int:stylesheet_id>/tiles")
+def stylesheet_tiles(s, req, stylesheet_id):
+    return _respond(s, req, bpm.api.stylesheet_tiles(s, stylesheet_id, _tile_url(req)))
+
+@route("/r/<string:subreddit_name>/tiles")
+def r_subreddit_tiles(s, req, subreddit_name):
+    return _respond(s, req, bpm.api.subreddit_tiles(s, subreddit_name, _tile_url(req)))
+
+TILE_MIMETYPES = {"png": "image/png", "jpg": "image/jpeg"}
+
+@route("/tiles/<string:filename>")
+async def tile(req, filename):
+    path = bpm.api.tile_file(filename)
+    if werkzeug.http.parse_etags(req.headers.get("if-none-match")).contains(filename):
+        response = Response(304)
+    else:
+        try:
+            body = await asyncio.to_thread(_read_file, path)
+        except FileNotFoundError:
+            raise werkzeug.exceptions.NotFound()
+        response = Response(200, body, TILE_MIMETYPES[filename.rsplit(".", 1)[1]])
+    response.headers.append(("ETag", werkzeug.http.quote_etag(filename)))
+    response.headers.append(("Cache-Control", bpm.api.IMMUTABLE))
+    return response
+
+def _read_file(path):
+    with open(path, "rb") as file:
+        return file.read()
+
+@route("/stats/cache")
+async def stats_cache(req):
+    return Response(200, bpm.serialize.encode_json(bpm.webapi.cache_stats()), "application/json")
+
+@route("/metrics")
+async def metrics(req):
+    return Response(200, bpm.metrics.registry.render().encode("utf8"), bpm.metrics.CONTENT_TYPE)
+
+@route("/batch/subreddits")
+def batch_subreddits(s, req):
+    names = bpm.api.batch_args(req.getlist("name"))
+    return _respond(s, req, bpm.api.batch_subreddits(s, names))
+
+@route("/batch/updates")
+def batch_updates(s, req):
+    ids = bpm.api.batch_args(req.getlist("id"), int)
+    return _respond(s, req, bpm.api.batch_updates(s, ids))
+
+@route("/batch/stylesheets")
+def batch_stylesheets(s, req):
+    ids = bpm.api.batch_args(req.getlist("id"), int)
+    return _respond(s, req, bpm.api.batch_stylesheets(s, ids))
+
+@route("/emotes/search")
+def emotes_search(s, req):
+    query, mode, limit = bpm.api.search_args(req.args)
+    return _respond(s, req, bpm.api.emotes_search(s, query, mode, limit))
+
+# The feed waits on bpm.feed.broadcaster without holding a session (or a
+# thread). Its listener runs on a synchronous connection of its own.
+
+def _start_feed_listener():
+    global _listener_engine
+    if _listener_engine is None:
+        _listener_engine = sqlalchemy.create_engine(_database_uri or bpm.database.DEFAULT_DATABASE_URI)
+    bpm.feed.start_listener(_listener_engine)
+
+@route("/feed")
+async def feed(req):
+    args = req.args
+    timeout = bpm.api.feed_timeout(args)
+
+    if "after" not in args:
+        updates = []
+        cursor = await _run(bpm.api.latest_cursor)
+    else:
+        cursor = bpm.api.parse_cursor(args["after"])
+        _start_feed_listener()
+        updates = await _run(bpm.api.serialize_feed, cursor)
+        if not updates:
+            await bpm.feed.broadcaster.wait_async(cursor, timeout)
+            updates = await _run(bpm.api.serialize_feed, cursor)
+        if updates:
+            cursor = updates[-1][0]
+
+    response = Response(200, bpm.api.feed_body(updates, cursor), "application/json")
+    response.headers.append(("Cache-Control", "no-store"))
+    return response
+
+@route("/feed/events")
+async def feed_events(req):
+    after = req.headers.get("last-event-id", req.args.get("after"))
+    if after is None:
+        cursor = await _run(bpm.api.latest_cursor)
+    else:
+        cursor = bpm.api.parse_cursor(after)
+    _start_feed_listener()
+
+    async def generate(cursor):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + bpm.api.FEED_STREAM_TIME
+        while loop.time() < deadline:
+            events = []
+            for (update_id, data) in await _run(bpm.api.serialize_feed, cursor):
+                events.append(bpm.api.feed_event(update_id, data))
+                cursor = update_id
+
+            if events:
+                yield "".join(events).encode("ascii")
+                if len(events) == bpm.api.FEED_BATCH_SIZE:
+                    continue
+
+            latest = await bpm.feed.broadcaster.wait_async(cursor, bpm.api.FEED_HEARTBEAT)
+            if latest is None or latest <= cursor:
+                yield b": keepalive\n\n"
+
+    response = Response(200, generate(cursor), "text/event-stream")
+    response.headers.append(("Cache-Control", "no-store"))
+    return response
+
+# ASGI entry point
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+    elif scope["type"] == "http":
+        req = Request(scope)
+        metrics = bpm.metrics.start_request()
+        response = await _handle(req, metrics)
+        metrics.status = response.status
+        await _send(req, response, receive, send, metrics)
+        metrics.finish()
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            if _engine is None:
+                pool_size = int(os.environ.get("BPM_POOL_SIZE", DEFAULT_POOL_SIZE))
+                setup(os.environ.get("BPM_DATABASE"), pool_size=pool_size)
+            if os.environ.get("BPM_METRICS_DIR"):
+                bpm.metrics.registry.set_directory(os.environ["BPM_METRICS_DIR"], clear=False)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if _engine is not None:
+                await _engine.dispose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def _handle(req, metrics):
+    pattern, handler, params = _match(req.path)
+    if handler is None:
+        return Response(404)
+    metrics.route = pattern
+    if req.method not in ("GET", "HEAD"):
+        return Response(405)
+
+    try:
+        if asyncio.iscoroutinefunction(handler):
+            return await handler(req, **params)
+        async with _session_factory() as session:
+            with bpm.metrics.checkout_timer():
+                await session.connection()
+            return await session.run_sync(handler, req, **params)
+    except werkzeug.exceptions.HTTPException as error:
+        return Response(error.code)
+    except Exception:
+        log.exception("Error handling {} {}", req.method, req.path)
+        return Response(500)
+
+async def _send(req, response, receive, send, metrics):
+    headers = [(name.encode("latin-1"), value.encode("latin-1")) for (name, value) in response.headers]
+
+    if isinstance(response.body, bytes):
+        if response.status not in (204, 304):
+            headers.append((b"content-length", str(len(response.body)).encode("latin-1")))
+        body = response.body if req.method != "HEAD" else b""
+        await send({"type": "http.response.start", "status": response.status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+        metrics.bytes = len(body)
+        return
+
+    # Streamed bodies stop early if the client goes away, rather than when the
+    # next chunk fails to send (which could be a heartbeat away).
+    await send({"type": "http.response.start", "status": response.status, "headers": headers})
+    chunks = response.body
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+    try:
+        while req.method != "HEAD":
+            next_chunk = asyncio.ensure_future(chunks.__anext__())
+            await asyncio.wait([next_chunk, disconnected], return_when=asyncio.FIRST_COMPLETED)
+            if not next_chunk.done():
+                next_chunk.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await next_chunk
+                return
+            try:
+                chunk = next_chunk.result()
+            except StopAsyncIteration:
+                break
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            metrics.bytes += len(chunk)
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        disconnected.cancel()
+        await chunks.aclose()
+
+async def _wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
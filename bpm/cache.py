@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+################################################################################
+##
+## This file is part of BetterPonymotes.
+## Copyright (c) 2015 Typhos.
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or (at your
+## option) any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+################################################################################
+
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+import sqlalchemy
+import sqlalchemy.exc
+
+from bpm.database import CacheGeneration
+
+# In-process cache of encoded response bodies, bounded by memory and evicted
+# in LRU order.
+#
+# Entries are bytes, keyed by anything that identifies their content (the web
+# API uses the request path and ETag). Nothing is ever dropped because its data
+# changed: changed data gets a new key, and the old entries just go unused until
+# they're evicted.
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# Rough per-entry bookkeeping overhead, so that lots of tiny entries still
+# count against the limit.
+ENTRY_OVERHEAD = 256
+
+class ResponseCache:
+    # Each process has its own.
+    shared = False
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, max_entry_bytes=None):
+        self.max_bytes = max_bytes
+        # Don't let one huge response flush out everything else.
+        if max_entry_bytes is None:
+            max_entry_bytes = max_bytes // 8
+        self.max_entry_bytes = max_entry_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict() # key -> body
+        self._size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, body):
+        size = _entry_size(key, body)
+        if size > self.max_entry_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = body
+            self._size += size
+
+            while self._size > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes
+            }
+
+    # Must hold the lock
+    def _remove(self, key):
+        body = self._entries.pop(key)
+        self._size -= _entry_size(key, body)
+
+def _entry_size(key, body):
+    return len(key) + len(body) + ENTRY_OVERHEAD
+
+# The same interface, backed by files in a directory that any number of
+# processes on the host can share, so workers don't each build (and hold) their
+# own copy of every response. The OS page cache keeps hot entries in memory
+# once, however many workers there are.
+#
+# Each entry is one file: a JSON header line (the key, in case of hash
+# collisions) and then the body. Files are written to a temporary name and
+# renamed into place, so readers only ever see complete entries. As above,
+# entries for data that has since changed are left for eviction.
+#
+# Size is enforced by scanning the directory every so often and deleting the
+# least recently used entries (by mtime, which hits update). Hit and miss
+# counts are for this process only; entries and bytes are estimates, corrected
+# by each scan.
+
+DISK_SCAN_FRACTION = 16 # Rescan after writing 1/16th of the limit
+
+class DiskCache:
+    # Every process using the directory sees the same entries.
+    shared = True
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, max_entry_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        if max_entry_bytes is None:
+            max_entry_bytes = max_bytes // 8
+        self.max_entry_bytes = max_entry_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._entries_path = os.path.join(path, "entries")
+        os.makedirs(self._entries_path, exist_ok=True)
+
+        self._entries = 0
+        self._size = 0
+        self._written = 0
+        self._scan()
+
+    def __len__(self):
+        return self._entries
+
+    def get(self, key):
+        filename = self._entry_filename(key)
+        try:
+            with open(filename, "rb") as file:
+                header = json.loads(file.readline().decode("utf8"))
+                if header["key"] != key:
+                    body = None
+                else:
+                    body = file.read()
+        except (OSError, ValueError, KeyError):
+            body = None
+            filename = None
+
+        if body is None:
+            if filename is not None:
+                _unlink(filename)
+            with self._lock:
+                self.misses += 1
+            return None
+
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return body
+
+    def put(self, key, body):
+        size = _entry_size(key, body)
+        if size > self.max_entry_bytes:
+            return
+
+        header = {"key": key}
+        filename = self._entry_filename(key)
+        directory = os.path.dirname(filename)
+        os.makedirs(directory, exist_ok=True)
+        _write_atomic(directory, filename, json.dumps(header).encode("utf8") + b"\n" + body)
+
+        with self._lock:
+            # Estimates, until the next scan
+            self._entries += 1
+            self._size += size
+            self._written += size
+            scan = self._written > self.max_bytes // DISK_SCAN_FRACTION
+        if scan:
+            self._scan()
+
+    def clear(self):
+        for (filename, size, mtime) in self._list_entries():
+            _unlink(filename)
+        with self._lock:
+            self._entries = 0
+            self._size = 0
+            self._written = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": self._entries,
+                "bytes": self._size,
+                "max_bytes": self.max_bytes
+            }
+
+    def _entry_filename(self, key):
+        digest = hashlib.sha1(key.encode("utf8")).hexdigest()
+        return os.path.join(self._entries_path, digest[:2], digest)
+
+    def _list_entries(self):
+        entries = []
+        for directory in os.scandir(self._entries_path):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                # Skip other processes' partly written temporary files.
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+    # Recounts the directory and evicts the least recently used entries until
+    # it's within the limit.
+    def _scan(self):
+        entries = self._list_entries()
+        total = sum(size for (filename, size, mtime) in entries)
+        evicted = 0
+        if total > self.max_bytes:
+            entries.sort(key=lambda entry: entry[2])
+            for (filename, size, mtime) in entries:
+                if total <= self.max_bytes:
+                    break
+                _unlink(filename)
+                total -= size
+                evicted += 1
+
+        with self._lock:
+            self._entries = len(entries) - evicted
+            self._size = total
+            self._written = 0
+            self.evictions += evicted
+
+# Cached responses can depend on data written by any process (ingestion, the
+# scheduler, maintenance scripts), not just the one serving them. So each tag
+# also has a generation in the database, bumped in the same transaction as the
+# change, and the web API folds the generations into the ETags of tagged
+# responses. That changes the cache key too, so stale entries are simply never
+# looked up again, in every process and whichever cache is in use.
+
+SUBREDDITS_TAG = "subreddits"
+
+def subreddit_tag(subreddit_name):
+    return "r/" + subreddit_name
+
+def bump_generations(s, tags):
+    table = CacheGeneration.__table__
+    for tag in sorted(set(tags)):
+        update = table.update().where(table.c.tag == tag).values(generation=table.c.generation + 1)
+        if s.execute(update).rowcount == 0:
+            try:
+                with s.begin_nested():
+                    s.execute(table.insert().values(tag=tag, generation=1))
+            except sqlalchemy.exc.IntegrityError:
+                # Another process created it first.
+                s.execute(update)
+
+# The tags' current generations as a string, in a fixed order. Tags that were
+# never bumped are generation 0.
+def tag_generations(s, tags):
+    tags = sorted(set(tags))
+    table = CacheGeneration.__table__
+    query = sqlalchemy.select([table.c.tag, table.c.generation]).where(table.c.tag.in_(tags))
+    generations = dict(s.execute(query).fetchall())
+    return ".".join(str(generations.get(tag, 0)) for tag in tags)
+
+def _write_atomic(directory, filename, data):
+    fd, temp_filename = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(temp_filename, filename)
+    except BaseException:
+        _unlink(temp_filename)
+        raise
+
+def _unlink(filename):
+    try:
+        os.unlink(filename)
+    except OSError:
+        pass
@@ -30,9 +30,16 @@ def size(text):
     # to just "0".
     return _size(prop(text))
 
-def position(text, width, height):
+# Background position of an element of the given size. Percentages align
+# that point of the image with the same point of the element, which needs the
+# image size: offset = p% * (element size - image size). Without it, they're
+# guessed at.
+def position(text, width, height, image_size=None):
     x_text, y_text = prop(text).split()
-    return (_pos(x_text, width), _pos(y_text, height))
+    if image_size is None:
+        return (_pos(x_text, width), _pos(y_text, height))
+    image_width, image_height = image_size
+    return (_pos(x_text, width, image_width), _pos(y_text, height, image_height))
 
 def url(text):
     text = prop(text)
@@ -45,7 +52,9 @@ def _size(s):
         s = s[:-2]
     return int(s)
 
-def _pos(s, size):
+def _pos(s, size, image_size=None):
+    if s[-1] == "%" and image_size is not None:
+        return round(int(s[:-1]) / 100.0 * (size - image_size))
     # Hack to handle percentage values, which are essentially multiples of the
     # width/height.
     if s[-1] == "%":
@@ -28,8 +28,8 @@ import sqlalchemy
 import sqlalchemy.orm
 import sqlalchemy.ext.declarative
 from sqlalchemy import Column, ForeignKey
-from sqlalchemy import Boolean, DateTime, Integer, String
-from sqlalchemy import ForeignKeyConstraint, UniqueConstraint
+from sqlalchemy import Boolean, DateTime, Integer, LargeBinary, String
+from sqlalchemy import ForeignKeyConstraint, Index, PrimaryKeyConstraint, UniqueConstraint
 from sqlalchemy import func
 from sqlalchemy.orm import backref, deferred, relationship
 from sqlalchemy.orm.exc import NoResultFound
@@ -48,6 +48,20 @@ def setup_sqlalchemy(database_uri=None, debug=False):
     Session.configure(bind=engine)
     return engine
 
+# Equivalent async drivers, for bpm.asgi.
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite"
+    }
+
+def async_database_uri(database_uri=None):
+    if database_uri is None:
+        database_uri = DEFAULT_DATABASE_URI
+
+    scheme, sep, rest = database_uri.partition("://")
+    dialect = scheme.split("+")[0]
+    return ASYNC_DRIVERS.get(dialect, scheme) + sep + rest
+
 def _cleanup_session(exc):
     Session.remove()
 
@@ -55,7 +69,43 @@ def setup_flask(app):
     app.teardown_appcontext(_cleanup_session)
 
 def create_tables(engine):
+    # The emote search index uses trigrams for substring searches.
+    if engine.dialect.name == "postgresql":
+        with engine.begin() as conn:
+            conn.execute(sqlalchemy.text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
     Base.metadata.create_all(bind=engine)
+    add_missing_columns(engine)
+
+# create_all() only creates tables that don't exist yet. Columns added to
+# existing tables since they were created are added here, along with their
+# indexes, so running initdb brings an older database up to date. New columns
+# are always nullable; existing rows get nulls, which the relevant backfills
+# (materialize --hashes, dlimages --fix, imageinfo) fill in.
+#
+# Returns the names ("table.column") of the columns added.
+def add_missing_columns(engine):
+    inspector = sqlalchemy.inspect(engine)
+    preparer = engine.dialect.identifier_preparer
+    tables = set(inspector.get_table_names())
+    added = []
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in tables:
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            missing = [column for column in table.columns if column.name not in existing]
+            for column in missing:
+                if not column.nullable:
+                    raise ValueError("Can't add non-null column to existing table", table.name, column.name)
+                conn.execute(sqlalchemy.text("ALTER TABLE %s ADD COLUMN %s %s" % (
+                    preparer.format_table(table),
+                    preparer.format_column(column),
+                    column.type.compile(dialect=engine.dialect))))
+                added.append("%s.%s" % (table.name, column.name))
+            for index in table.indexes:
+                if any(column.name in index.columns for column in missing):
+                    index.create(conn)
+    return added
 
 def add_database_arguments(parser, debug_default=False):
     parser.add_argument("--database", help="Database URI")
@@ -106,6 +156,36 @@ class Subreddit(Base):
             name="subreddits_latest_update_fkey"),
     )
 
+class StylesheetFetch(Base):
+    __tablename__ = "stylesheet_fetches"
+
+    # HTTP validators from a subreddit's last successful stylesheet download,
+    # so that the next one can be conditional. Either may be missing.
+    subreddit_name = Column(String, ForeignKey("subreddits.subreddit_name"), primary_key=True)
+    etag = Column(String)
+    last_modified = Column(String) # Sent back verbatim
+    checked = Column(ArrowDateTime(timezone=True)) # Last request made
+    changed = Column(ArrowDateTime(timezone=True)) # Last time it had changed
+
+    subreddit = relationship("Subreddit", backref=backref("fetch", uselist=False))
+
+class PollSchedule(Base):
+    __tablename__ = "poll_schedules"
+
+    # When bpm.scheduler will next download a subreddit's stylesheet, and how
+    # often it's currently doing so.
+    subreddit_name = Column(String, ForeignKey("subreddits.subreddit_name"), primary_key=True)
+    interval = Column(Integer, nullable=False) # Seconds
+    next_poll = Column(ArrowDateTime(timezone=True), nullable=False)
+    last_poll = Column(ArrowDateTime(timezone=True))
+    failures = Column(Integer, nullable=False) # In a row
+
+    subreddit = relationship("Subreddit", backref=backref("schedule", uselist=False))
+
+    __table_args__ = (
+        Index("poll_schedules_next_poll_idx", "next_poll"),
+        )
+
 class Update(Base):
     __tablename__ = "updates"
 
@@ -157,6 +237,18 @@ class Stylesheet(Base):
         else:
             return max + 1
 
+class StylesheetDetail(Base):
+    __tablename__ = "stylesheet_details"
+
+    # Precomputed web API output for a stylesheet (with detail=True). Since
+    # stylesheets never change, this is written once at ingestion.
+    stylesheet_id = Column(Integer, ForeignKey("stylesheets.stylesheet_id"), primary_key=True)
+    json = Column(LargeBinary, nullable=False)
+    json_gzip = Column(LargeBinary, nullable=False)
+    created = Column(ArrowDateTime(timezone=True), nullable=False)
+
+    stylesheet = relationship("Stylesheet", backref=backref("detail", uselist=False))
+
 class Image(Base):
     __tablename__ = "images"
 
@@ -167,6 +259,15 @@ class Image(Base):
     contains_emotes = Column(Boolean, nullable=False)
     filename = Column(String, nullable=False)
     downloaded = Column(ArrowDateTime(timezone=True))
+    sha256 = Column(String, index=True) # See bpm.imagestore
+    # From the downloaded file; see bpm.imageinfo. Format is "unknown" if it
+    # couldn't be read, or null if it hasn't been looked at yet. Until then,
+    # width and height may have been probed at ingestion instead.
+    format = Column(String)
+    width = Column(Integer)
+    height = Column(Integer)
+    frame_count = Column(Integer)
+    size = Column(Integer) # Bytes
 
     stylesheet = relationship("Stylesheet", backref="images")
 
@@ -174,12 +275,29 @@ class Image(Base):
         UniqueConstraint("stylesheet_id", "name"),
         )
 
+class SpriteTile(Base):
+    __tablename__ = "sprite_tiles"
+
+    # A sprite cropped out of its spritesheet (see bpm.tiles). Identified by
+    # the sheet's content hash and the rectangle, so any emote part using the
+    # same sprite of the same image shares it.
+    tile_hash = Column(String, primary_key=True) # See bpm.tiles.tile_hash()
+    image_sha256 = Column(String, nullable=False)
+    x = Column(Integer, nullable=False)
+    y = Column(Integer, nullable=False)
+    width = Column(Integer, nullable=False)
+    height = Column(Integer, nullable=False)
+    format = Column(String, nullable=False)
+    size = Column(Integer, nullable=False) # Bytes
+    created = Column(ArrowDateTime(timezone=True), nullable=False)
+
 class Emote(Base):
     __tablename__ = "emotes"
 
     emote_id = Column(Integer, primary_key=True)
     stylesheet_id = Column(Integer, ForeignKey("stylesheets.stylesheet_id"), nullable=False)
     name = Column(String, nullable=False)
+    parts_hash = Column(String) # See bpm.diff.parts_hash()
 
     stylesheet = relationship("Stylesheet", backref="emotes")
     # "parts" backref
@@ -188,6 +306,56 @@ class Emote(Base):
         UniqueConstraint("stylesheet_id", "name"),
         )
 
+class EmoteChange(Base):
+    __tablename__ = "emote_changes"
+
+    # What each update did to the emotes, relative to the update before it.
+    # Denormalized so that history queries don't need to join anything.
+    change_id = Column(Integer, primary_key=True)
+    update_id = Column(Integer, ForeignKey("updates.update_id"), nullable=False)
+    subreddit_name = Column(String, ForeignKey("subreddits.subreddit_name"), nullable=False)
+    emote_name = Column(String, nullable=False)
+    change = Column(String, nullable=False) # "added", "removed" or "changed"
+    created = Column(ArrowDateTime(timezone=True), nullable=False) # Same as the update
+
+    update = relationship("Update", backref="emote_changes")
+
+    __table_args__ = (
+        UniqueConstraint("update_id", "emote_name"),
+        Index("emote_changes_subreddit_idx", "subreddit_name", "change_id"),
+        Index("emote_changes_emote_idx", "subreddit_name", "emote_name", "created"),
+        Index("emote_changes_created_idx", "created"),
+        )
+
+class LatestEmote(Base):
+    __tablename__ = "latest_emotes"
+
+    # Search index over the emotes in every subreddit's latest stylesheet.
+    # Maintained by bpm.search whenever latest_update_id moves.
+    subreddit_name = Column(String, ForeignKey("subreddits.subreddit_name"), nullable=False)
+    emote_name = Column(String, nullable=False)
+    emote_id = Column(Integer, ForeignKey("emotes.emote_id"), nullable=False)
+    stylesheet_id = Column(Integer, ForeignKey("stylesheets.stylesheet_id"), nullable=False)
+
+    __table_args__ = (
+        PrimaryKeyConstraint("subreddit_name", "emote_name"),
+        # Exact and prefix (LIKE 'foo%') matches, regardless of collation.
+        Index("latest_emotes_name_idx", "emote_name",
+            postgresql_ops={"emote_name": "text_pattern_ops"}),
+        # Substring (LIKE '%foo%') matches. Needs the pg_trgm extension.
+        Index("latest_emotes_name_trgm_idx", "emote_name",
+            postgresql_using="gin",
+            postgresql_ops={"emote_name": "gin_trgm_ops"}),
+        )
+
+class CacheGeneration(Base):
+    __tablename__ = "cache_generations"
+
+    # Version of each group of cached web API responses (see bpm.cache).
+    # Bumped by whatever changes the data behind them, in any process.
+    tag = Column(String, primary_key=True)
+    generation = Column(Integer, nullable=False)
+
 class EmotePart(Base):
     __tablename__ = "emote_parts"
 
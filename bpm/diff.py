@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+################################################################################
+##
+## This file is part of BetterPonymotes.
+## Copyright (c) 2015 Typhos.
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or (at your
+## option) any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+################################################################################
+
+
+import hashlib
+import json
+
+import bpm.cache
+from bpm.database import Update, Image, Emote, EmoteChange
+
+# Differences between stylesheets.
+#
+# Emotes are compared by a hash of their parts, computed at ingestion time, so
+# a diff only needs (name, hash) pairs from each side and never has to load or
+# serialize the parts themselves.
+
+# Hashes an emote's parts (EmotePart rows), ignoring IDs and part order.
+def parts_hash(parts):
+    data = sorted(json.dumps(part.serialize(), sort_keys=True) for part in parts)
+    return hashlib.sha256(json.dumps(data).encode("utf8")).hexdigest()
+
+# Fills in missing parts hashes, e.g. for emotes ingested before they existed.
+# Returns the number of emotes updated.
+def backfill_parts_hashes(s, stylesheet_id=None, batch_size=1000):
+    count = 0
+    while True:
+        q = s.query(Emote).filter(Emote.parts_hash == None)
+        if stylesheet_id is not None:
+            q = q.filter(Emote.stylesheet_id == stylesheet_id)
+        emotes = q.order_by(Emote.emote_id).limit(batch_size).all()
+        if not emotes:
+            return count
+        for emote in emotes:
+            emote.parts_hash = parts_hash(emote.parts)
+        s.flush()
+        count += len(emotes)
+
+def _emote_hashes(s, stylesheet_id):
+    hashes = dict(s.query(Emote.name, Emote.parts_hash).filter_by(stylesheet_id=stylesheet_id).all())
+
+    # Fall back to hashing the slow way if this stylesheet hasn't been
+    # backfilled yet.
+    if None in hashes.values():
+        q = s.query(Emote).filter_by(stylesheet_id=stylesheet_id, parts_hash=None)
+        for emote in q:
+            hashes[emote.name] = parts_hash(emote.parts)
+    return hashes
+
+def _image_urls(s, stylesheet_id):
+    return dict(s.query(Image.name, Image.url).filter_by(stylesheet_id=stylesheet_id).all())
+
+def _diff_dicts(old, new):
+    return {
+        "added": sorted(set(new) - set(old)),
+        "removed": sorted(set(old) - set(new)),
+        "changed": sorted(name for name in set(old) & set(new) if old[name] != new[name])
+    }
+
+# Returns {"emotes": {...}, "images": {...}}, each with sorted "added",
+# "removed" and "changed" lists of names.
+#
+# Emotes are always compared by their parts, even when the CSS is identical,
+# since what's extracted from it also depends on the images (see
+# bpm.extract.extract_sprite()).
+def diff_stylesheets(s, old_ss, new_ss):
+    old_emotes = _emote_hashes(s, old_ss.stylesheet_id)
+    new_emotes = _emote_hashes(s, new_ss.stylesheet_id)
+    old_images = _image_urls(s, old_ss.stylesheet_id)
+    new_images = _image_urls(s, new_ss.stylesheet_id)
+
+    return {
+        "emotes": _diff_dicts(old_emotes, new_emotes),
+        "images": _diff_dicts(old_images, new_images)
+    }
+
+def diff_updates(s, old_update, new_update):
+    return diff_stylesheets(s, old_update.stylesheet, new_update.stylesheet)
+
+# Writes the change log for an update, relative to the given previous update
+# (or None if it's the first). Returns the new EmoteChange rows.
+def record_changes(s, update, previous):
+    if previous is None:
+        names = [name for (name,) in s.query(Emote.name).filter_by(stylesheet_id=update.stylesheet_id)]
+        emote_diff = {"added": sorted(names), "removed": [], "changed": []}
+    else:
+        emote_diff = diff_updates(s, previous, update)["emotes"]
+
+    changes = []
+    for (kind, names) in sorted(emote_diff.items()):
+        for name in names:
+            change = EmoteChange(
+                update_id=update.update_id,
+                subreddit_name=update.subreddit_name,
+                emote_name=name,
+                change=kind,
+                created=update.created)
+            s.add(change)
+            changes.append(change)
+    return changes
+
+# Rebuilds the change log for a subreddit from its full update history.
+def rebuild_changes(s, subreddit_name):
+    s.query(EmoteChange).filter_by(subreddit_name=subreddit_name).delete(synchronize_session=False)
+
+    previous = None
+    for update in s.query(Update).filter_by(subreddit_name=subreddit_name).order_by(Update.update_seq):
+        record_changes(s, update, previous)
+        previous = update
+
+    bpm.cache.bump_generations(s, [bpm.cache.SUBREDDITS_TAG, bpm.cache.subreddit_tag(subreddit_name)])
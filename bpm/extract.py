@@ -72,12 +72,14 @@ class EmotePart:
         return d
 
 class Sprite:
-    def __init__(self, image_url, x, y, width, height):
+    def __init__(self, image_url, x, y, width, height, guessed=False):
         self.image_url = image_url
         self.x = x
         self.y = y
         self.width = width
         self.height = height
+        # True if the position depends on the image size, which wasn't known
+        self.guessed = guessed
 
     def __repr__(self):
         return "Sprite(%r, %r, %r, %r, %r)" % (self.image_url, self.x, self.y, self.width, self.height)
@@ -144,7 +146,9 @@ def collapse_rules(rules):
     props.update(important_props)
     return props
 
-def extract_sprite(name, original_css):
+# image_sizes maps image URL's (as written in the CSS) to (width, height), for
+# the images whose sizes are known.
+def extract_sprite(name, original_css, image_sizes=None):
     css = original_css.copy()
 
     # Required emote markers
@@ -166,6 +170,7 @@ def extract_sprite(name, original_css):
 
     # Find the background image. One of these is also required.
     image_url = None
+    repeat = []
     if "background" in css:
         parts = bpm.cssutil.prop(css.pop("background")).split()
         for p in parts:
@@ -175,6 +180,9 @@ def extract_sprite(name, original_css):
                     log.warning("{}: Multiple images on 'background' property", name)
 
                 image_url = bpm.cssutil.url(p)
+            elif p.lower() in REPEAT_KEYWORDS:
+                # Discarded too, but needed to make sense of the position.
+                repeat.append(p.lower())
             else:
                 # Since we remove the property and currently have no way to
                 # reassemble all but the image into separate properties,
@@ -197,22 +205,62 @@ def extract_sprite(name, original_css):
     width = bpm.cssutil.size(css.pop("width"))
     height = bpm.cssutil.size(css.pop("height"))
 
+    image_size = (image_sizes or {}).get(image_url)
+    if image_size is not None and (image_size[0] <= 0 or image_size[1] <= 0):
+        image_size = None
+
+    # Takes priority over background. (Removed later by clean_css().)
+    if "background-repeat" in css:
+        repeat = bpm.cssutil.prop(css["background-repeat"]).lower().split()
+    repeat_x, repeat_y = _repeats(repeat)
+
     # Position
+    guessed = False
     if "background-position" in css:
-        x, y = bpm.cssutil.position(css.pop("background-position"), width, height)
+        position = css.pop("background-position")
+        x, y = bpm.cssutil.position(position, width, height, image_size)
+        # Percentages are only guessed at without the image size.
+        guessed = "%" in position and image_size is None
     else:
         x, y = 0, 0
 
-    if x > 0 or y > 0:
-        log.warning("{}: Positive background position ({}, {})", name, x, y)
-        # No idea what to do here. We'd need the image size to do this
-        # correctly.
-        x = -abs(x)
-        y = -abs(y)
-
-    sprite = Sprite(image_url, x, y, width, height)
+    # A positive offset leaves a gap before the image, unless the background
+    # repeats, in which case it shows the same thing as an offset one image
+    # width (or height) further back. Gaps are left as they are.
+    if (x > 0 and repeat_x) or (y > 0 and repeat_y):
+        if image_size is not None:
+            if repeat_x:
+                x = -(-x % image_size[0])
+            if repeat_y:
+                y = -(-y % image_size[1])
+        else:
+            log.warning("{}: Positive background position ({}, {})", name, x, y)
+            # No idea what to do here. We'd need the image size to do this
+            # correctly.
+            if repeat_x:
+                x = -abs(x)
+            if repeat_y:
+                y = -abs(y)
+            guessed = True
+
+    sprite = Sprite(image_url, x, y, width, height, guessed=guessed)
     return (sprite, css)
 
+REPEAT_KEYWORDS = {"repeat", "repeat-x", "repeat-y", "no-repeat", "space", "round"}
+
+# Returns whether background-repeat values repeat horizontally and
+# vertically. Backgrounds repeat by default.
+def _repeats(values):
+    if not values:
+        return (True, True)
+    if values[0] == "repeat-x":
+        return (True, False)
+    if values[0] == "repeat-y":
+        return (False, True)
+    x = values[0]
+    y = values[1] if len(values) > 1 else x
+    return (x != "no-repeat", y != "no-repeat")
+
 FILTERED_PROPERTIES = {
     "background-repeat": None,
     "clear": None,
@@ -244,11 +292,11 @@ def check_css(name, css):
         if prop not in IGNORED_PROPERTIES:
             log.debug("{}: Unknown extra property {!r}: {!r}", name, prop, value)
 
-def extract_emote(name, group, animations):
+def extract_emote(name, group, animations, image_sizes=None):
     d = {}
     for (key, rules) in group.items():
         css = collapse_rules(rules)
-        sprite, css = extract_sprite(name, css)
+        sprite, css = extract_sprite(name, css, image_sizes)
         animation = extract_animation(css, animations)
         if sprite:
             clean_css(css)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+################################################################################
+##
+## This file is part of BetterPonymotes.
+## Copyright (c) 2015 Typhos.
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or (at your
+## option) any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+################################################################################
+
+
+import asyncio
+import select
+import threading
+import time
+
+import logbook
+import sqlalchemy
+import sqlalchemy.event
+from sqlalchemy import func
+
+from bpm.database import Update
+
+log = logbook.Logger(__name__)
+
+# Change notifications for new updates.
+#
+# Update IDs only ever go up, so they serve as the feed cursor: a client that
+# has seen update N wants everything after N. Each process has one
+# Broadcaster, which waiting clients block on. It's woken by:
+#
+# - Commits in this process, via session events.
+# - PostgreSQL NOTIFY from other processes (see notify()), via one listener
+#   thread holding a single connection.
+# - On other databases, the same thread polling for the latest update ID.
+#
+# Either way, an idle client costs a sleeping thread and nothing else; there's
+# no per-client database traffic until something actually happens.
+
+CHANNEL = "bpm_updates"
+
+POLL_INTERVAL = 5
+
+class Broadcaster:
+    def __init__(self):
+        self.latest_id = None
+        self._cond = threading.Condition()
+        self._futures = [] # (loop, future), for wait_async()
+
+    def publish(self, update_id):
+        with self._cond:
+            if self.latest_id is None or update_id > self.latest_id:
+                self.latest_id = update_id
+                self._cond.notify_all()
+                futures, self._futures = self._futures, []
+            else:
+                futures = []
+        for (loop, future) in futures:
+            try:
+                loop.call_soon_threadsafe(_set_done, future)
+            except RuntimeError: # Loop closed
+                pass
+
+    # Blocks until there's an update after the given ID, or the timeout
+    # expires. Returns the latest known update ID.
+    def wait(self, after, timeout):
+        with self._cond:
+            self._cond.wait_for(lambda: self.latest_id is not None and self.latest_id > after, timeout)
+            return self.latest_id
+
+    # The same, for event loops. Waiting costs a future rather than a thread.
+    async def wait_async(self, after, timeout):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            with self._cond:
+                if self.latest_id is not None and self.latest_id > after:
+                    return self.latest_id
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return self.latest_id
+                future = loop.create_future()
+                self._futures.append((loop, future))
+            try:
+                await asyncio.wait_for(future, remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self._cond:
+                    if (loop, future) in self._futures:
+                        self._futures.remove((loop, future))
+
+def _set_done(future):
+    if not future.done():
+        future.set_result(None)
+
+broadcaster = Broadcaster()
+
+# Announces a new update to other processes. Takes effect when the
+# transaction commits. A no-op except on PostgreSQL.
+def notify(s, update):
+    if s.bind.dialect.name == "postgresql":
+        s.execute(sqlalchemy.text("SELECT pg_notify(:channel, :payload)"),
+            {"channel": CHANNEL, "payload": str(update.update_id)})
+
+# Publishes updates committed through sessions from this factory.
+def listen_sessions(session_factory):
+    sqlalchemy.event.listen(session_factory, "after_flush", _track_updates)
+    sqlalchemy.event.listen(session_factory, "after_commit", _publish_updates)
+    sqlalchemy.event.listen(session_factory, "after_rollback", _forget_updates)
+
+def _track_updates(session, flush_context):
+    ids = session.info.setdefault("bpm_new_update_ids", set())
+    for obj in session.new:
+        if isinstance(obj, Update):
+            ids.add(obj.update_id)
+
+def _publish_updates(session):
+    ids = session.info.pop("bpm_new_update_ids", None)
+    if ids:
+        broadcaster.publish(max(ids))
+
+def _forget_updates(session):
+    session.info.pop("bpm_new_update_ids", None)
+
+_listener = None
+_listener_lock = threading.Lock()
+
+# Starts the background listener for this process, if it isn't running.
+def start_listener(engine):
+    global _listener
+    with _listener_lock:
+        if _listener is not None and _listener.is_alive():
+            return
+        if engine.dialect.name == "postgresql":
+            target = _listen_postgresql
+        else:
+            target = _poll
+        _listener = threading.Thread(target=target, args=(engine,), name="bpm-feed", daemon=True)
+        _listener.start()
+
+def _latest_update_id(engine):
+    with engine.connect() as conn:
+        return conn.execute(sqlalchemy.select([func.max(Update.update_id)])).scalar()
+
+def _poll(engine):
+    while True:
+        try:
+            latest = _latest_update_id(engine)
+            if latest is not None:
+                broadcaster.publish(latest)
+        except Exception:
+            log.exception("Error polling for updates")
+        time.sleep(POLL_INTERVAL)
+
+def _listen_postgresql(engine):
+    while True:
+        try:
+            conn = engine.raw_connection()
+            try:
+                conn.set_isolation_level(0) # Autocommit, so notifications arrive
+                cursor = conn.cursor()
+                cursor.execute("LISTEN " + CHANNEL)
+                # Catch up on anything we missed before listening.
+                cursor.execute("SELECT max(update_id) FROM updates")
+                latest = cursor.fetchone()[0]
+                if latest is not None:
+                    broadcaster.publish(latest)
+
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notification = conn.notifies.pop(0)
+                        broadcaster.publish(int(notification.payload))
+            finally:
+                conn.close()
+        except Exception:
+            log.exception("Error listening for updates; reconnecting")
+            time.sleep(POLL_INTERVAL)
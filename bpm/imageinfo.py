@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+################################################################################
+##
+## This file is part of BetterPonymotes.
+## Copyright (c) 2015 Typhos.
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or (at your
+## option) any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+################################################################################
+
+
+import collections
+import concurrent.futures
+import io
+import os
+import struct
+
+# Reads image dimensions, format and frame count from file headers, without
+# decoding any pixel data. PNG (and APNG), JPEG and GIF are understood; only
+# GIF needs more than the first few hundred bytes, since its frames have to be
+# counted by skipping from one to the next.
+
+ImageInfo = collections.namedtuple("ImageInfo", ["format", "width", "height", "frame_count", "size"])
+
+class ImageInfoError(ValueError):
+    pass
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+JPEG_SIGNATURE = b"\xff\xd8"
+GIF_SIGNATURES = (b"GIF87a", b"GIF89a")
+
+# Returns an ImageInfo, or None if the format isn't recognized. Raises
+# ImageInfoError if the file is truncated or corrupt.
+def read_info(path):
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        magic = file.read(8)
+        file.seek(0)
+        if magic.startswith(PNG_SIGNATURE):
+            format, width, height, frame_count = _read_png(file)
+        elif magic.startswith(JPEG_SIGNATURE):
+            format, width, height, frame_count = _read_jpeg(file)
+        elif magic[:6] in GIF_SIGNATURES:
+            format, width, height, frame_count = _read_gif(file)
+        else:
+            return None
+    return ImageInfo(format, width, height, frame_count, size)
+
+# Returns (width, height) from the first bytes of an image, or None if they
+# aren't enough or the format isn't recognized. For sizing images that haven't
+# been downloaded yet.
+def read_size(data):
+    file = io.BytesIO(data)
+    try:
+        if data.startswith(PNG_SIGNATURE):
+            file.seek(len(PNG_SIGNATURE))
+            length, type = struct.unpack(">I4s", _read(file, 8))
+            if type != b"IHDR":
+                return None
+            return struct.unpack(">II", _read(file, 8))
+        elif data.startswith(JPEG_SIGNATURE):
+            format, width, height, frame_count = _read_jpeg(file)
+            return (width, height)
+        elif data[:6] in GIF_SIGNATURES:
+            file.seek(6)
+            return struct.unpack("<HH", _read(file, 4))
+    except (ImageInfoError, struct.error):
+        pass
+    return None
+
+def _read(file, n):
+    data = file.read(n)
+    if len(data) != n:
+        raise ImageInfoError("Unexpected end of file")
+    return data
+
+def _read_png(file):
+    file.seek(len(PNG_SIGNATURE))
+    length, type = struct.unpack(">I4s", _read(file, 8))
+    if type != b"IHDR" or length < 8:
+        raise ImageInfoError("PNG doesn't start with IHDR")
+    width, height = struct.unpack(">II", _read(file, 8))
+    file.seek(length - 8 + 4, os.SEEK_CUR) # Rest of IHDR, and CRC
+
+    # An APNG's acTL must come before the first IDAT.
+    while True:
+        length, type = struct.unpack(">I4s", _read(file, 8))
+        if type == b"acTL":
+            (frame_count,) = struct.unpack(">I", _read(file, 4))
+            return ("apng", width, height, frame_count)
+        if type in (b"IDAT", b"IEND"):
+            return ("png", width, height, 1)
+        file.seek(length + 4, os.SEEK_CUR)
+
+# Start of frame markers, which carry the dimensions. C4, C8 and CC are
+# something else.
+JPEG_SOF_MARKERS = {0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf}
+# Markers with no length or payload
+JPEG_STANDALONE_MARKERS = {0x01, 0xd0, 0xd1, 0xd2, 0xd3, 0xd4, 0xd5, 0xd6, 0xd7, 0xd8}
+
+def _read_jpeg(file):
+    file.seek(len(JPEG_SIGNATURE))
+    while True:
+        if _read(file, 1) != b"\xff":
+            raise ImageInfoError("Bad JPEG marker")
+        marker = _read(file, 1)[0]
+        while marker == 0xff: # Fill bytes
+            marker = _read(file, 1)[0]
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        if marker in (0xd9, 0xda): # End of image, start of scan
+            raise ImageInfoError("No JPEG frame header")
+        (length,) = struct.unpack(">H", _read(file, 2))
+        if marker in JPEG_SOF_MARKERS:
+            precision, height, width = struct.unpack(">BHH", _read(file, 5))
+            return ("jpeg", width, height, 1)
+        file.seek(length - 2, os.SEEK_CUR)
+
+def _read_gif(file):
+    file.seek(6)
+    width, height, flags = struct.unpack("<HHB", _read(file, 5))
+    file.seek(2, os.SEEK_CUR) # Background color, aspect ratio
+    if flags & 0x80:
+        file.seek(3 << ((flags & 0x07) + 1), os.SEEK_CUR) # Global color table
+
+    frame_count = 0
+    while True:
+        block = file.read(1)
+        if block in (b";", b""): # Trailer, or a truncated file that browsers would still play
+            break
+        elif block == b",": # Image descriptor
+            frame_count += 1
+            flags = _read(file, 9)[8]
+            if flags & 0x80:
+                file.seek(3 << ((flags & 0x07) + 1), os.SEEK_CUR) # Local color table
+            file.seek(1, os.SEEK_CUR) # LZW code size
+            _skip_gif_subblocks(file)
+        elif block == b"!": # Extension
+            file.seek(1, os.SEEK_CUR) # Label
+            _skip_gif_subblocks(file)
+        else:
+            raise ImageInfoError("Bad GIF block")
+
+    return ("gif", width, height, frame_count)
+
+def _skip_gif_subblocks(file):
+    while True:
+        length = _read(file, 1)[0]
+        if length == 0:
+            return
+        file.seek(length, os.SEEK_CUR)
+
+# Reads many files on a pool of processes (this is mostly parsing, which
+# threads wouldn't help with). Yields (path, info, error) in order; error is a
+# message if the file couldn't be read.
+def read_all(paths, workers=None, chunksize=16):
+    paths = list(paths)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for (path, (info, error)) in zip(paths, executor.map(_read_info, paths, chunksize=chunksize)):
+            yield (path, info, error)
+
+def _read_info(path):
+    try:
+        return (read_info(path), None)
+    except (OSError, ImageInfoError, struct.error) as e:
+        return (None, str(e))
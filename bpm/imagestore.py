@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+################################################################################
+##
+## This file is part of BetterPonymotes.
+## Copyright (c) 2015 Typhos.
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or (at your
+## option) any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+################################################################################
+
+
+import hashlib
+import os
+import tempfile
+import time
+
+# Content-addressed storage for downloaded images.
+#
+# Every distinct image is kept once, as sha256/<first two hex digits>/<hash>
+# under the image directory. The familiar URL-derived names (see
+# bpm.images.image_filename()) are hard links to those objects, so anything
+# reading images/<filename> is unaffected, while re-uploads of the same bytes
+# under new names take no extra space.
+#
+# Objects are only ever created by renaming complete files into place, and
+# names are relinked the same way, so readers never see partial files. Nothing
+# is deleted except by gc().
+
+IMAGE_DIR = "images"
+CHUNK_SIZE = 64 * 1024
+
+# Objects younger than this are never collected, since a running download may
+# have stored one without having committed its hash yet.
+GC_GRACE = 60 * 60 # Seconds
+
+class ImageStore:
+    def __init__(self, root=IMAGE_DIR):
+        self.root = root
+        self.objects_path = os.path.join(root, "sha256")
+        os.makedirs(self.objects_path, exist_ok=True)
+
+    def object_path(self, sha256):
+        return os.path.join(self.objects_path, sha256[:2], sha256)
+
+    def link_path(self, filename):
+        return os.path.join(self.root, filename)
+
+    def has(self, sha256):
+        return os.path.exists(self.object_path(sha256))
+
+    # Returns (file, temp_path) for writing a new image into. Pass the path to
+    # add() once it's written and closed, or discard() if it isn't needed.
+    def new_file(self):
+        fd, temp_path = tempfile.mkstemp(dir=self.objects_path, prefix=".tmp-")
+        return (os.fdopen(fd, "wb"), temp_path)
+
+    def discard(self, temp_path):
+        _unlink(temp_path)
+
+    # Stores a finished temporary file under its hash. Returns True if it was
+    # new, or False if the same image was already stored (and the file has been
+    # thrown away).
+    def add(self, temp_path, sha256):
+        path = self.object_path(sha256)
+        if os.path.exists(path):
+            _unlink(temp_path)
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+        return True
+
+    # Points a URL-derived name at a stored image.
+    def link(self, sha256, filename):
+        path = self.link_path(filename)
+        object_path = self.object_path(sha256)
+        if _same_file(path, object_path):
+            return
+        # Link under a temporary name and rename over the old one, so the name
+        # always refers to some complete image.
+        temp_path = os.path.join(self.root, ".tmp-link-%s-%s" % (os.getpid(), sha256))
+        _unlink(temp_path)
+        os.link(object_path, temp_path)
+        os.replace(temp_path, path)
+
+    # Moves an existing plain file (from before the store existed) into the
+    # store, replacing it with a link. Returns its hash.
+    def adopt(self, filename):
+        path = self.link_path(filename)
+        sha256 = hash_file(path)
+        object_path = self.object_path(sha256)
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            os.link(path, object_path)
+            # Counts as new, as far as gc() is concerned.
+            os.utime(object_path)
+        else:
+            self.link(sha256, filename)
+        return sha256
+
+    # Yields (sha256, path, size, mtime) for every stored image.
+    def objects(self):
+        for directory in os.scandir(self.objects_path):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                if entry.name.startswith("."):
+                    continue
+                stat = entry.stat()
+                yield (entry.name, entry.path, stat.st_size, stat.st_mtime)
+
+    # Yields every URL-derived name.
+    def filenames(self):
+        for entry in os.scandir(self.root):
+            if entry.is_file() and not entry.name.startswith("."):
+                yield entry.name
+
+    # Deletes names that aren't in live_filenames, and then images that
+    # aren't in live_hashes. Returns (names removed, images removed, bytes
+    # freed).
+    def gc(self, live_hashes, live_filenames, dry_run=False, grace=GC_GRACE):
+        removed_names = 0
+        for filename in list(self.filenames()):
+            if filename not in live_filenames:
+                if not dry_run:
+                    _unlink(self.link_path(filename))
+                removed_names += 1
+
+        removed_objects = 0
+        freed = 0
+        cutoff = time.time() - grace
+        for (sha256, path, size, mtime) in list(self.objects()):
+            if sha256 in live_hashes or mtime > cutoff:
+                continue
+            if not dry_run:
+                _unlink(path)
+            removed_objects += 1
+            freed += size
+
+        return (removed_names, removed_objects, freed)
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _same_file(a, b):
+    try:
+        return os.path.samefile(a, b)
+    except OSError:
+        return False
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+################################################################################
+##
+## This file is part of BetterPonymotes.
+## Copyright (c) 2015 Typhos.
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or (at your
+## option) any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+################################################################################
+
+import hashlib
+import json
+
+import arrow
+import logbook
+import requests
+
+import bpm.cache
+import bpm.css
+import bpm.database
+import bpm.diff
+import bpm.extract
+import bpm.feed
+import bpm.imageinfo
+import bpm.images
+import bpm.reddit
+import bpm.search
+import bpm.serialize
+
+log = logbook.Logger(__name__)
+
+# Turns a downloaded stylesheet into a new update: parsing, then writing the
+# stylesheet, images, emotes and update, then everything derived from them.
+
+def extract_emotes(rules, image_sizes=None):
+    raw_emotes = bpm.extract.group_rules(rules)
+    animations = bpm.extract.find_animations(rules)
+
+    emotes = {}
+
+    for (name, group) in raw_emotes.items():
+        emote = bpm.extract.extract_emote(name, group, animations, image_sizes)
+        emotes[name] = emote
+
+    return emotes
+
+def find_spritesheets(emotes):
+    spritesheets = set()
+
+    for (name, emote) in emotes.items():
+        for part in emote.parts.values():
+            if part.sprite:
+                url = part.sprite.image_url
+                assert url.startswith("%%") and url.endswith("%%")
+                spritesheets.add(url[2:-2])
+
+    return spritesheets
+
+def css_hash(css):
+    return hashlib.sha256(css.encode("utf8")).hexdigest()
+
+# image_sizes maps image URL's to (width, height), for whichever images have
+# already been downloaded and indexed (see indexed_image_sizes()).
+#
+# Returns (emotes, spritesheets).
+def parse_stylesheet(css, noignore=False, images=None, image_sizes=None):
+    rules = bpm.css.parse_stylesheet(css)
+    if not noignore:
+        rules = bpm.extract.filter_ponyscript_ignore(rules)
+
+    rules = list(rules) # Force the generator so we can use this multiple times
+
+    # The CSS refers to images by name.
+    sizes = {}
+    if images and image_sizes:
+        for (name, url) in images.items():
+            if url in image_sizes:
+                sizes["%%" + name + "%%"] = image_sizes[url]
+
+    emotes = extract_emotes(rules, sizes)
+    spritesheets = find_spritesheets(emotes)
+    return (emotes, spritesheets)
+
+# Spritesheets whose size some emote's position was guessed without.
+def guessed_spritesheets(emotes):
+    names = set()
+    for emote in emotes.values():
+        for part in emote.parts.values():
+            if part.sprite and part.sprite.guessed:
+                names.add(part.sprite.image_url[2:-2])
+    return names
+
+# Enough for the headers of any image we've seen. JPEG's can put a lot of
+# metadata in front of the frame header.
+PROBE_BYTES = 64 * 1024
+
+# Returns {url: (width, height)} for the named images, from just the first
+# bytes of each. Images that can't be sized are left out.
+def probe_image_sizes(images, names):
+    sizes = {}
+    for name in sorted(names):
+        url = images.get(name)
+        if url is None:
+            continue
+        try:
+            data = _download_head(bpm.images.image_download_url(url))
+        except requests.exceptions.RequestException as e:
+            log.warning("Couldn't probe {}: {}", url, e)
+            continue
+        if data is None:
+            continue
+        size = bpm.imageinfo.read_size(data)
+        if size is None:
+            log.warning("Couldn't probe {}: unrecognized image", url)
+            continue
+        sizes[url] = size
+    return sizes
+
+# The first PROBE_BYTES of an image, or None if it couldn't be downloaded.
+# Hosts that ignore the Range header send the whole thing, so the body is
+# streamed and the rest never read.
+def _download_head(url):
+    headers = {"Range": "bytes=0-%s" % (PROBE_BYTES - 1)}
+    with bpm.reddit.download(url, headers=headers, stream=True) as r:
+        if r.status_code not in (200, 206):
+            log.warning("Couldn't probe {}: HTTP {}", url, r.status_code)
+            return None
+        return next(r.iter_content(PROBE_BYTES), b"")[:PROBE_BYTES]
+
+# Records sizes probed at fetch time on the images that don't have one yet,
+# so they aren't probed again before they're downloaded and indexed (which
+# replaces them).
+def record_image_sizes(s, image_sizes):
+    Image = bpm.database.Image
+    for (url, (width, height)) in sorted(image_sizes.items()):
+        q = s.query(Image).filter(Image.url == url, Image.width == None)
+        q.update({Image.width: width, Image.height: height}, synchronize_session=False)
+
+# Returns {url: (width, height)} for indexed images, optionally only those with
+# the given URL's.
+def indexed_image_sizes(s, urls=None):
+    Image = bpm.database.Image
+    q = s.query(Image.url, Image.width, Image.height).filter(Image.width != None).distinct()
+    if urls is not None:
+        q = q.filter(Image.url.in_(list(urls)))
+    return {url: (width, height) for (url, width, height) in q}
+
+# True if this is exactly what the subreddit's latest update already has, in
+# which case there's nothing to ingest.
+def is_unchanged(s, subreddit, css, images):
+    if subreddit.latest_update_id is None:
+        return False
+    stylesheet = subreddit.latest_update.stylesheet
+    if stylesheet.css_hash != css_hash(css):
+        return False
+    old_images = dict(s.query(bpm.database.Image.name, bpm.database.Image.url).filter_by(stylesheet_id=stylesheet.stylesheet_id))
+    return old_images == images
+
+# Writes a new update for the subreddit. Doesn't commit. Returns the Update.
+def ingest(s, subreddit, css, images, emotes, spritesheets, now=None):
+    if now is None:
+        now = arrow.utcnow()
+
+    # Add stylesheet
+    stylesheet_seq = bpm.database.Stylesheet.next_stylesheet_seq(s, subreddit)
+    stylesheet = bpm.database.Stylesheet(
+        subreddit_name=subreddit.subreddit_name,
+        stylesheet_seq=stylesheet_seq,
+        downloaded=now,
+        css=css,
+        css_hash=css_hash(css))
+
+    # Partial commit to get stylesheet_id
+    s.begin_nested()
+    s.add(stylesheet)
+    s.commit()
+
+    # Add all images.
+    for (name, url) in sorted(images.items()):
+        filename = bpm.images.image_filename(url)
+        contains_emotes = name in spritesheets
+        image = bpm.database.Image(
+                stylesheet_id=stylesheet.stylesheet_id,
+                name=name,
+                url=url,
+                contains_emotes=contains_emotes,
+                filename=filename)
+        s.add(image)
+
+    # Add all emotes (not parts). One big partial commit to get emote ID's.
+    s.begin_nested()
+    emote_rows = {}
+    for (name, emote) in sorted(emotes.items()):
+        e = bpm.database.Emote(stylesheet_id=stylesheet.stylesheet_id, name=name)
+        emote_rows[name] = e
+        s.add(e)
+    s.commit()
+
+    # Add all emote parts.
+    for (name, emote) in sorted(emotes.items()):
+        part_rows = []
+        for (specifiers, part) in sorted(emote.parts.items()):
+            specifiers_json = json.dumps(part.serialize_specifiers()) if part.specifiers else None
+            css_json = json.dumps(part.css, sort_keys=True) if part.css else None
+
+            p = bpm.database.EmotePart(
+                emote_id=emote_rows[name].emote_id,
+                specifiers=specifiers_json,
+                animation=part.animation,
+                css=css_json)
+
+            if part.sprite:
+                p.sprite_image_url = part.sprite.image_url
+                p.sprite_x = part.sprite.x
+                p.sprite_y = part.sprite.y
+                p.sprite_width = part.sprite.width
+                p.sprite_height = part.sprite.height
+
+            s.add(p)
+            part_rows.append(p)
+
+        emote_rows[name].parts_hash = bpm.diff.parts_hash(part_rows)
+
+    # Add update
+    seq = bpm.database.Update.next_update_seq(s, subreddit)
+    update = bpm.database.Update(subreddit_name=subreddit.subreddit_name, update_seq=seq, stylesheet_id=stylesheet.stylesheet_id, created=now)
+
+    # Partial commit to get update ID
+    s.begin_nested()
+    s.add(update)
+    s.commit()
+
+    # Record what changed since the previous latest update.
+    bpm.diff.record_changes(s, update, subreddit.latest_update)
+
+    # Tell anyone following the feed (delivered on commit).
+    bpm.feed.notify(s, update)
+
+    # Everything served about this subreddit, and the listings, is now stale.
+    bpm.cache.bump_generations(s, [bpm.cache.SUBREDDITS_TAG, bpm.cache.subreddit_tag(subreddit.subreddit_name)])
+
+    # Mark this as the latest update.
+    subreddit.latest_update_id = update.update_id
+    s.add(subreddit)
+
+    # Precompute the web API's detailed stylesheet JSON. Expire everything
+    # first so that the relationships are loaded fresh from what we just wrote.
+    s.flush()
+    s.expire_all()
+    bpm.serialize.materialize_stylesheet(s, stylesheet)
+
+    # Point the emote search index at the new emotes.
+    bpm.search.refresh_subreddit(s, subreddit)
+
+    return update
+
+# Downloading straight from reddit: fetch() does the network and parsing work
+# (no database access, so it can run on worker threads), then apply_fetch()
+# records the result. A 304 never gets as far as parsing.
+
+# Returns (bpm.reddit.Fetch, parsed, probed), where parsed is None if there's
+# no new stylesheet, and probed has the sizes of any images that had to be
+# probed for it (see apply_fetch()).
+def fetch(subreddit_name, etag=None, last_modified=None, noignore=False, image_sizes=None):
+    result = bpm.reddit.fetch_stylesheet(subreddit_name, etag=etag, last_modified=last_modified)
+    if result.css is None:
+        return (result, None, {})
+    parsed = parse_stylesheet(result.css, noignore=noignore, images=result.images, image_sizes=image_sizes)
+
+    # New stylesheets usually bring new images, which dlimages hasn't seen
+    # yet. Rather than store positions that depend on a guess, size the
+    # images from their headers and parse again.
+    image_sizes = dict(image_sizes or {})
+    missing = {name for name in guessed_spritesheets(parsed[0]) if result.images.get(name) not in image_sizes}
+    probed = {}
+    if missing:
+        probed = probe_image_sizes(result.images, missing)
+        if probed:
+            image_sizes.update(probed)
+            parsed = parse_stylesheet(result.css, noignore=noignore, images=result.images, image_sizes=image_sizes)
+    return (result, parsed, probed)
+
+# The validators to send when fetching a subreddit.
+def validators(subreddit):
+    if subreddit.fetch is None:
+        return (None, None)
+    return (subreddit.fetch.etag, subreddit.fetch.last_modified)
+
+# Stores the validators from a fetch, and ingests the stylesheet if it's new.
+# Probed image sizes are recorded either way, since an unchanged stylesheet
+# would otherwise have them probed again on every poll until dlimages gets to
+# them. Doesn't commit. Returns the new Update, or None if nothing changed.
+def apply_fetch(s, subreddit, result, parsed, probed=None, now=None):
+    if now is None:
+        now = arrow.utcnow()
+
+    state = subreddit.fetch
+    if state is None:
+        state = bpm.database.StylesheetFetch(subreddit_name=subreddit.subreddit_name)
+        s.add(state)
+    state.etag = result.etag
+    state.last_modified = result.last_modified
+    state.checked = now
+
+    # Reddit doesn't always send validators, so a full response may still be
+    # what we already have.
+    if result.css is None or is_unchanged(s, subreddit, result.css, result.images):
+        update = None
+    else:
+        emotes, spritesheets = parsed
+        update = ingest(s, subreddit, result.css, result.images, emotes, spritesheets, now=now)
+        # ingest() expires everything.
+        subreddit.fetch.changed = now
+
+    if probed:
+        record_image_sizes(s, probed)
+    return update
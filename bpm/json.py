@@ -42,6 +42,7 @@ level of items and no more.
 import json
 from json import load, loads # For convenience
 import sys
+import types
 
 # Code taken from json module and modified.
 def _encode(obj, indent, split_lists, max_depth, sort_keys):
@@ -136,6 +137,27 @@ def _encode(obj, indent, split_lists, max_depth, sort_keys):
 
     return _encode_obj(obj, 1)
 
+# Streaming variant for output too large to build in memory. Produces a compact
+# JSON object from an iterable of (key, value) pairs; values that are
+# themselves generators of pairs become nested objects, streamed the same way.
+# Anything else is encoded whole.
+def iterencode_pairs(pairs):
+    yield "{"
+    first = True
+    for (key, value) in pairs:
+        if first:
+            first = False
+        else:
+            yield ","
+        yield json.encoder.encode_basestring_ascii(key)
+        yield ":"
+        if isinstance(value, types.GeneratorType):
+            for chunk in iterencode_pairs(value):
+                yield chunk
+        else:
+            yield json.dumps(value, separators=(",", ":"), sort_keys=True)
+    yield "}"
+
 def dump(root, file, indent=None, split_lists=True, max_depth=None, sort_keys=False):
     for chunk in _encode(root, indent, split_lists, max_depth, sort_keys):
         file.write(chunk)
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+################################################################################
+##
+## This file is part of BetterPonymotes.
+## Copyright (c) 2015 Typhos.
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or (at your
+## option) any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+################################################################################
+
+import hashlib
+import random
+import threading
+import time
+import urllib.parse
+
+import arrow
+import requests
+
+import bpm.ingest
+from bpm.database import Subreddit
+
+# Load testing for the web API: a synthetic but deterministic data set, and a
+# closed-loop driver that hits a weighted mix of routes from a number of
+# threads and reports latency percentiles.
+#
+# The same seed gives the same data and the same request sequence (per
+# thread), so runs before and after a change are comparable. Point it at a URL
+# to test a real server (bpm.webapi under gunicorn, bpm.asgi under uvicorn),
+# or run it in-process against the Flask app.
+
+### Synthetic data
+
+SUBREDDIT_PREFIX = "loadtest"
+EMOTES_PER_SPRITESHEET = 50
+EMOTE_SIZE = 70
+# Fraction of emotes touched by each update (split between added, removed and
+# moved on the spritesheet)
+CHURN = 0.05
+
+START_TIME = arrow.get("2015-01-01T00:00:00+00:00")
+
+# Writes subreddits * updates * emotes worth of history. Each update is a
+# generated stylesheet, parsed and ingested exactly as a downloaded one would
+# be, so everything derived from it (parts hashes, change log, materialized
+# JSON, search index) is the real thing. Commits once per subreddit.
+def populate(s, subreddits, updates, emotes, seed=0):
+    rng = random.Random(seed)
+    for i in range(subreddits):
+        name = "%s%03d" % (SUBREDDIT_PREFIX, i)
+        sr = Subreddit(subreddit_name=name, added=START_TIME)
+        s.add(sr)
+        s.flush()
+
+        names = ["/%s%s" % (_word(rng), n) for n in range(emotes)]
+        next_name = emotes
+        for seq in range(updates):
+            if seq > 0:
+                churn = max(1, int(len(names) * CHURN / 3))
+                for _ in range(churn):
+                    if names:
+                        names.remove(rng.choice(names))
+                    names.append("/%s%s" % (_word(rng), next_name))
+                    next_name += 1
+                # Shuffling moves emotes around the spritesheets.
+                for _ in range(churn):
+                    a, b = rng.randrange(len(names)), rng.randrange(len(names))
+                    names[a], names[b] = names[b], names[a]
+
+            css, images = _stylesheet(name, seq, names)
+            parsed_emotes, spritesheets = bpm.ingest.parse_stylesheet(css, images=images)
+            created = START_TIME.shift(days=seq, seconds=i)
+            bpm.ingest.ingest(s, sr, css, images, parsed_emotes, spritesheets, now=created)
+
+        s.commit()
+
+def _word(rng):
+    return "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(3, 8)))
+
+# Returns (css, images) for one update: every emote on a grid of 50 per
+# spritesheet, with a new URL for each sheet every update.
+def _stylesheet(subreddit_name, seq, names):
+    sheets = ["sheet%s" % (n // EMOTES_PER_SPRITESHEET) for n in range(0, len(names), EMOTES_PER_SPRITESHEET)]
+    images = {sheet: "https://a.thumbs.redditmedia.com/%s.png" % (hashlib.sha1(("%s %s %s" % (subreddit_name, seq, sheet)).encode("ascii")).hexdigest()[:20]) for sheet in sheets}
+
+    rules = []
+    for (n, name) in enumerate(names):
+        sheet = sheets[n // EMOTES_PER_SPRITESHEET]
+        x = -(n % 10) * EMOTE_SIZE
+        y = -((n % EMOTES_PER_SPRITESHEET) // 10) * EMOTE_SIZE
+        rules.append("a[href|='%s']{display:block;float:left;background-image:url(%%%%%s%%%%);background-position:%spx %spx;width:%spx;height:%spx}" % (name, sheet, x, y, EMOTE_SIZE, EMOTE_SIZE))
+    return ("\n".join(rules), images)
+
+### Clients
+
+# Each worker thread gets its own client. get() returns (status, body size).
+
+class AppClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get_json(self, path):
+        response = self.client.get(path)
+        try:
+            return response.get_json()
+        finally:
+            response.close()
+
+    def get(self, path, headers):
+        response = self.client.get(path, headers=headers)
+        try:
+            return (response.status_code, len(response.get_data()))
+        finally:
+            response.close()
+
+class HTTPClient:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+
+    def get_json(self, path):
+        response = self.session.get(self.base_url + path)
+        response.raise_for_status()
+        return response.json()
+
+    def get(self, path, headers):
+        # Don't let requests decompress; we want what went over the wire.
+        response = self.session.get(self.base_url + path, headers=headers, stream=True)
+        try:
+            size = sum(len(chunk) for chunk in response.raw.stream(65536, decode_content=False))
+            return (response.status_code, size)
+        finally:
+            response.close()
+
+### Route mix
+
+# Things to make requests about, discovered through the API itself so that
+# remote servers can be tested without database access.
+class Targets:
+    def __init__(self, subreddits, emote_names):
+        self.subreddits = subreddits # [(name, latest update_seq, latest stylesheet_seq)]
+        self.emote_names = emote_names
+
+def discover(client, max_subreddits=20):
+    subreddits = []
+    for data in client.get_json("/subreddits").values():
+        update = data["latest_update"]
+        if update is not None:
+            subreddits.append((data["subreddit_name"], update["update_seq"], update["stylesheet"]["stylesheet_seq"]))
+    if not subreddits:
+        raise Exception("No subreddits with updates to test against")
+
+    emote_names = set()
+    for (name, update_seq, stylesheet_seq) in subreddits[:max_subreddits]:
+        stylesheet = client.get_json("/r/%s/stylesheets/%s" % (name, stylesheet_seq))
+        emote_names.update(stylesheet["emotes"])
+
+    return Targets(subreddits, sorted(emote_names))
+
+def _subreddit(rng, t):
+    return rng.choice(t.subreddits)
+
+def _update_seq(rng, t):
+    (name, latest, _) = _subreddit(rng, t)
+    # Recent history is more popular than old history.
+    return (name, max(0, latest - int(rng.expovariate(0.5))))
+
+def _stylesheet_seq(rng, t):
+    (name, _, latest) = _subreddit(rng, t)
+    return (name, max(0, latest - int(rng.expovariate(0.5))))
+
+def _quote(name):
+    return urllib.parse.quote(name, safe="")
+
+def _search_path(rng, t):
+    name = rng.choice(t.emote_names).lstrip("/")
+    length = rng.randint(1, len(name))
+    return "/emotes/search?q=" + _quote(name[:length])
+
+def _diff_path(rng, t):
+    (name, seq) = _update_seq(rng, t)
+    return "/r/%s/updates/%s/diff/%s" % (name, max(0, seq - 1), seq)
+
+def _batch_path(rng, t):
+    names = rng.sample(t.subreddits, min(len(t.subreddits), 5))
+    return "/batch/subreddits?" + "&".join("name=" + _quote(n[0]) for n in names)
+
+# (route name, weight, path(rng, targets))
+DEFAULT_MIX = [
+    ("subreddits", 5, lambda rng, t: "/subreddits"),
+    ("subreddit", 20, lambda rng, t: "/r/%s" % (_subreddit(rng, t)[0])),
+    ("updates", 10, lambda rng, t: "/r/%s/updates" % (_subreddit(rng, t)[0])),
+    ("update", 10, lambda rng, t: "/r/%s/updates/%s" % _update_seq(rng, t)),
+    ("stylesheet", 15, lambda rng, t: "/r/%s/stylesheets/%s" % _stylesheet_seq(rng, t)),
+    ("stylesheet_css", 10, lambda rng, t: "/r/%s/stylesheets/%s/css" % _stylesheet_seq(rng, t)),
+    ("diff", 5, _diff_path),
+    ("changes", 5, lambda rng, t: "/changes"),
+    ("subreddit_changes", 5, lambda rng, t: "/r/%s/changes" % (_subreddit(rng, t)[0])),
+    ("search", 10, _search_path),
+    ("batch", 5, _batch_path),
+    ]
+
+### Driver
+
+class Results:
+    def __init__(self):
+        self.samples = [] # (route, seconds, status, bytes)
+        self.elapsed = 0.0
+
+    def routes(self):
+        return sorted(set(sample[0] for sample in self.samples))
+
+    # Returns a dict of summary statistics for one route, or all of them.
+    def summary(self, route=None):
+        samples = [sample for sample in self.samples if route is None or sample[0] == route]
+        latencies = sorted(sample[1] for sample in samples)
+        errors = sum(1 for sample in samples if sample[2] >= 400)
+        return {
+            "requests": len(samples),
+            "errors": errors,
+            "rps": len(samples) / self.elapsed if self.elapsed else 0.0,
+            "bytes": sum(sample[3] for sample in samples),
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99)
+            }
+
+    def report(self):
+        lines = []
+        lines.append("%-20s %9s %7s %9s %9s %9s %9s" % ("route", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms"))
+        for route in self.routes() + [None]:
+            data = self.summary(route)
+            lines.append("%-20s %9d %7d %9.1f %9.2f %9.2f %9.2f" % (
+                route or "TOTAL", data["requests"], data["errors"], data["rps"],
+                data["p50"] * 1000, data["p95"] * 1000, data["p99"] * 1000))
+        return "\n".join(lines)
+
+# Nearest-rank percentile of a sorted list.
+def percentile(values, p):
+    if not values:
+        return 0.0
+    rank = max(1, int(-(-p * len(values) // 100)))
+    return values[rank - 1]
+
+# Runs concurrency workers, each making requests back-to-back, until either
+# the duration (seconds) is up or the total number of requests has been made.
+# Requests finishing during the first warmup seconds aren't counted.
+def run(make_client, targets, concurrency, duration=None, total=None, mix=DEFAULT_MIX, seed=0, warmup=0, headers=None):
+    if duration is None and total is None:
+        raise ValueError("Need a duration or a request count")
+    headers = dict(headers or {})
+
+    routes = [(name, path) for (name, weight, path) in mix]
+    weights = [weight for (name, weight, path) in mix]
+
+    lock = threading.Lock()
+    remaining = total
+    results = Results()
+    start = time.monotonic()
+    measure_from = start + warmup
+    deadline = measure_from + duration if duration is not None else None
+
+    def take():
+        nonlocal remaining
+        if remaining is None:
+            return True
+        with lock:
+            if remaining <= 0:
+                return False
+            remaining -= 1
+            return True
+
+    def worker(index):
+        rng = random.Random("%s-%s" % (seed, index))
+        client = make_client()
+        samples = []
+        while deadline is None or time.monotonic() < deadline:
+            if not take():
+                break
+            ((name, path),) = rng.choices(routes, weights)
+            before = time.monotonic()
+            try:
+                status, size = client.get(path(rng, targets), headers)
+            except Exception:
+                status, size = 599, 0
+            after = time.monotonic()
+            if after >= measure_from:
+                samples.append((name, after - before, status, size))
+        with lock:
+            results.samples.extend(samples)
+
+    threads = [threading.Thread(target=worker, args=(i,), name="loadtest-%s" % (i), daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    results.elapsed = max(0.0, time.monotonic() - measure_from)
+    return results
@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+################################################################################
+##
+## This file is part of BetterPonymotes.
+## Copyright (c) 2015 Typhos.
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or (at your
+## option) any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+################################################################################
+
+import bisect
+import contextlib
+import contextvars
+import json
+import os
+import tempfile
+import threading
+import time
+import weakref
+
+import flask
+import sqlalchemy.event
+
+# Request and database metrics, rendered in the Prometheus text exposition
+# format.
+#
+# Metrics are collected per process. Under a pre-forking server, whichever
+# worker happens to take a scrape would only report its own numbers, so the
+# registry can be given a directory shared by every worker: each one writes its
+# samples to a file there every so often, and a scrape combines the files.
+# Counters and histograms are summed over every worker there has been (so they
+# don't go backwards when one exits); gauges are reported for each live worker,
+# labelled by pid, unless they describe something the workers share.
+
+# Seconds
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+# Bytes
+SIZE_BUCKETS = [256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216]
+# Queries
+COUNT_BUCKETS = [0, 1, 2, 3, 5, 10, 20, 50, 100]
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self._values = {} # labels -> value
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, labels, value) for (labels, value) in sorted(self._values.items())]
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._values = {} # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value, labels=()):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            if i < len(self.buckets):
+                counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts)) for (labels, counts) in sorted(self._values.items())]
+
+        samples = []
+        for (labels, counts) in values:
+            cumulative = 0
+            for (bound, count) in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((self.name + "_bucket", labels + (("le", _format_value(bound)),), cumulative))
+            samples.append((self.name + "_bucket", labels + (("le", "+Inf"),), counts[-1]))
+            samples.append((self.name + "_sum", labels, counts[-2]))
+            samples.append((self.name + "_count", labels, counts[-1]))
+        return samples
+
+# Metrics computed at scrape time, from a function returning
+# [(labels, value), ...].
+#
+# shared (a bool, or a function returning one) means every process would report
+# the same thing, in which case only the scraping process's value is used.
+class Gauge:
+    type = "gauge"
+
+    def __init__(self, name, help, collect, type="gauge", shared=False):
+        self.name = name
+        self.help = help
+        self.type = type
+        self._collect = collect
+        self._shared = shared
+
+    def samples(self):
+        return [(self.name, labels, value) for (labels, value) in self._collect()]
+
+    def shared(self):
+        return self._shared() if callable(self._shared) else self._shared
+
+# Seconds between writes of a process's samples, in multiprocess mode
+FLUSH_INTERVAL = 1.0
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.directory = None
+        self._flusher_pid = None
+        self._flusher_lock = threading.Lock()
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self.add(Counter(name, help))
+
+    def histogram(self, name, help, buckets):
+        return self.add(Histogram(name, help, buckets))
+
+    def gauge(self, name, help, collect, type="gauge", shared=False):
+        return self.add(Gauge(name, help, collect, type=type, shared=shared))
+
+    # Shares metrics between processes through files in a directory. Call this
+    # before forking, and files left by a previous run are removed; processes
+    # started some other way should join with clear=False.
+    def set_directory(self, path, clear=True):
+        os.makedirs(path, exist_ok=True)
+        if clear:
+            for entry in os.scandir(path):
+                if entry.name.endswith(".json"):
+                    _unlink(entry.path)
+        self.directory = path
+
+    # Starts writing this process's samples in the background, if there's a
+    # directory and it isn't already. Cheap enough to call on every request.
+    def start_flushing(self):
+        pid = os.getpid()
+        if self.directory is None or self._flusher_pid == pid:
+            return
+        with self._flusher_lock:
+            if self._flusher_pid == pid:
+                return
+            self._flusher_pid = pid
+            threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+    # Writes this process's samples to its file.
+    def flush(self):
+        if self.directory is None:
+            return
+        pid = os.getpid()
+        data = {
+            "pid": pid,
+            "metrics": {metric.name: [[name, [list(label) for label in labels], value] for (name, labels, value) in samples]
+                for (metric, samples) in self.collect()}
+            }
+        fd, temp_filename = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w") as file:
+                json.dump(data, file)
+            os.replace(temp_filename, os.path.join(self.directory, "%s.json" % (pid)))
+        except BaseException:
+            _unlink(temp_filename)
+            raise
+
+    # Returns [(metric, samples), ...] for this process.
+    def collect(self):
+        return [(metric, metric.samples()) for metric in self.metrics]
+
+    # Returns [(metric, samples), ...] for every process sharing the
+    # directory, or just this one if there isn't one.
+    def combined(self):
+        if self.directory is None:
+            return self.collect()
+
+        self.flush()
+        processes = []
+        for entry in sorted(os.scandir(self.directory), key=lambda entry: entry.name):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                with open(entry.path) as file:
+                    data = json.load(file)
+            except (OSError, ValueError):
+                continue
+            processes.append((data["pid"], _alive(data["pid"]), data["metrics"]))
+
+        results = []
+        for metric in self.metrics:
+            if metric.type == "gauge":
+                if metric.shared():
+                    samples = metric.samples()
+                else:
+                    samples = []
+                    for (pid, alive, metrics) in processes:
+                        if alive:
+                            for (name, labels, value) in metrics.get(metric.name, ()):
+                                samples.append((name, _labels(labels) + (("pid", str(pid)),), value))
+            else:
+                # Insertion order keeps each label set's buckets together and
+                # in order.
+                totals = {}
+                for (pid, alive, metrics) in processes:
+                    for (name, labels, value) in metrics.get(metric.name, ()):
+                        key = (name, _labels(labels))
+                        totals[key] = totals.get(key, 0) + value
+                samples = [(name, labels, value) for ((name, labels), value) in totals.items()]
+            results.append((metric, samples))
+        return results
+
+    def render(self):
+        lines = []
+        for (metric, samples) in self.combined():
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+            for (name, labels, value) in samples:
+                if labels:
+                    label_text = ",".join("%s=\"%s\"" % (k, _escape(v)) for (k, v) in labels)
+                    lines.append("%s{%s} %s" % (name, label_text, _format_value(value)))
+                else:
+                    lines.append("%s %s" % (name, _format_value(value)))
+        lines.append("")
+        return "\n".join(lines)
+
+def _labels(labels):
+    return tuple((k, v) for (k, v) in labels)
+
+def _alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _unlink(filename):
+    try:
+        os.unlink(filename)
+    except OSError:
+        pass
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+registry = Registry()
+
+request_seconds = registry.histogram("bpm_http_request_duration_seconds",
+    "Time from request start until the response body has been sent.", LATENCY_BUCKETS)
+response_bytes = registry.histogram("bpm_http_response_size_bytes",
+    "Response body size, after compression.", SIZE_BUCKETS)
+responses = registry.counter("bpm_http_responses_total",
+    "Responses sent, by route and status code.")
+request_queries = registry.histogram("bpm_http_request_queries",
+    "SQL statements executed per request.", COUNT_BUCKETS)
+db_queries = registry.counter("bpm_db_queries_total",
+    "SQL statements executed, by route.")
+db_query_seconds = registry.counter("bpm_db_query_seconds_total",
+    "Time spent executing SQL statements, by route.")
+db_checkout_seconds = registry.histogram("bpm_db_pool_checkout_seconds",
+    "Time requests spent waiting for a database connection.", LATENCY_BUCKETS)
+db_checkouts = registry.counter("bpm_db_pool_checkouts_total",
+    "Connections checked out of the pool.")
+db_connects = registry.counter("bpm_db_pool_connects_total",
+    "New database connections opened by the pool.")
+
+# Statements run outside of a request (background threads, startup)
+NO_ROUTE = "(none)"
+# Requests that didn't match any route
+UNMATCHED_ROUTE = "(unmatched)"
+
+### Flask
+
+# Per-request state lives in flask.g, which stream_with_context() keeps around
+# while streamed bodies are generated. Everything is recorded when the response
+# is closed, so streamed responses are measured in full.
+
+def instrument_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+
+def _before_request():
+    registry.start_flushing()
+    flask.g.bpm_metrics = _RequestMetrics()
+
+def _after_request(response):
+    state = flask.g.get("bpm_metrics")
+    if state is None:
+        return response
+
+    rule = flask.request.url_rule
+    state.route = rule.rule if rule is not None else UNMATCHED_ROUTE
+    state.status = response.status_code
+
+    if response.is_streamed:
+        response.response = _count_bytes(response.response, state)
+    else:
+        state.bytes = response.content_length or 0
+
+    response.call_on_close(state.finish)
+    return response
+
+def _count_bytes(chunks, state):
+    for chunk in chunks:
+        state.bytes += len(chunk)
+        yield chunk
+
+class _RequestMetrics:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.route = UNMATCHED_ROUTE
+        self.status = None
+        self.bytes = 0
+        self.queries = 0
+        self.query_seconds = 0.0
+
+    def finish(self):
+        labels = (("route", self.route),)
+        request_seconds.observe(time.perf_counter() - self.start, labels)
+        response_bytes.observe(self.bytes, labels)
+        responses.inc(labels + (("status", str(self.status)),))
+        request_queries.observe(self.queries, labels)
+
+def _current_request():
+    if flask.has_app_context():
+        return flask.g.get("bpm_metrics")
+    return _asgi_request.get()
+
+### ASGI
+
+# The same measurements for bpm.asgi, where there's no flask.g. The state
+# lives in a context variable, which SQLAlchemy's async sessions carry through
+# to the statements they run.
+
+_asgi_request = contextvars.ContextVar("bpm_metrics_request", default=None)
+
+# Starts measuring a request. Set the route (once matched), status and bytes on
+# the result, and call finish() once the response has been sent.
+def start_request():
+    registry.start_flushing()
+    state = _RequestMetrics()
+    _asgi_request.set(state)
+    return state
+
+### SQLAlchemy
+
+_engines = weakref.WeakSet()
+_engines_lock = threading.Lock()
+
+# Starts collecting statement and pool metrics for an engine. Safe to call
+# repeatedly. Pool events registered on an engine carry over to the pool
+# Engine.dispose() replaces it with.
+def instrument_engine(engine):
+    with _engines_lock:
+        if engine not in _engines:
+            sqlalchemy.event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+            sqlalchemy.event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+            sqlalchemy.event.listen(engine, "connect", _pool_connect)
+            sqlalchemy.event.listen(engine, "checkout", _pool_checkout)
+            _engines.add(engine)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("bpm_query_start", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["bpm_query_start"].pop()
+    state = _current_request()
+    if state is not None:
+        state.queries += 1
+        state.query_seconds += elapsed
+        if flask.has_request_context():
+            route = flask.request.url_rule.rule if flask.request.url_rule is not None else UNMATCHED_ROUTE
+        else:
+            route = state.route
+    else:
+        route = NO_ROUTE
+    labels = (("route", route),)
+    db_queries.inc(labels)
+    db_query_seconds.inc(labels, elapsed)
+
+def _pool_connect(dbapi_connection, connection_record):
+    db_connects.inc()
+
+def _pool_checkout(dbapi_connection, connection_record, connection_proxy):
+    db_checkouts.inc()
+
+# Pools have no event for "started waiting", so time getting a connection
+# where a request asks for one instead:
+#
+#     with bpm.metrics.checkout_timer():
+#         s.connection()
+@contextlib.contextmanager
+def checkout_timer():
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        db_checkout_seconds.observe(time.perf_counter() - start)
+
+def _pool_connections():
+    with _engines_lock:
+        engines = list(_engines)
+    samples = []
+    for engine in engines:
+        pool = engine.pool
+        if hasattr(pool, "checkedout"):
+            labels = (("database", engine.url.database or ""),)
+            samples.append((labels + (("state", "checked_out"),), pool.checkedout()))
+            samples.append((labels + (("state", "idle"),), pool.checkedin()))
+    return samples
+
+registry.gauge("bpm_db_pool_connections",
+    "Pooled database connections, by state.", _pool_connections)
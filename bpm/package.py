@@ -20,8 +20,10 @@
 ################################################################################
 
 import arrow
+import sqlalchemy.orm
 
 import bpm.images
+import bpm.serialize
 
 FILE_MAGIC = "rainbow dash is best pony"
 FILE_SCHEMA_VERSION = 1
@@ -86,14 +88,34 @@ def pkg_subreddit(package_config, filters, sr):
                 images[part.sprite_image_url] = None
         emotes[emote.name] = emote_data
 
+    image_info = {}
+
     for image in ss.images:
         pname = "%%" + image.name + "%%"
         if pname in images:
             # Map images to proper download URL's. This rewrites to HTTPS and
             # also evades Cloudflare, just in case.
             images[pname] = bpm.images.image_download_url(image.url)
+            # Lets clients size placeholders before the image has loaded.
+            if image.width is not None:
+                image_info[pname] = {
+                    "format": image.format,
+                    "width": image.width,
+                    "height": image.height,
+                    "frame_count": image.frame_count,
+                    "size": image.size
+                }
+
+    data = {"emotes": emotes, "images": images, "image_info": image_info}
 
-    data = {"emotes": emotes, "images": images}
+    # Tiles (see bpm.tiles), if the package says where they're hosted.
+    tile_base_url = package_config.get("TileBaseURL")
+    if tile_base_url:
+        def tile_url(filename):
+            return tile_base_url.rstrip("/") + "/" + filename
+        s = sqlalchemy.orm.object_session(ss)
+        tiles = bpm.serialize.serialize_stylesheet_tiles(s, ss, tile_url)["tiles"]
+        data["tiles"] = {name: t for (name, t) in tiles.items() if name in emotes}
     return data
 
 def pkg_emotes(package_config, subreddit_data):
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+################################################################################
+##
+## This file is part of BetterPonymotes.
+## Copyright (c) 2015 Typhos.
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or (at your
+## option) any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+################################################################################
+
+import concurrent.futures
+import email.utils
+import random
+import threading
+import time
+import urllib.parse
+
+import logbook
+import requests
+
+log = logbook.Logger(__name__)
+
+# Rate limiting for outgoing HTTP requests: a token bucket per host, shared by
+# any number of threads, plus retries that back off the whole host when it
+# says it's overloaded (429 or 5xx, honoring Retry-After).
+#
+# Requests are spaced by when they start, not when the previous one finished,
+# so with enough concurrent workers the limit itself is the only bottleneck.
+
+class TokenBucket:
+    def __init__(self, rate, burst=1):
+        self.rate = rate # Tokens per second, or None for no limit
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._pauses = 0
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    # Blocks until a request may be made. Tokens are reserved up front (the
+    # count can go negative), so waiters are served in order without polling.
+    # Returns the time spent waiting.
+    def acquire(self):
+        if self.rate is None:
+            return 0.0
+        start = time.monotonic()
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                self._tokens -= 1
+                wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+                pauses = self._pauses
+            if wait > 0:
+                time.sleep(wait)
+            # If we were told to back off while waiting, our reservation is
+            # void; get back in line behind the pause.
+            with self._lock:
+                if self._pauses == pauses:
+                    return time.monotonic() - start
+
+    # Holds off everyone for the given number of seconds.
+    def pause(self, seconds):
+        if self.rate is None:
+            return
+        with self._lock:
+            self._refill(time.monotonic())
+            # The next token is due once the pause is over.
+            self._tokens = min(self._tokens, 1 - seconds * self.rate)
+            self._pauses += 1
+
+class RateLimiter:
+    def __init__(self, rate, burst=1, host_rates=None):
+        self.rate = rate
+        self.burst = burst
+        self.host_rates = host_rates or {} # host -> rate
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def bucket(self, url):
+        host = urllib.parse.urlparse(url).netloc.lower()
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = TokenBucket(self.host_rates.get(host, self.rate), self.burst)
+                self._buckets[host] = bucket
+            return bucket
+
+    def acquire(self, url):
+        return self.bucket(url).acquire()
+
+    def pause(self, url, seconds):
+        self.bucket(url).pause(seconds)
+
+MAX_RETRIES = 4
+BACKOFF_BASE = 2.0 # Seconds, doubled on each retry
+BACKOFF_MAX = 120.0
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# Parses Retry-After (either seconds or an HTTP date) into seconds from now.
+def retry_after(response):
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+def backoff_delay(attempt):
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt))
+    return delay * random.uniform(0.5, 1.0)
+
+# Makes a rate limited request, retrying on overload and connection errors.
+# Returns the final response, whatever its status.
+def request(limiter, method, url, session=None, max_retries=MAX_RETRIES, **kwargs):
+    if session is None:
+        session = requests
+    attempt = 0
+    while True:
+        limiter.acquire(url)
+        try:
+            r = session.request(method, url, **kwargs)
+        except requests.ConnectionError:
+            if attempt >= max_retries:
+                raise
+            delay = backoff_delay(attempt)
+            log.warning("Connection error for {}, retrying in {:.1f}s", url, delay)
+        else:
+            if r.status_code not in RETRY_STATUS or attempt >= max_retries:
+                return r
+            delay = retry_after(r)
+            if delay is None:
+                delay = backoff_delay(attempt)
+            delay = min(delay, BACKOFF_MAX)
+            log.warning("Got {} for {}, backing off for {:.1f}s", r.status_code, url, delay)
+            r.close()
+
+        limiter.pause(url, delay)
+        attempt += 1
+
+def get(limiter, url, **kwargs):
+    return request(limiter, "GET", url, **kwargs)
+
+# Runs func(item) for each item on a bounded pool of threads, yielding
+# (item, result, exception) as each finishes. With func doing rate limited
+# requests, this keeps a host busy right up to its limit.
+def run_all(func, items, workers):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(func, item): item for item in items}
+        for future in concurrent.futures.as_completed(futures):
+            item = futures[future]
+            try:
+                yield (item, future.result(), None)
+            except Exception as e:
+                yield (item, None, e)
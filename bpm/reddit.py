@@ -19,43 +19,56 @@
 ##
 ################################################################################
 
-import datetime
-import html.parser
-import time
+import collections
+import html
 import urllib
 
 import logbook
-
 import requests
+import requests.adapters
+
+import bpm.ratelimit
+import bpm.transport
 
 log = logbook.Logger(__name__)
 
 USER_AGENT = "BetterPonymotes Backend Services (/u/Typhos)"
 REDDIT = "https://www.reddit.com"
 
-REQUEST_DELAY = datetime.timedelta(seconds=2)
+# Seconds between requests to any one host
+REQUEST_DELAY = 2.0
+
+# Seconds, per socket operation. A stalled connection would otherwise hold up
+# fetch and the scheduler indefinitely.
+TIMEOUT = 60
+
+# Shared by every thread in the process.
+limiter = bpm.ratelimit.RateLimiter(1 / REQUEST_DELAY)
+
+# Connections are kept alive between requests. Sized for a handful of
+# concurrent downloads per host.
+POOL_SIZE = 10
 
-_last_request = None
+def _make_session():
+    session = requests.Session()
+    session.headers["User-Agent"] = USER_AGENT
+    adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
-def check_request_timer():
-    if _last_request is not None:
-        now = datetime.datetime.utcnow()
-        dt = now - _last_request
-        if dt < REQUEST_DELAY:
-            time.sleep((REQUEST_DELAY - dt).seconds)
+session = _make_session()
 
-def reset_request_timer():
-    global _last_request
-    _last_request = datetime.datetime.utcnow()
+# Sets up recording or replay (see bpm.transport). There's no need to be
+# polite to an archive, so replaying turns off rate limiting.
+def init_transport_from_args(args):
+    global limiter
+    if bpm.transport.init_from_args(args, session):
+        limiter = bpm.ratelimit.RateLimiter(None)
 
-def download(url):
-    check_request_timer()
-    try:
-        log.debug("Downloading {}", url)
-        r = requests.get(url, headers={"User-Agent": USER_AGENT})
-    finally:
-        reset_request_timer()
-    return r
+def download(url, headers=None, stream=False):
+    log.debug("Downloading {}", url)
+    return bpm.ratelimit.get(limiter, url, session=session, headers=headers, stream=stream, timeout=TIMEOUT)
 
 def check_search_redirect(r):
     # Check for redirects
@@ -64,25 +77,49 @@ def check_search_redirect(r):
         raise ValueError("Subreddit redirected to search (invalid name?)")
 
 def download_raw_stylesheet(subreddit):
+    return fetch_raw_stylesheet(subreddit).data
+
+def download_stylesheet(subreddit):
+    fetch = fetch_stylesheet(subreddit)
+    return (fetch.css, fetch.images)
+
+# data is None if the stylesheet wasn't modified. The validators are whatever
+# came with the response (to be sent back next time), or None.
+RawFetch = collections.namedtuple("RawFetch", ["data", "etag", "last_modified"])
+Fetch = collections.namedtuple("Fetch", ["css", "images", "etag", "last_modified"])
+
+# Downloads a stylesheet, unless it hasn't changed since the download that gave
+# us the validators.
+def fetch_raw_stylesheet(subreddit, etag=None, last_modified=None):
     url = "%s/r/%s/about/stylesheet.json" % (REDDIT, subreddit)
-    r = download(url)
+    headers = {}
+    if etag is not None:
+        headers["If-None-Match"] = etag
+    if last_modified is not None:
+        headers["If-Modified-Since"] = last_modified
+
+    r = download(url, headers=headers)
+    if r.status_code == 304:
+        return RawFetch(None, r.headers.get("ETag", etag), r.headers.get("Last-Modified", last_modified))
     r.raise_for_status()
     check_search_redirect(r)
     data = r.json()
     assert data["kind"] == "stylesheet"
-    return data
+    return RawFetch(data, r.headers.get("ETag"), r.headers.get("Last-Modified"))
 
-def download_stylesheet(subreddit):
-    data = download_raw_stylesheet(subreddit)
+def fetch_stylesheet(subreddit, etag=None, last_modified=None):
+    raw = fetch_raw_stylesheet(subreddit, etag=etag, last_modified=last_modified)
+    if raw.data is None:
+        return Fetch(None, None, raw.etag, raw.last_modified)
 
-    css = data["data"]["stylesheet"]
+    css = raw.data["data"]["stylesheet"]
 
     # FIXME: reddit does something weird and encodes this as if it were HTML.
     # So selectors like "foo > bar" will get munged into "foo &gt; bar". Since
     # I can't find any way around this we'll just fix it ourselves.
-    css = html.parser.unescape(css)
+    css = html.unescape(css)
 
     # Reformat images list. We don't need the "link": "url(%%image%%)" part.
-    images = {img["name"]: img["url"] for img in data["data"]["images"]}
+    images = {img["name"]: img["url"] for img in raw.data["data"]["images"]}
 
-    return (css, images)
+    return Fetch(css, images, raw.etag, raw.last_modified)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+################################################################################
+##
+## This file is part of BetterPonymotes.
+## Copyright (c) 2015 Typhos.
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or (at your
+## option) any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+################################################################################
+
+import random
+import statistics
+import time
+
+import arrow
+import logbook
+
+import bpm.ingest
+import bpm.ratelimit
+from bpm.database import Subreddit, Update, PollSchedule
+
+log = logbook.Logger(__name__)
+
+# Decides when to download each subreddit's stylesheet again.
+#
+# The interval comes from how often the subreddit has actually changed: the
+# median gap between its recent updates, polled a few times per gap so changes
+# are picked up reasonably soon. Each poll that finds nothing new stretches
+# the interval, so quiet subreddits fade into the background; a change resets
+# it from the history. Polls are taken oldest-due first within a global
+# budget, so if there's more work than budget everything slows down evenly.
+#
+# All of this lives in the poll_schedules table, so restarting loses nothing.
+
+MIN_INTERVAL = 15 * 60
+MAX_INTERVAL = 7 * 24 * 60 * 60
+DEFAULT_INTERVAL = 24 * 60 * 60 # With no history to go on
+
+HISTORY = 10 # Updates to look back over
+POLLS_PER_CHANGE = 4
+BACKOFF = 1.5 # Interval multiplier after finding nothing new
+JITTER = 0.1 # Randomize intervals by up to this fraction, to spread polls out
+
+# Failed polls are retried sooner than the normal interval, backing off.
+RETRY_INTERVAL = 5 * 60
+
+DEFAULT_BUDGET = 600 # Requests per hour
+MAX_SLEEP = 60
+
+def _clamp(interval):
+    return int(max(MIN_INTERVAL, min(MAX_INTERVAL, interval)))
+
+# Polling interval (seconds) suggested by a subreddit's update history.
+def estimate_interval(s, subreddit_name):
+    q = s.query(Update.created).filter_by(subreddit_name=subreddit_name)
+    times = [created for (created,) in q.order_by(Update.update_seq.desc()).limit(HISTORY)]
+    if len(times) < 2:
+        return DEFAULT_INTERVAL
+    gaps = [(newer - older).total_seconds() for (newer, older) in zip(times, times[1:])]
+    return _clamp(statistics.median(gaps) / POLLS_PER_CHANGE)
+
+def _next_poll(now, interval):
+    return now.shift(seconds=interval * random.uniform(1 - JITTER, 1 + JITTER))
+
+# Adds schedules for any subreddits that don't have one yet, due now. Returns
+# how many were added.
+def add_missing(s, now=None):
+    if now is None:
+        now = arrow.utcnow()
+    q = s.query(Subreddit.subreddit_name).outerjoin(PollSchedule).filter(PollSchedule.subreddit_name == None)
+    names = [name for (name,) in q]
+    for name in names:
+        s.add(PollSchedule(subreddit_name=name, interval=estimate_interval(s, name), next_poll=now, failures=0))
+    return len(names)
+
+def due(s, now, limit):
+    q = s.query(PollSchedule).filter(PollSchedule.next_poll <= now)
+    return q.order_by(PollSchedule.next_poll).limit(limit).all()
+
+def next_due(s):
+    q = s.query(PollSchedule.next_poll).order_by(PollSchedule.next_poll)
+    row = q.first()
+    return row[0] if row is not None else None
+
+# Updates a schedule after a poll.
+def record_poll(s, schedule, changed, failed=False, now=None):
+    if now is None:
+        now = arrow.utcnow()
+    schedule.last_poll = now
+
+    if failed:
+        schedule.failures += 1
+        retry = min(schedule.interval, RETRY_INTERVAL * 2 ** (schedule.failures - 1))
+        schedule.next_poll = _next_poll(now, retry)
+        return
+
+    schedule.failures = 0
+    if changed:
+        schedule.interval = estimate_interval(s, schedule.subreddit_name)
+    else:
+        schedule.interval = _clamp(schedule.interval * BACKOFF)
+    schedule.next_poll = _next_poll(now, schedule.interval)
+
+class Scheduler:
+    def __init__(self, session, budget=DEFAULT_BUDGET, workers=4, noignore=False):
+        self.session = session
+        # Allow a small burst, so a backlog can start moving right away.
+        self.budget = bpm.ratelimit.TokenBucket(budget / 3600, burst=min(workers, 10))
+        self.workers = workers
+        self.noignore = noignore
+        self.image_sizes = {}
+
+    def _fetch(self, request):
+        (name, etag, last_modified) = request
+        self.budget.acquire()
+        return bpm.ingest.fetch(name, etag=etag, last_modified=last_modified,
+            noignore=self.noignore, image_sizes=self.image_sizes)
+
+    # Polls whatever is due (up to limit). Returns the number polled.
+    def run_once(self, limit=100):
+        s = self.session
+        now = arrow.utcnow()
+        added = add_missing(s, now)
+        if added:
+            log.info("Scheduling {} new subreddits", added)
+        schedules = due(s, now, limit)
+        pending = [(schedule.subreddit_name,) + bpm.ingest.validators(schedule.subreddit) for schedule in schedules]
+        if pending:
+            self.image_sizes = bpm.ingest.indexed_image_sizes(s)
+        s.commit()
+
+        for (request, result, error) in bpm.ratelimit.run_all(self._fetch, pending, self.workers):
+            name = request[0]
+            now = arrow.utcnow()
+            schedule = s.query(PollSchedule).get(name)
+            if error is not None:
+                log.error("Error polling /r/{}: {}", name, error)
+                record_poll(s, schedule, changed=False, failed=True, now=now)
+            else:
+                try:
+                    update = bpm.ingest.apply_fetch(s, schedule.subreddit, *result, now=now)
+                except Exception:
+                    log.exception("Error ingesting /r/{}", name)
+                    s.rollback()
+                    schedule = s.query(PollSchedule).get(name)
+                    record_poll(s, schedule, changed=False, failed=True, now=now)
+                else:
+                    if update is not None:
+                        log.info("/r/{}: new update #{}", name, update.update_seq)
+                    schedule = s.query(PollSchedule).get(name)
+                    record_poll(s, schedule, changed=update is not None, now=now)
+                    log.debug("/r/{}: next poll in {}s", name, schedule.interval)
+            s.commit()
+
+        return len(pending)
+
+    def run(self):
+        while True:
+            if self.run_once():
+                continue
+            s = self.session
+            upcoming = next_due(s)
+            s.rollback()
+            if upcoming is None:
+                delay = MAX_SLEEP
+            else:
+                delay = min(MAX_SLEEP, max(1, (upcoming - arrow.utcnow()).total_seconds()))
+            time.sleep(delay)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+################################################################################
+##
+## This file is part of BetterPonymotes.
+## Copyright (c) 2015 Typhos.
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or (at your
+## option) any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+################################################################################
+
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+import uvicorn
+
+import bpm.asgi
+import bpm.database
+import bpm.metrics
+
+def main(argv0, argv):
+    parser = argparse.ArgumentParser(prog=argv0, description="Run async data API")
+    parser.add_argument("--database", help="Database URI")
+    parser.add_argument("--host", default="127.0.0.1", help="Host to bind to")
+    parser.add_argument("--port", type=int, default=8000, help="Port to bind to")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes")
+    parser.add_argument("--pool-size", type=int, default=bpm.asgi.DEFAULT_POOL_SIZE, help="Database connections per worker")
+    parser.add_argument("--metrics-dir", help="Directory for combining workers' metrics (default is a temporary directory)")
+    args = parser.parse_args(argv)
+
+    # Each worker sets itself up from the environment on startup, so that no
+    # connections are shared between processes.
+    if args.database:
+        os.environ["BPM_DATABASE"] = args.database
+    os.environ["BPM_POOL_SIZE"] = str(args.pool_size)
+
+    # Workers are separate processes, each only seeing its own requests;
+    # /metrics and /stats/cache combine them all through this directory.
+    metrics_dir = args.metrics_dir or tempfile.mkdtemp(prefix="bpm-metrics-")
+    bpm.metrics.registry.set_directory(metrics_dir)
+    os.environ["BPM_METRICS_DIR"] = metrics_dir
+
+    try:
+        uvicorn.run("bpm.asgi:app", host=args.host, port=args.port, workers=args.workers, lifespan="on")
+    finally:
+        if not args.metrics_dir:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main(sys.argv[0], sys.argv[1:])
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+################################################################################
+##
+## This file is part of BetterPonymotes.
+## Copyright (c) 2015 Typhos.
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or (at your
+## option) any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+################################################################################
+
+
+import argparse
+import sys
+
+import bpm.database
+import bpm.diff
+from bpm.database import Subreddit
+
+def main(argv0, argv):
+    parser = argparse.ArgumentParser(prog=argv0, description="Rebuild emote change log from update history")
+    bpm.database.add_database_arguments(parser)
+    parser.add_argument("-n", action="store_true", help="Don't commit")
+    parser.add_argument("subreddits", nargs="*", help="Subreddits (default: all)")
+    args = parser.parse_args(argv)
+
+    engine = bpm.database.init_from_args(args)
+    s = bpm.database.Session()
+
+    names = args.subreddits
+    if not names:
+        names = [name for (name,) in s.query(Subreddit.subreddit_name).order_by(Subreddit.subreddit_name)]
+
+    for name in names:
+        if s.query(Subreddit).get(name) is None:
+            print("Error: could not find /r/%s" % (name))
+            sys.exit(1)
+        print("Rebuilding change log for /r/%s" % (name))
+        bpm.diff.rebuild_changes(s, name)
+        # One subreddit per transaction.
+        if not args.n:
+            s.commit()
+        s.expunge_all()
+
+if __name__ == "__main__":
+    main(sys.argv[0], sys.argv[1:])
@@ -20,29 +20,124 @@
 ################################################################################
 
 import argparse
+import hashlib
 import os.path
 import sys
 
 import arrow
 import requests
+import requests.adapters
 
 import bpm.database
 import bpm.images
+import bpm.imagestore
+import bpm.ratelimit
+import bpm.transport
 from bpm.database import Subreddit, Stylesheet, Image
 
-def mark_download(s, image):
-    image.downloaded = arrow.utcnow()
-    s.add(image)
-    s.commit()
+# Per host. The image CDN is a lot more tolerant than reddit itself.
+IMAGE_RATE = 20.0
+TIMEOUT = 60 # Seconds, per socket operation
+CHUNK_SIZE = 64 * 1024
+
+# Failures partway through a body aren't covered by bpm.ratelimit.request(),
+# so the download as a whole is retried on these.
+BODY_ERRORS = (requests.exceptions.ChunkedEncodingError, requests.exceptions.ReadTimeout)
+
+def make_session(workers):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# Streams a URL into the image store, hashing it on the way, and links the
+# URL-derived name to it. The body goes to a temporary file that's only stored
+# once complete, so an interrupted download never leaves a truncated image
+# behind to be mistaken for a finished one. Returns (sha256, size, new), where
+# new is False if the same image had already been stored.
+def download_file(limiter, session, store, url, filename):
+    attempt = 0
+    while True:
+        try:
+            sha256, size, new = _download_file(limiter, session, store, url)
+            break
+        except BODY_ERRORS:
+            if attempt >= bpm.ratelimit.MAX_RETRIES:
+                raise
+            limiter.pause(url, bpm.ratelimit.backoff_delay(attempt))
+            attempt += 1
+    store.link(sha256, filename)
+    return (sha256, size, new)
+
+def _download_file(limiter, session, store, url):
+    with bpm.ratelimit.get(limiter, url, session=session, stream=True, timeout=TIMEOUT) as r:
+        r.raise_for_status()
+        # We never ask for a range, so a partial response would only store a
+        # truncated image.
+        if r.status_code == 206 and "Range" not in r.request.headers:
+            raise requests.exceptions.HTTPError("Unrequested partial response for %s" % (url), response=r)
+        file, temp_path = store.new_file()
+        try:
+            h = hashlib.sha256()
+            size = 0
+            with file:
+                for chunk in r.iter_content(CHUNK_SIZE):
+                    file.write(chunk)
+                    h.update(chunk)
+                    size += len(chunk)
+            sha256 = h.hexdigest()
+            new = store.add(temp_path, sha256)
+        except BaseException:
+            store.discard(temp_path)
+            raise
+    return (sha256, size, new)
+
+# Hashes images downloaded before the store existed, moving their files into
+# it. Rows whose file is missing are left alone. Returns the number of rows
+# updated.
+def backfill_hashes(s, store, batch, commit=True):
+    q = s.query(Image.image_id, Image.filename).filter(Image.downloaded != None, Image.sha256 == None)
+    rows = q.order_by(Image.image_id).all()
+
+    hashes = {} # filename -> sha256, or None if missing
+    count = 0
+    for (image_id, filename) in rows:
+        if filename not in hashes:
+            if os.path.exists(store.link_path(filename)):
+                hashes[filename] = store.adopt(filename)
+            else:
+                print("Warning: %s is marked as downloaded, but doesn't exist" % (filename))
+                hashes[filename] = None
+        if hashes[filename] is None:
+            continue
+
+        s.query(Image).filter_by(image_id=image_id).update({Image.sha256: hashes[filename]}, synchronize_session=False)
+        count += 1
+        if commit and count % batch == 0:
+            s.commit()
+
+    if commit:
+        s.commit()
+    return count
 
 def main(argv0, argv):
     parser = argparse.ArgumentParser(prog=argv0, description="Download pending images")
     bpm.database.add_database_arguments(parser)
     parser.add_argument("-n", action="store_true", help="Don't commit")
-    parser.add_argument("--fix", action="store_true", help="Mark existing files as downloaded")
+    parser.add_argument("--fix", action="store_true", help="Mark existing files as downloaded, and hash images downloaded before the image store")
     parser.add_argument("-l", action="store_true", help="List pending images")
+    parser.add_argument("-j", "--jobs", type=int, default=8, help="Concurrent downloads")
+    parser.add_argument("--rate", type=float, default=IMAGE_RATE, help="Requests per second, per host")
+    parser.add_argument("--batch", type=int, default=100, help="Images to mark as downloaded per commit")
+    bpm.transport.add_transport_arguments(parser)
     args = parser.parse_args(argv)
 
+    session = make_session(args.jobs)
+    limiter = bpm.ratelimit.RateLimiter(args.rate)
+    if bpm.transport.init_from_args(args, session):
+        limiter = bpm.ratelimit.RateLimiter(None)
+
     engine = bpm.database.init_from_args(args)
     s = bpm.database.Session()
 
@@ -52,30 +147,84 @@ def main(argv0, argv):
             print("%s  %-25s %s" % (ss.downloaded.format("YYYY-MM-DD"), sr.subreddit_name, image.url))
         return
 
+    store = bpm.imagestore.ImageStore()
+
+    if args.fix:
+        count = backfill_hashes(s, store, args.batch, commit=not args.n)
+        print("Hashed %s previously downloaded images" % (count))
+
     images = s.query(Image).filter_by(downloaded=None).order_by(Image.image_id).all()
 
+    # Images already downloaded under another stylesheet need no download,
+    # just a link (which is normally already there).
+    urls = {image.url for image in images}
+    known = {}
+    for (url, sha256) in s.query(Image.url, Image.sha256).filter(Image.sha256 != None).distinct():
+        if url in urls:
+            known[url] = sha256
+
+    # The same image is often used by several stylesheets; fetch it once.
+    pending = {} # filename -> [image_id, ...]
+    download_urls = {} # filename -> download URL
+    marked = {} # sha256 -> [image_id, ...]
     for image in images:
-        path = os.path.join("images", image.filename)
+        sha256 = known.get(image.url)
+        if sha256 is not None and store.has(sha256):
+            store.link(sha256, image.filename)
+            marked.setdefault(sha256, []).append(image.image_id)
+            continue
 
-        if os.path.exists(path):
+        if os.path.exists(store.link_path(image.filename)):
             print("Notice: %s already exists. Marking as downloaded." % (image.filename))
-            mark_download(s, image)
+            sha256 = store.adopt(image.filename)
+            known[image.url] = sha256
+            marked.setdefault(sha256, []).append(image.image_id)
             continue
 
         if args.fix:
             continue
 
-        real_url = bpm.images.image_download_url(image.url)
-        print("Downloading", real_url, "->", path)
+        pending.setdefault(image.filename, []).append(image.image_id)
+        if image.filename not in download_urls:
+            download_urls[image.filename] = bpm.images.image_download_url(image.url)
+
+    # Downloads happen on worker threads, which never touch the database.
+    # Finished images are marked here, and committed in batches.
+    def flush():
+        if marked and not args.n:
+            now = arrow.utcnow()
+            for (sha256, ids) in marked.items():
+                s.query(Image).filter(Image.image_id.in_(ids)).update(
+                    {Image.downloaded: now, Image.sha256: sha256}, synchronize_session=False)
+            s.commit()
+        marked.clear()
+
+    def download(filename):
+        return download_file(limiter, session, store, download_urls[filename], filename)
+
+    flush()
+
+    failed = 0
+    count = 0
+    for (filename, result, error) in bpm.ratelimit.run_all(download, sorted(pending), args.jobs):
+        if error is not None:
+            print("Error: %s: %s" % (download_urls[filename], error))
+            failed += 1
+            continue
 
-        r = requests.get(real_url)
-        r.raise_for_status()
+        sha256, size, new = result
+        print("Downloaded", download_urls[filename], "->", store.link_path(filename),
+            "(%s bytes%s)" % (size, "" if new else ", duplicate of " + sha256[:12]))
+        marked.setdefault(sha256, []).extend(pending[filename])
+        count += len(pending[filename])
+        if count >= args.batch:
+            flush()
+            count = 0
 
-        with open(path, "wb") as file:
-            file.write(r.content)
+    flush()
 
-        if not args.n:
-            mark_download(s, image)
+    if failed:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main(sys.argv[0], sys.argv[1:])
@@ -23,29 +23,50 @@ import argparse
 import sys
 
 import bpm.json
+import bpm.ratelimit
 import bpm.reddit
+import bpm.transport
 
 def main(argv0, argv):
     parser = argparse.ArgumentParser(prog=argv0, description="Download stylesheet")
     parser.add_argument("--raw", action="store_true", help="Output raw API response")
-    parser.add_argument("-o", help="Output file (css or raw)")
-    parser.add_argument("-i", help="Output file (images)")
-    parser.add_argument("subreddit", help="Subreddit")
+    parser.add_argument("-o", help="Output file (css or raw; one subreddit only)")
+    parser.add_argument("-i", help="Output file (images; one subreddit only)")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="Concurrent downloads")
+    parser.add_argument("subreddits", nargs="+", help="Subreddits")
+    bpm.transport.add_transport_arguments(parser)
     args = parser.parse_args(argv)
 
-    if args.raw:
-        filename = args.o or args.subreddit + ".json"
-        data = bpm.reddit.download_raw_stylesheet(args.subreddit)
-        with open(filename, "w") as file:
-            bpm.json.dump_config(data, file, max_depth=3)
-    else:
-        css_filename = args.o or args.subreddit + ".css"
-        images_filename = args.i or args.subreddit + "-images.json"
-        css, images = bpm.reddit.download_stylesheet(args.subreddit)
-        with open(css_filename, "w") as file:
-            file.write(css)
-        with open(images_filename, "w") as file:
-            bpm.json.dump_config(images, file)
+    bpm.reddit.init_transport_from_args(args)
+
+    if (args.o or args.i) and len(args.subreddits) > 1:
+        parser.error("-o and -i only work with a single subreddit")
+
+    def download(subreddit):
+        if args.raw:
+            filename = args.o or subreddit + ".json"
+            data = bpm.reddit.download_raw_stylesheet(subreddit)
+            with open(filename, "w") as file:
+                bpm.json.dump_config(data, file, max_depth=3)
+        else:
+            css_filename = args.o or subreddit + ".css"
+            images_filename = args.i or subreddit + "-images.json"
+            css, images = bpm.reddit.download_stylesheet(subreddit)
+            with open(css_filename, "w") as file:
+                file.write(css)
+            with open(images_filename, "w") as file:
+                bpm.json.dump_config(images, file)
+
+    # Requests are spaced out by bpm.reddit's rate limiter; the workers just
+    # make sure we're always ready to send the next one.
+    failed = 0
+    for (subreddit, result, error) in bpm.ratelimit.run_all(download, args.subreddits, args.jobs):
+        if error is not None:
+            print("Error: /r/%s: %s" % (subreddit, error))
+            failed += 1
+
+    if failed:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main(sys.argv[0], sys.argv[1:])
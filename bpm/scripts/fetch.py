@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+################################################################################
+##
+## This file is part of BetterPonymotes.
+## Copyright (c) 2015 Typhos.
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or (at your
+## option) any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+################################################################################
+
+import argparse
+import sys
+
+import bpm.database
+import bpm.ingest
+import bpm.ratelimit
+import bpm.reddit
+import bpm.transport
+
+def main(argv0, argv):
+    parser = argparse.ArgumentParser(prog=argv0, description="Download and ingest subreddit stylesheets")
+    bpm.database.add_database_arguments(parser)
+    parser.add_argument("-n", action="store_true", help="Don't commit")
+    parser.add_argument("--noignore", action="store_true", help="Disregard PONYSCRIPT-IGNORE directives")
+    parser.add_argument("--force", action="store_true", help="Download everything, even if not modified")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="Concurrent downloads")
+    parser.add_argument("subreddits", nargs="*", help="Subreddits (default: all)")
+    bpm.transport.add_transport_arguments(parser)
+    args = parser.parse_args(argv)
+
+    bpm.reddit.init_transport_from_args(args)
+
+    engine = bpm.database.init_from_args(args)
+    s = bpm.database.Session()
+
+    if args.subreddits:
+        subreddits = []
+        for name in args.subreddits:
+            sr = s.query(bpm.database.Subreddit).get(name)
+            if sr is None:
+                print("Error: could not find /r/%s" % (name))
+                sys.exit(1)
+            subreddits.append(sr)
+    else:
+        subreddits = s.query(bpm.database.Subreddit).order_by(bpm.database.Subreddit.subreddit_name).all()
+
+    # Downloads happen on worker threads, and are handed back here to be
+    # written one at a time.
+    pending = {}
+    for sr in subreddits:
+        etag, last_modified = bpm.ingest.validators(sr)
+        if args.force:
+            etag, last_modified = None, None
+        pending[sr.subreddit_name] = (etag, last_modified)
+    image_sizes = bpm.ingest.indexed_image_sizes(s)
+    s.rollback()
+
+    def fetch(name):
+        etag, last_modified = pending[name]
+        return bpm.ingest.fetch(name, etag=etag, last_modified=last_modified,
+            noignore=args.noignore, image_sizes=image_sizes)
+
+    failed = 0
+    for (name, result, error) in bpm.ratelimit.run_all(fetch, sorted(pending), args.jobs):
+        if error is not None:
+            print("Error: /r/%s: %s" % (name, error))
+            failed += 1
+            continue
+
+        sr = s.query(bpm.database.Subreddit).get(name)
+        update = bpm.ingest.apply_fetch(s, sr, *result)
+        if update is not None:
+            print("/r/%s: new update #%s" % (name, update.update_seq))
+        elif result[0].css is None:
+            print("/r/%s: not modified" % (name))
+        else:
+            print("/r/%s: unchanged" % (name))
+
+        if args.n:
+            s.rollback()
+        else:
+            s.commit()
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[0], sys.argv[1:])
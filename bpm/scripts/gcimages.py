@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+################################################################################
+##
+## This file is part of BetterPonymotes.
+## Copyright (c) 2015 Typhos.
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or (at your
+## option) any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+################################################################################
+
+
+import argparse
+import sys
+
+import bpm.database
+import bpm.imagestore
+from bpm.database import Image
+
+def main(argv0, argv):
+    parser = argparse.ArgumentParser(prog=argv0, description="Delete stored images no longer referenced by any stylesheet")
+    bpm.database.add_database_arguments(parser)
+    parser.add_argument("-n", action="store_true", help="Only report what would be deleted")
+    parser.add_argument("--grace", type=float, default=bpm.imagestore.GC_GRACE / 3600, help="Keep images stored within this many hours")
+    args = parser.parse_args(argv)
+
+    engine = bpm.database.init_from_args(args)
+    s = bpm.database.Session()
+
+    live_hashes = {sha256 for (sha256,) in s.query(Image.sha256).filter(Image.sha256 != None).distinct()}
+    live_filenames = {filename for (filename,) in s.query(Image.filename).distinct()}
+    s.rollback()
+
+    store = bpm.imagestore.ImageStore()
+    names, objects, freed = store.gc(live_hashes, live_filenames, dry_run=args.n, grace=args.grace * 3600)
+    print("%s %s names and %s images (%s bytes)" % ("Would remove" if args.n else "Removed", names, objects, freed))
+
+if __name__ == "__main__":
+    main(sys.argv[0], sys.argv[1:])
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+################################################################################
+##
+## This file is part of BetterPonymotes.
+## Copyright (c) 2015 Typhos.
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or (at your
+## option) any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+################################################################################
+
+
+import argparse
+import sys
+
+import bpm.database
+import bpm.imageinfo
+import bpm.imagestore
+from bpm.database import Image
+
+def main(argv0, argv):
+    parser = argparse.ArgumentParser(prog=argv0, description="Read dimensions, format and frame counts of downloaded images")
+    bpm.database.add_database_arguments(parser)
+    parser.add_argument("-n", action="store_true", help="Don't commit")
+    parser.add_argument("--all", action="store_true", help="Reindex images that already have information")
+    parser.add_argument("-j", "--jobs", type=int, help="Worker processes (default: one per CPU)")
+    parser.add_argument("--batch", type=int, default=1000, help="Images to update per commit")
+    args = parser.parse_args(argv)
+
+    engine = bpm.database.init_from_args(args)
+    s = bpm.database.Session()
+    store = bpm.imagestore.ImageStore()
+
+    q = s.query(Image.image_id, Image.filename, Image.sha256).filter(Image.downloaded != None)
+    if not args.all:
+        q = q.filter(Image.format == None)
+
+    # Each file is only read once, however many rows refer to it.
+    pending = {} # path -> [image_id, ...]
+    for (image_id, filename, sha256) in q.order_by(Image.image_id):
+        if sha256 is not None:
+            path = store.object_path(sha256)
+        else:
+            path = store.link_path(filename)
+        pending.setdefault(path, []).append(image_id)
+    s.rollback()
+
+    count = 0
+    failed = 0
+    for (path, info, error) in bpm.imageinfo.read_all(sorted(pending), workers=args.jobs):
+        if error is not None:
+            print("Error: %s: %s" % (path, error))
+            failed += 1
+            continue
+
+        if info is None:
+            print("Warning: %s: unknown format" % (path))
+            values = {Image.format: "unknown"}
+        else:
+            values = {
+                Image.format: info.format,
+                Image.width: info.width,
+                Image.height: info.height,
+                Image.frame_count: info.frame_count,
+                Image.size: info.size
+                }
+        s.query(Image).filter(Image.image_id.in_(pending[path])).update(values, synchronize_session=False)
+
+        count += 1
+        if count % args.batch == 0 and not args.n:
+            s.commit()
+
+    if not args.n:
+        s.commit()
+    print("Indexed %s images, %s failed" % (count, failed))
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[0], sys.argv[1:])
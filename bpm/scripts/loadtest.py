@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+################################################################################
+##
+## This file is part of BetterPonymotes.
+## Copyright (c) 2015 Typhos.
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or (at your
+## option) any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+################################################################################
+
+import argparse
+import sys
+
+import bpm.database
+import bpm.loadtest
+import bpm.webapi
+
+def main(argv0, argv):
+    parser = argparse.ArgumentParser(prog=argv0, description="Load test the data API")
+    bpm.database.add_database_arguments(parser)
+    parser.add_argument("--populate", action="store_true", help="Create tables and write synthetic data first")
+    parser.add_argument("--subreddits", type=int, default=10, help="Synthetic subreddits")
+    parser.add_argument("--updates", type=int, default=20, help="Synthetic updates per subreddit")
+    parser.add_argument("--emotes", type=int, default=200, help="Synthetic emotes per update")
+    parser.add_argument("--url", help="Base URL of a running server (default: test the app in-process)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients")
+    parser.add_argument("--duration", type=float, help="Seconds to run for (default: 30)")
+    parser.add_argument("--requests", type=int, help="Total requests to make, instead of a duration")
+    parser.add_argument("--warmup", type=float, default=0, help="Seconds to run before measuring")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed, for data and requests")
+    parser.add_argument("--routes", help="Comma-separated routes to test (default: all of %s)" % (",".join(name for (name, weight, path) in bpm.loadtest.DEFAULT_MIX)))
+    parser.add_argument("--encoding", default="gzip", help="Accept-Encoding to send")
+    parser.add_argument("--no-run", action="store_true", help="Only populate")
+    args = parser.parse_args(argv)
+
+    if args.duration is None and args.requests is None:
+        args.duration = 30
+
+    mix = bpm.loadtest.DEFAULT_MIX
+    if args.routes:
+        names = args.routes.split(",")
+        mix = [entry for entry in mix if entry[0] in names]
+        if len(mix) != len(names):
+            parser.error("unknown route in --routes")
+
+    # A remote server brings its own database.
+    if args.populate or not args.url:
+        engine = bpm.database.init_from_args(args)
+
+    if args.populate:
+        bpm.database.create_tables(engine)
+        s = bpm.database.Session()
+        bpm.loadtest.populate(s, args.subreddits, args.updates, args.emotes, seed=args.seed)
+        s.close()
+
+    if args.no_run:
+        return
+
+    if args.url:
+        make_client = lambda: bpm.loadtest.HTTPClient(args.url)
+    else:
+        bpm.database.setup_flask(bpm.webapi.app)
+        make_client = lambda: bpm.loadtest.AppClient(bpm.webapi.app)
+
+    targets = bpm.loadtest.discover(make_client())
+    results = bpm.loadtest.run(make_client, targets, args.concurrency,
+        duration=args.duration, total=args.requests, mix=mix, seed=args.seed,
+        warmup=args.warmup, headers={"Accept-Encoding": args.encoding})
+    print(results.report())
+
+if __name__ == "__main__":
+    main(sys.argv[0], sys.argv[1:])
@@ -20,40 +20,13 @@
 ################################################################################
 
 import argparse
-import hashlib
 import json
 import sys
 
 import arrow
 
-import bpm.css
 import bpm.database
-import bpm.extract
-import bpm.images
-
-def extract_emotes(rules):
-    raw_emotes = bpm.extract.group_rules(rules)
-    animations = bpm.extract.find_animations(rules)
-
-    emotes = {}
-
-    for (name, group) in raw_emotes.items():
-        emote = bpm.extract.extract_emote(name, group, animations)
-        emotes[name] = emote
-
-    return emotes
-
-def find_spritesheets(emotes):
-    spritesheets = set()
-
-    for (name, emote) in emotes.items():
-        for part in emote.parts.values():
-            if part.sprite:
-                url = part.sprite.image_url
-                assert url.startswith("%%") and url.endswith("%%")
-                spritesheets.add(url[2:-2])
-
-    return spritesheets
+import bpm.ingest
 
 def main(argv0, argv):
     parser = argparse.ArgumentParser(prog=argv0, description="Manually create subreddit update")
@@ -72,97 +45,22 @@ def main(argv0, argv):
     with open(args.stylesheet) as file:
         css = file.read()
 
-    css_hash = hashlib.sha256(css.encode("utf8")).hexdigest()
-
-    rules = bpm.css.parse_stylesheet(css)
-    if not args.noignore:
-        rules = bpm.extract.filter_ponyscript_ignore(rules)
-
-    rules = list(rules) # Force the generator so we can use this multiple times
-
-    emotes = extract_emotes(rules)
-    spritesheets = find_spritesheets(emotes)
-
     with open(args.images) as file:
         images = json.load(file)
 
     # All database access is conditional on -n to avoid errors using this script
     # on subreddits that aren't in the table.
     if args.n:
+        bpm.ingest.parse_stylesheet(css, noignore=args.noignore)
         return
 
     s = bpm.database.Session()
 
-    subreddit = s.query(bpm.database.Subreddit).get(args.subreddit)
-
-    # Add stylesheet
-    stylesheet_seq = bpm.database.Stylesheet.next_stylesheet_seq(s, subreddit)
-    stylesheet = bpm.database.Stylesheet(
-        subreddit_name=args.subreddit,
-        stylesheet_seq=stylesheet_seq,
-        downloaded=now,
-        css=css,
-        css_hash=css_hash)
+    image_sizes = bpm.ingest.indexed_image_sizes(s, images.values())
+    emotes, spritesheets = bpm.ingest.parse_stylesheet(css, noignore=args.noignore, images=images, image_sizes=image_sizes)
 
-    # Partial commit to get stylesheet_id
-    s.begin_nested()
-    s.add(stylesheet)
-    s.commit()
-
-    # Add all images.
-    for (name, url) in sorted(images.items()):
-        filename = bpm.images.image_filename(url)
-        contains_emotes = name in spritesheets
-        image = bpm.database.Image(
-                stylesheet_id=stylesheet.stylesheet_id,
-                name=name,
-                url=url,
-                contains_emotes=contains_emotes,
-                filename=filename)
-        s.add(image)
-
-    # Add all emotes (not parts). One big partial commit to get emote ID's.
-    s.begin_nested()
-    emote_rows = {}
-    for (name, emote) in sorted(emotes.items()):
-        e = bpm.database.Emote(stylesheet_id=stylesheet.stylesheet_id, name=name)
-        emote_rows[name] = e
-        s.add(e)
-    s.commit()
-
-    # Add all emote parts.
-    for (name, emote) in sorted(emotes.items()):
-        for (specifiers, part) in sorted(emote.parts.items()):
-            specifiers_json = json.dumps(part.serialize_specifiers()) if part.specifiers else None
-            css_json = json.dumps(part.css, sort_keys=True) if part.css else None
-
-            p = bpm.database.EmotePart(
-                emote_id=emote_rows[name].emote_id,
-                specifiers=specifiers_json,
-                animation=part.animation,
-                css=css_json)
-
-            if part.sprite:
-                p.sprite_image_url = part.sprite.image_url
-                p.sprite_x = part.sprite.x
-                p.sprite_y = part.sprite.y
-                p.sprite_width = part.sprite.width
-                p.sprite_height = part.sprite.height
-
-            s.add(p)
-
-    # Add update
-    seq = bpm.database.Update.next_update_seq(s, subreddit)
-    update = bpm.database.Update(subreddit_name=args.subreddit, update_seq=seq, stylesheet_id=stylesheet.stylesheet_id, created=now)
-
-    # Partial commit to get update ID
-    s.begin_nested()
-    s.add(update)
-    s.commit()
-
-    # Mark this as the latest update.
-    subreddit.latest_update_id = update.update_id
-    s.add(subreddit)
+    subreddit = s.query(bpm.database.Subreddit).get(args.subreddit)
+    bpm.ingest.ingest(s, subreddit, css, images, emotes, spritesheets, now=now)
 
     s.commit()
 
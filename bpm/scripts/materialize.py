@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+################################################################################
+##
+## This file is part of BetterPonymotes.
+## Copyright (c) 2015 Typhos.
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or (at your
+## option) any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+################################################################################
+
+
+import argparse
+import sys
+
+import bpm.database
+import bpm.diff
+import bpm.serialize
+from bpm.database import Stylesheet, StylesheetDetail
+
+def main(argv0, argv):
+    parser = argparse.ArgumentParser(prog=argv0, description="Precompute stylesheet JSON")
+    bpm.database.add_database_arguments(parser)
+    parser.add_argument("-n", action="store_true", help="Don't commit")
+    parser.add_argument("--all", action="store_true", help="Rebuild existing entries too")
+    parser.add_argument("--check", action="store_true", help="Compare existing entries against the live serializer")
+    parser.add_argument("--hashes", action="store_true", help="Fill in missing emote parts hashes instead")
+    args = parser.parse_args(argv)
+
+    engine = bpm.database.init_from_args(args)
+    s = bpm.database.Session()
+
+    if args.hashes:
+        count = bpm.diff.backfill_parts_hashes(s)
+        print("Hashed %s emotes" % (count))
+        if not args.n:
+            s.commit()
+        return
+
+    if args.check:
+        ids = s.query(StylesheetDetail.stylesheet_id).order_by(StylesheetDetail.stylesheet_id).all()
+        bad = 0
+        for (stylesheet_id,) in ids:
+            ss = s.query(Stylesheet).get(stylesheet_id)
+            if not bpm.serialize.check_materialized(ss):
+                print("Mismatch: stylesheet %s (/r/%s #%s)" % (ss.stylesheet_id, ss.subreddit_name, ss.stylesheet_seq))
+                bad += 1
+            s.expunge_all()
+        print("Checked %s stylesheets, %s mismatches" % (len(ids), bad))
+        sys.exit(1 if bad else 0)
+
+    q = s.query(Stylesheet.stylesheet_id)
+    if not args.all:
+        q = q.outerjoin(StylesheetDetail).filter(StylesheetDetail.stylesheet_id == None)
+    ids = [id for (id,) in q.order_by(Stylesheet.stylesheet_id).all()]
+
+    for stylesheet_id in ids:
+        ss = s.query(Stylesheet).get(stylesheet_id)
+        print("Materializing stylesheet %s (/r/%s #%s)" % (ss.stylesheet_id, ss.subreddit_name, ss.stylesheet_seq))
+        bpm.serialize.materialize_stylesheet(s, ss)
+        if not args.n:
+            s.commit()
+        # Don't hold on to every emote we've ever loaded.
+        s.expunge_all()
+
+if __name__ == "__main__":
+    main(sys.argv[0], sys.argv[1:])
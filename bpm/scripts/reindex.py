@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+################################################################################
+##
+## This file is part of BetterPonymotes.
+## Copyright (c) 2015 Typhos.
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or (at your
+## option) any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+################################################################################
+
+
+import argparse
+import sys
+
+import bpm.database
+import bpm.search
+from bpm.database import Subreddit
+
+def main(argv0, argv):
+    parser = argparse.ArgumentParser(prog=argv0, description="Rebuild emote search index")
+    bpm.database.add_database_arguments(parser)
+    parser.add_argument("-n", action="store_true", help="Don't commit")
+    parser.add_argument("subreddits", nargs="*", help="Subreddits (default: all)")
+    args = parser.parse_args(argv)
+
+    engine = bpm.database.init_from_args(args)
+    s = bpm.database.Session()
+
+    if args.subreddits:
+        for name in args.subreddits:
+            sr = s.query(Subreddit).get(name)
+            if sr is None:
+                print("Error: could not find /r/%s" % (name))
+                sys.exit(1)
+            bpm.search.refresh_subreddit(s, sr)
+    else:
+        bpm.search.rebuild(s)
+
+    if not args.n:
+        s.commit()
+
+if __name__ == "__main__":
+    main(sys.argv[0], sys.argv[1:])
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+################################################################################
+##
+## This file is part of BetterPonymotes.
+## Copyright (c) 2015 Typhos.
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or (at your
+## option) any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+################################################################################
+
+import argparse
+import sys
+
+import logbook
+
+import bpm.database
+import bpm.reddit
+import bpm.scheduler
+import bpm.transport
+
+def main(argv0, argv):
+    parser = argparse.ArgumentParser(prog=argv0, description="Poll subreddits for stylesheet updates")
+    bpm.database.add_database_arguments(parser)
+    parser.add_argument("--budget", type=float, default=bpm.scheduler.DEFAULT_BUDGET, help="Requests per hour, across all subreddits")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="Concurrent downloads")
+    parser.add_argument("--noignore", action="store_true", help="Disregard PONYSCRIPT-IGNORE directives")
+    parser.add_argument("--once", action="store_true", help="Poll whatever is due, then exit")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log every poll")
+    bpm.transport.add_transport_arguments(parser)
+    args = parser.parse_args(argv)
+
+    bpm.reddit.init_transport_from_args(args)
+
+    logbook.StderrHandler(level="DEBUG" if args.verbose else "INFO").push_application()
+
+    engine = bpm.database.init_from_args(args)
+    s = bpm.database.Session()
+
+    scheduler = bpm.scheduler.Scheduler(s, budget=args.budget, workers=args.jobs, noignore=args.noignore)
+    if args.once:
+        count = scheduler.run_once(limit=None)
+        print("Polled %s subreddits" % (count))
+    else:
+        scheduler.run()
+
+if __name__ == "__main__":
+    main(sys.argv[0], sys.argv[1:])
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+################################################################################
+##
+## This file is part of BetterPonymotes.
+## Copyright (c) 2015 Typhos.
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or (at your
+## option) any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+################################################################################
+
+
+import argparse
+import sys
+
+import arrow
+
+import bpm.database
+import bpm.tiles
+from bpm.database import Subreddit, Update, SpriteTile
+
+def main(argv0, argv):
+    parser = argparse.ArgumentParser(prog=argv0, description="Crop emote sprites out of their spritesheets")
+    bpm.database.add_database_arguments(parser)
+    parser.add_argument("-n", action="store_true", help="Only report what would be done")
+    parser.add_argument("--all", action="store_true", help="Every stylesheet, not just the latest for each subreddit")
+    parser.add_argument("--force", action="store_true", help="Make tiles again even if they already exist")
+    parser.add_argument("-j", "--jobs", type=int, help="Worker processes (default: one per CPU)")
+    parser.add_argument("--batch", type=int, default=100, help="Sheets to record per commit")
+    args = parser.parse_args(argv)
+
+    engine = bpm.database.init_from_args(args)
+    s = bpm.database.Session()
+
+    if args.all:
+        stylesheet_ids = None
+    else:
+        q = s.query(Update.stylesheet_id).join(Subreddit, Subreddit.latest_update_id == Update.update_id)
+        stylesheet_ids = [id for (id,) in q]
+
+    parts = list(bpm.tiles.sprite_parts(s, stylesheet_ids))
+    if args.force:
+        existing = {}
+    else:
+        existing = bpm.tiles.existing_tiles(s, {part.tile_hash for part in parts})
+
+    # Grouped by sheet, so each one is only decoded once.
+    work = {} # image_sha256 -> (image_format, {tile_hash: (x, y, width, height)})
+    for part in parts:
+        if part.tile_hash in existing:
+            continue
+        image_format, rects = work.setdefault(part.image_sha256, (part.image_format, {}))
+        rects[part.tile_hash] = (part.x, part.y, part.width, part.height)
+    s.rollback()
+
+    count = sum(len(rects) for (image_format, rects) in work.values())
+    print("%s sprites, %s tiles to make from %s sheets" % (len(parts), count, len(work)))
+    if args.n or not work:
+        return
+
+    made = 0
+    failed = 0
+    for (i, (sha256, results, error)) in enumerate(bpm.tiles.make_all(work, workers=args.jobs), 1):
+        if error is not None:
+            print("Error: %s: %s" % (sha256, error))
+            failed += 1
+            continue
+
+        now = arrow.utcnow()
+        rects = work[sha256][1]
+        for (tile_hash, format, size) in results:
+            x, y, width, height = rects[tile_hash]
+            s.merge(SpriteTile(tile_hash=tile_hash, image_sha256=sha256, x=x, y=y, width=width, height=height,
+                format=format, size=size, created=now))
+        made += len(results)
+
+        if i % args.batch == 0:
+            s.commit()
+
+    s.commit()
+    print("Made %s tiles, %s sheets failed" % (made, failed))
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[0], sys.argv[1:])
@@ -20,23 +20,117 @@
 ################################################################################
 
 import argparse
+import os
+import shutil
 import sys
+import tempfile
 
+import gunicorn.app.base
+
+import bpm.api
+import bpm.cache
 import bpm.database
+import bpm.metrics
 import bpm.webapi
 
+# Serves the app with gunicorn's pre-fork server. The app is loaded (and the
+# cache optionally warmed) once in the master process, then workers fork from
+# it. SIGHUP to the master gracefully replaces the workers; since the app is
+# preloaded, code changes still need a full restart.
+class WebAPIServer(gunicorn.app.base.BaseApplication):
+    def __init__(self, app, engine, options):
+        self.application = app
+        self.engine = engine
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for (key, value) in self.options.items():
+            self.cfg.set(key, value)
+        self.cfg.set("preload_app", True)
+        self.cfg.set("post_fork", self.post_fork)
+
+    def load(self):
+        return self.application
+
+    # Pooled connections mustn't be shared between processes. The master has
+    # already given its own up, but make sure each worker starts with a new
+    # pool regardless.
+    def post_fork(self, server, worker):
+        self.engine.dispose()
+
+# Workers are threaded, so that a long-polling or streaming /feed client ties
+# up a thread (mostly asleep, and without a database connection) rather than a
+# whole process. Threaded workers also keep up their heartbeat while requests
+# run, so long requests don't get them killed; the timeout is still kept above
+# the longest request, an event stream.
+WORKER_CLASS = "gthread"
+DEFAULT_THREADS = 32
+DEFAULT_TIMEOUT = bpm.api.FEED_STREAM_TIME + 60
+
 def main(argv0, argv):
     parser = argparse.ArgumentParser(prog=argv0, description="Run data API")
     bpm.database.add_database_arguments(parser)
     parser.add_argument("--flask-debug", action="store_true", help="Enable Flask debugging")
     parser.add_argument("--host", help="Host to bind to")
     parser.add_argument("--port", type=int, help="Port to bind to")
+    parser.add_argument("--cache-size", type=int, default=64, help="Response cache size (MiB)")
+    parser.add_argument("--cache-dir", help="Keep the response cache in this directory, shared between processes")
+    parser.add_argument("--gunicorn", action="store_true", help="Run a production server with gunicorn")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Worker processes (gunicorn)")
+    parser.add_argument("--threads", type=int, default=DEFAULT_THREADS, help="Threads per worker (gunicorn)")
+    parser.add_argument("--timeout", type=int, default=DEFAULT_TIMEOUT, help="Worker timeout in seconds (gunicorn)")
+    parser.add_argument("--graceful-timeout", type=int, default=30, help="Seconds to finish requests on reload/shutdown (gunicorn)")
+    parser.add_argument("--pidfile", help="Master PID file, for sending SIGHUP (gunicorn)")
+    parser.add_argument("--access-log", help="Access log file, or - for stderr (gunicorn)")
+    parser.add_argument("--warm", action="store_true", help="Fill the response cache with the latest data on startup")
+    parser.add_argument("--metrics-dir", help="Directory for combining workers' metrics (gunicorn; default is a temporary directory)")
     args = parser.parse_args(argv)
 
+    if args.gunicorn and args.flask_debug:
+        parser.error("--flask-debug can't be used with --gunicorn")
+
+    if args.cache_dir:
+        bpm.webapi.cache = bpm.cache.DiskCache(args.cache_dir, args.cache_size * 1024 * 1024)
+    else:
+        bpm.webapi.cache = bpm.cache.ResponseCache(args.cache_size * 1024 * 1024)
+
     engine = bpm.database.init_from_args(args)
     bpm.database.setup_flask(bpm.webapi.app)
 
-    bpm.webapi.app.run(host=args.host, port=args.port, debug=args.flask_debug)
+    if args.warm:
+        count = bpm.webapi.warm_cache()
+        print("Cached %s responses" % (count))
+
+    if not args.gunicorn:
+        bpm.webapi.app.run(host=args.host, port=args.port, debug=args.flask_debug)
+        return
+
+    # Don't hand any connections opened so far down to the workers.
+    engine.dispose()
+
+    # Each worker only sees its own requests; /metrics and /stats/cache
+    # combine them all through this directory.
+    metrics_dir = args.metrics_dir or tempfile.mkdtemp(prefix="bpm-metrics-")
+    bpm.metrics.registry.set_directory(metrics_dir)
+
+    options = {
+        "bind": "%s:%s" % (args.host or "127.0.0.1", args.port or 8000),
+        "workers": args.workers,
+        "worker_class": WORKER_CLASS,
+        "threads": args.threads,
+        "timeout": args.timeout,
+        "graceful_timeout": args.graceful_timeout,
+        "pidfile": args.pidfile,
+        "accesslog": args.access_log
+        }
+    master_pid = os.getpid()
+    try:
+        WebAPIServer(bpm.webapi.app, engine, options).run()
+    finally:
+        # Workers exit through here too.
+        if not args.metrics_dir and os.getpid() == master_pid:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
 
 if __name__ == "__main__":
     main(sys.argv[0], sys.argv[1:])
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+################################################################################
+##
+## This file is part of BetterPonymotes.
+## Copyright (c) 2015 Typhos.
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or (at your
+## option) any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+################################################################################
+
+
+import sqlalchemy
+
+import bpm.cache
+from bpm.database import Subreddit, Update, Emote, LatestEmote
+
+# Emote name search across all subreddits' latest stylesheets.
+#
+# Rather than search every emote ever recorded, we keep a small index table
+# (latest_emotes) with just the current emotes of each subreddit. It's
+# rebuilt for a subreddit whenever its latest update changes.
+
+MODES = ["exact", "prefix", "substring"]
+
+DEFAULT_LIMIT = 100
+
+# Rewrites the index entries for one subreddit from its latest update. Done in
+# two statements without loading any emotes into Python.
+def refresh_subreddit(s, sr):
+    s.query(LatestEmote).filter_by(subreddit_name=sr.subreddit_name).delete(synchronize_session=False)
+    bpm.cache.bump_generations(s, [bpm.cache.SUBREDDITS_TAG])
+
+    if sr.latest_update_id is None:
+        return
+
+    select = sqlalchemy.select([Update.subreddit_name, Emote.name, Emote.emote_id, Emote.stylesheet_id])
+    select = select.select_from(Update.__table__.join(Emote.__table__, Update.stylesheet_id == Emote.stylesheet_id))
+    select = select.where(Update.update_id == sr.latest_update_id)
+
+    columns = ["subreddit_name", "emote_name", "emote_id", "stylesheet_id"]
+    s.execute(LatestEmote.__table__.insert().from_select(columns, select))
+
+def rebuild(s):
+    for sr in s.query(Subreddit).order_by(Subreddit.subreddit_name).all():
+        refresh_subreddit(s, sr)
+
+def _escape_like(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+# Returns matching LatestEmote rows, ordered by emote name then subreddit.
+def search_emotes(s, query, mode="prefix", limit=DEFAULT_LIMIT):
+    name = LatestEmote.emote_name
+    if mode == "exact":
+        condition = name == query
+    elif mode == "prefix":
+        condition = name.like(_escape_like(query) + "%", escape="\\")
+    elif mode == "substring":
+        condition = name.like("%" + _escape_like(query) + "%", escape="\\")
+    else:
+        raise ValueError("Unknown search mode", mode)
+
+    q = s.query(LatestEmote).filter(condition)
+    return q.order_by(name, LatestEmote.subreddit_name).limit(limit).all()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+################################################################################
+##
+## This file is part of BetterPonymotes.
+## Copyright (c) 2015 Typhos.
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or (at your
+## option) any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+################################################################################
+
+import gzip
+import json
+
+import arrow
+from sqlalchemy.orm import joinedload, lazyload
+
+import bpm.tiles
+from bpm.database import Subreddit, Update, Emote, EmotePart, Image, StylesheetDetail
+
+# Serialization of database objects for the web API.
+
+# Note: These functions do not omit redundant fields when used as child objects,
+# e.g. we include the subreddit_name all the way down the subreddit -> update ->
+# stylesheet object tree. This is in hopes that dumber clients will have an
+# easier time parsing the output.
+
+# Note: emote_id and part_id are pretty much useless, but maybe someone will
+# find a purpose for them, so they remain in the output. They make a nice
+# identifier.
+
+def serialize_subreddit(sr, detail_latest=False):
+    data = {}
+    data["subreddit_name"] = sr.subreddit_name
+    data["added"] = sr.added.format()
+    data["latest_update_id"] = sr.latest_update_id
+    if sr.latest_update_id:
+        data["latest_update"] = serialize_update(sr.latest_update, detail=detail_latest)
+    else:
+        data["latest_update"] = None
+    return data
+
+def serialize_update(update, detail=False):
+    data = {}
+    data["update_id"] = update.update_id
+    data["subreddit_name"] = update.subreddit_name
+    data["update_seq"] = update.update_seq
+    data["stylesheet_id"] = update.stylesheet_id
+    data["created"] = update.created.format()
+    data["stylesheet"] = serialize_stylesheet(update.stylesheet, detail=detail)
+    return data
+
+def serialize_stylesheet(ss, detail=False, materialized=True):
+    # Detailed stylesheets are precomputed at ingestion time; use that when we
+    # can, since walking every image, emote and part is expensive.
+    if detail and materialized and ss.detail is not None:
+        return json.loads(ss.detail.json.decode("ascii"))
+
+    data = {}
+    data["stylesheet_id"] = ss.stylesheet_id
+    data["subreddit_name"] = ss.subreddit_name
+    data["stylesheet_seq"] = ss.stylesheet_seq
+    data["downloaded"] = ss.downloaded.format()
+    data["css_hash"] = ss.css_hash
+    if detail:
+        data["images"] = {}
+        for image in ss.images:
+            data["images"][image.name] = serialize_image(image)
+        data["emotes"] = {}
+        for emote in ss.emotes:
+            data["emotes"][emote.name] = serialize_emote(emote)
+    return data
+
+def serialize_image(image):
+    data = {}
+    data["image_id"] = image.image_id
+    data["stylesheet_id"] = image.stylesheet_id
+    data["name"] = image.name
+    data["url"] = image.url
+    data["contains_emotes"] = image.contains_emotes
+    return data
+
+# Tiles (see bpm.tiles) for a stylesheet's sprites, by emote name, in the
+# same order as the emote's parts. tile_url(filename) gives each one's URL.
+def serialize_stylesheet_tiles(s, ss, tile_url):
+    data = {}
+    data["stylesheet_id"] = ss.stylesheet_id
+    data["tiles"] = {}
+    for (part, tile) in bpm.tiles.stylesheet_tiles(s, ss.stylesheet_id):
+        data["tiles"].setdefault(part.emote_name, []).append(serialize_tile(part, tile, tile_url))
+    return data
+
+def serialize_tile(part, tile, tile_url):
+    data = {}
+    if part.specifiers:
+        data["specifiers"] = json.loads(part.specifiers)
+    data["url"] = tile_url(bpm.tiles.tile_filename(tile.tile_hash, tile.format))
+    data["width"] = tile.width
+    data["height"] = tile.height
+    data["size"] = tile.size
+    return data
+
+def serialize_emote(emote):
+    data = {}
+    data["emote_id"] = emote.emote_id
+    data["stylesheet_id"] = emote.stylesheet_id
+    data["name"] = emote.name
+    data["parts"] = []
+    for part in emote.parts:
+        data["parts"].append(serialize_part(part))
+    return data
+
+def serialize_part(part):
+    data = part.serialize()
+    data["part_id"] = part.part_id
+    data["emote_id"] = part.emote_id
+    return data
+
+def serialize_change(change):
+    data = {}
+    data["change_id"] = change.change_id
+    data["update_id"] = change.update_id
+    data["subreddit_name"] = change.subreddit_name
+    data["emote_name"] = change.emote_name
+    data["change"] = change.change
+    data["created"] = change.created.format()
+    return data
+
+# Batch versions of the above, with detail, for looking up many objects at once.
+# Stylesheet details are resolved with a fixed number of queries however many
+# objects there are, so the caller should eagerly load the updates and
+# stylesheets it passes in. Each returns {id or name: data}.
+
+def serialize_subreddits_detail(s, subreddits):
+    updates = [sr.latest_update for sr in subreddits if sr.latest_update_id]
+    update_data = serialize_updates_detail(s, updates)
+
+    result = {}
+    for sr in subreddits:
+        data = serialize_subreddit(sr, detail_latest=False)
+        if sr.latest_update_id:
+            data["latest_update"] = update_data[sr.latest_update_id]
+        result[sr.subreddit_name] = data
+    return result
+
+def serialize_updates_detail(s, updates):
+    stylesheet_data = serialize_stylesheets_detail(s, [update.stylesheet for update in updates])
+
+    result = {}
+    for update in updates:
+        data = serialize_update(update, detail=False)
+        data["stylesheet"] = stylesheet_data[update.stylesheet_id]
+        result[update.update_id] = data
+    return result
+
+def serialize_stylesheets_detail(s, stylesheets):
+    ids = {ss.stylesheet_id for ss in stylesheets}
+    if not ids:
+        return {}
+
+    # Precomputed details where we have them, and the rest the hard way.
+    q = s.query(StylesheetDetail.stylesheet_id, StylesheetDetail.json)
+    stored = dict(q.filter(StylesheetDetail.stylesheet_id.in_(ids)).all())
+
+    live = ids - set(stored)
+    images = {id: {} for id in live}
+    emotes = {id: {} for id in live}
+    if live:
+        for image in s.query(Image).filter(Image.stylesheet_id.in_(live)):
+            images[image.stylesheet_id][image.name] = serialize_image(image)
+        for emote in s.query(Emote).filter(Emote.stylesheet_id.in_(live)):
+            emotes[emote.stylesheet_id][emote.name] = serialize_emote(emote)
+
+    result = {}
+    for ss in stylesheets:
+        if ss.stylesheet_id in stored:
+            data = json.loads(stored[ss.stylesheet_id].decode("ascii"))
+        else:
+            data = serialize_stylesheet(ss, detail=False)
+            data["images"] = images[ss.stylesheet_id]
+            data["emotes"] = emotes[ss.stylesheet_id]
+        result[ss.stylesheet_id] = data
+    return result
+
+# Streaming versions of the above, for responses too big to build in memory.
+# These are generators of (key, value) pairs for bpm.json.iterencode_pairs(),
+# reading rows in batches through a server-side cursor. Output is the same as
+# the corresponding serialize_*() functions.
+
+STREAM_BATCH_SIZE = 500
+
+def stream_subreddits(s):
+    q = s.query(Subreddit).options(joinedload(Subreddit.latest_update).joinedload(Update.stylesheet))
+    for sr in q.order_by(Subreddit.subreddit_name).yield_per(STREAM_BATCH_SIZE):
+        yield (sr.subreddit_name, serialize_subreddit(sr, detail_latest=False))
+
+def stream_stylesheet(s, ss):
+    data = serialize_stylesheet(ss, detail=False)
+    data["images"] = _stream_images(s, ss.stylesheet_id)
+    data["emotes"] = _stream_emotes(s, ss.stylesheet_id)
+    for key in sorted(data):
+        yield (key, data[key])
+
+def _stream_images(s, stylesheet_id):
+    q = s.query(Image).filter_by(stylesheet_id=stylesheet_id).order_by(Image.name)
+    for image in q.yield_per(STREAM_BATCH_SIZE):
+        yield (image.name, serialize_image(image))
+
+def _stream_emotes(s, stylesheet_id):
+    # Collection eager loading doesn't work with a server-side cursor, so
+    # fetch (emote, part) rows and group them back up ourselves.
+    q = s.query(Emote, EmotePart).outerjoin(EmotePart, Emote.emote_id == EmotePart.emote_id)
+    q = q.filter(Emote.stylesheet_id == stylesheet_id).options(lazyload(Emote.parts))
+    q = q.order_by(Emote.name, EmotePart.part_id)
+
+    data = None
+    for (emote, part) in q.yield_per(STREAM_BATCH_SIZE):
+        if data is not None and data["emote_id"] != emote.emote_id:
+            yield (data["name"], data)
+            data = None
+        if data is None:
+            data = {"emote_id": emote.emote_id, "stylesheet_id": emote.stylesheet_id, "name": emote.name, "parts": []}
+        if part is not None:
+            data["parts"].append(serialize_part(part))
+    if data is not None:
+        yield (data["name"], data)
+
+def encode_json(data):
+    return json.dumps(data, separators=(",", ":"), sort_keys=True).encode("ascii")
+
+# Stores the detailed JSON for a stylesheet (plus a gzipped copy), replacing
+# any existing version.
+def materialize_stylesheet(s, ss):
+    data = serialize_stylesheet(ss, detail=True, materialized=False)
+    body = encode_json(data)
+
+    detail = s.query(StylesheetDetail).get(ss.stylesheet_id)
+    if detail is None:
+        detail = StylesheetDetail(stylesheet_id=ss.stylesheet_id)
+    detail.json = body
+    detail.json_gzip = gzip.compress(body, 9)
+    detail.created = arrow.utcnow()
+    s.add(detail)
+    return detail
+
+# Compares the stored detail JSON against a fresh serialization. Returns True
+# if they match (or there's nothing stored).
+def check_materialized(ss):
+    if ss.detail is None:
+        return True
+    stored = json.loads(ss.detail.json.decode("ascii"))
+    live = serialize_stylesheet(ss, detail=True, materialized=False)
+    return stored == live
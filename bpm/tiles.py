@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+################################################################################
+##
+## This file is part of BetterPonymotes.
+## Copyright (c) 2015 Typhos.
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or (at your
+## option) any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+################################################################################
+
+
+import collections
+import concurrent.futures
+import hashlib
+import io
+import os
+import tempfile
+
+try:
+    import PIL.Image
+except ImportError:
+    PIL = None
+
+import bpm.imagestore
+from bpm.database import Emote, EmotePart, Image, SpriteTile
+
+# Sprites cropped out of their spritesheets into images of their own, so that
+# a client showing one emote doesn't have to download the whole sheet.
+#
+# Tiles are identified by a hash of the sheet's content hash (see
+# bpm.imagestore) and the rectangle, so nothing is redone for sprites whose
+# sheet and rectangle haven't changed, however many stylesheets or emotes use
+# them. They're written to TILE_DIR and recorded in the sprite_tiles table.
+#
+# Making tiles needs Pillow, which is optional. Looking them up doesn't.
+
+TILE_DIR = os.path.join(bpm.imagestore.IMAGE_DIR, "tiles")
+
+# Bump to make every tile again, e.g. after changing how they're encoded.
+TILE_VERSION = 1
+
+EXTENSIONS = {"png": "png", "jpeg": "jpg"}
+JPEG_QUALITY = 90
+
+# Animated sheets are left alone, since a still tile would lose the animation.
+STILL_FORMATS = ["png", "jpeg", "gif"]
+
+SpritePart = collections.namedtuple("SpritePart", [
+    "part_id", "emote_name", "specifiers", "image_sha256", "image_format",
+    "x", "y", "width", "height", "tile_hash"])
+
+def tile_hash(image_sha256, x, y, width, height):
+    text = "%s %s %s %s %s %s" % (TILE_VERSION, image_sha256, x, y, width, height)
+    return hashlib.sha256(text.encode("ascii")).hexdigest()
+
+# JPEG sheets make JPEG tiles; everything else makes PNG.
+def tile_format(image_format):
+    return "jpeg" if image_format == "jpeg" else "png"
+
+def tile_filename(tile_hash, format):
+    return "%s.%s" % (tile_hash, EXTENSIONS[format])
+
+def tile_path(filename, tile_dir=TILE_DIR):
+    return os.path.join(tile_dir, filename[:2], filename)
+
+# Yields a SpritePart for every sprite in the given stylesheets (or all of
+# them) whose sheet has been downloaded and indexed, and can be cropped.
+def sprite_parts(s, stylesheet_ids=None):
+    qi = s.query(Image.stylesheet_id, Image.name, Image.sha256, Image.format)
+    qi = qi.filter(Image.sha256 != None, Image.format.in_(STILL_FORMATS), Image.frame_count == 1)
+    qp = s.query(EmotePart.part_id, Emote.stylesheet_id, Emote.name, EmotePart.specifiers, EmotePart.sprite_image_url,
+        EmotePart.sprite_x, EmotePart.sprite_y, EmotePart.sprite_width, EmotePart.sprite_height)
+    qp = qp.join(Emote, EmotePart.emote_id == Emote.emote_id).filter(EmotePart.sprite_image_url != None)
+    if stylesheet_ids is not None:
+        stylesheet_ids = list(stylesheet_ids)
+        qi = qi.filter(Image.stylesheet_id.in_(stylesheet_ids))
+        qp = qp.filter(Emote.stylesheet_id.in_(stylesheet_ids))
+
+    # CSS refers to images as %%name%%.
+    images = {}
+    for (stylesheet_id, name, sha256, format) in qi:
+        images[(stylesheet_id, "%%" + name + "%%")] = (sha256, format)
+
+    for (part_id, stylesheet_id, emote_name, specifiers, url, x, y, width, height) in qp.order_by(EmotePart.part_id):
+        image = images.get((stylesheet_id, url))
+        if image is None or not width or not height or width < 0 or height < 0:
+            continue
+        sha256, format = image
+        yield SpritePart(part_id, emote_name, specifiers, sha256, format,
+            x, y, width, height, tile_hash(sha256, x, y, width, height))
+
+# Returns {tile_hash: SpriteTile} for whichever of the hashes have been made.
+def existing_tiles(s, hashes, batch_size=500):
+    hashes = list(hashes)
+    tiles = {}
+    for i in range(0, len(hashes), batch_size):
+        q = s.query(SpriteTile).filter(SpriteTile.tile_hash.in_(hashes[i:i + batch_size]))
+        tiles.update((tile.tile_hash, tile) for tile in q)
+    return tiles
+
+# Returns [(SpritePart, SpriteTile)] for a stylesheet's sprites that have
+# tiles.
+def stylesheet_tiles(s, stylesheet_id):
+    parts = list(sprite_parts(s, [stylesheet_id]))
+    tiles = existing_tiles(s, {part.tile_hash for part in parts})
+    return [(part, tiles[part.tile_hash]) for part in parts if part.tile_hash in tiles]
+
+# Crops the tiles for many sheets on a pool of processes. work is
+# {image_sha256: (image_format, {tile_hash: (x, y, width, height)})}. Yields
+# (image_sha256, results, error) as each sheet is done, where results is
+# [(tile_hash, format, size)].
+def make_all(work, workers=None, store=None, tile_dir=TILE_DIR):
+    if PIL is None:
+        raise RuntimeError("Making tiles requires Pillow")
+    if store is None:
+        store = bpm.imagestore.ImageStore()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for (sha256, (image_format, rects)) in work.items():
+            future = executor.submit(make_tiles, store.object_path(sha256), image_format, rects, tile_dir)
+            futures[future] = sha256
+        for future in concurrent.futures.as_completed(futures):
+            sha256 = futures[future]
+            try:
+                yield (sha256, future.result(), None)
+            except Exception as e:
+                yield (sha256, None, e)
+
+# Crops tiles out of one sheet, which is only decoded once.
+def make_tiles(sheet_path, image_format, rects, tile_dir=TILE_DIR):
+    format = tile_format(image_format)
+    results = []
+    with PIL.Image.open(sheet_path) as sheet:
+        sheet.load()
+        rgba = None
+        for (hash, (x, y, width, height)) in sorted(rects.items()):
+            # Sprite positions are background offsets, so usually negative.
+            box = (-x, -y, -x + width, -y + height)
+            image = sheet
+            # Anything outside the sheet has to come out transparent, which
+            # palette and RGB images can't necessarily do.
+            if format == "png" and not _inside(box, sheet.size) and sheet.mode != "RGBA":
+                if rgba is None:
+                    rgba = sheet.convert("RGBA")
+                image = rgba
+            data = _encode(image.crop(box), format)
+            _write_atomic(tile_path(tile_filename(hash, format), tile_dir), data)
+            results.append((hash, format, len(data)))
+    return results
+
+def _inside(box, size):
+    left, top, right, bottom = box
+    return left >= 0 and top >= 0 and right <= size[0] and bottom <= size[1]
+
+def _encode(image, format):
+    buffer = io.BytesIO()
+    if format == "jpeg":
+        image.save(buffer, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    else:
+        image.save(buffer, "PNG", optimize=True)
+    return buffer.getvalue()
+
+def _write_atomic(path, data):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
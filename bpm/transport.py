@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+################################################################################
+##
+## This file is part of BetterPonymotes.
+## Copyright (c) 2015 Typhos.
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or (at your
+## option) any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+################################################################################
+
+import hashlib
+import http.server
+import io
+import json
+import os
+import tempfile
+import threading
+
+import requests
+import requests.adapters
+import requests.structures
+import requests.utils
+
+# Pluggable HTTP transports for requests sessions, so the whole pipeline can
+# run without a network: record every response to an archive directory, then
+# replay them later, either directly or through a local stand-in server.
+#
+# Recordings are keyed on the method, URL, conditional request headers (so a
+# 304 replays as a 304) and Range (so a partial response only answers the
+# request for that range). Recording the same request again adds another
+# response rather than replacing it; replay hands them out in order and then
+# keeps repeating the last, so a sequence of runs (e.g. a subreddit changing
+# between polls) replays as it happened.
+
+KEY_HEADERS = ["If-None-Match", "If-Modified-Since", "Range"]
+
+# Headers describing the transfer rather than the content. Bodies are stored
+# decoded, so these don't apply on replay.
+TRANSFER_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection", "keep-alive"}
+
+# The stand-in adapter sends the real URL along in this header.
+ORIGINAL_URL_HEADER = "X-BPM-Original-URL"
+
+def request_key(method, url, headers):
+    parts = [method.upper(), url] + ["%s: %s" % (name, headers.get(name, "")) for name in KEY_HEADERS]
+    return hashlib.sha1("\n".join(parts).encode("utf8")).hexdigest()
+
+class Archive:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._replayed = {} # key -> number of responses handed out
+
+    def _filename(self, key, n, ext):
+        return os.path.join(self.path, "%s-%s.%s" % (key, n, ext))
+
+    def _count(self, key):
+        n = 0
+        while os.path.exists(self._filename(key, n, "json")):
+            n += 1
+        return n
+
+    def save(self, method, url, request_headers, status, reason, headers, body):
+        key = request_key(method, url, request_headers)
+        headers = {name: value for (name, value) in headers.items() if name.lower() not in TRANSFER_HEADERS}
+        meta = {
+            "method": method.upper(),
+            "url": url,
+            "request_headers": {name: request_headers[name] for name in KEY_HEADERS if name in request_headers},
+            "status": status,
+            "reason": reason,
+            "headers": headers
+            }
+        with self._lock:
+            n = self._count(key)
+            # Body first, so a response only exists once it's complete.
+            _write_atomic(self._filename(key, n, "body"), body)
+            _write_atomic(self._filename(key, n, "json"), json.dumps(meta, indent=1, sort_keys=True).encode("utf8"))
+
+    # Returns (status, reason, headers, body), or None if it wasn't recorded.
+    def load(self, method, url, request_headers):
+        key = request_key(method, url, request_headers)
+        with self._lock:
+            count = self._count(key)
+            if count == 0:
+                return None
+            n = min(self._replayed.get(key, 0), count - 1)
+            self._replayed[key] = n + 1
+
+        with open(self._filename(key, n, "json"), "rb") as file:
+            meta = json.loads(file.read().decode("utf8"))
+        with open(self._filename(key, n, "body"), "rb") as file:
+            body = file.read()
+        return (meta["status"], meta["reason"], meta["headers"], body)
+
+def _write_atomic(filename, data):
+    fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), prefix=".tmp-")
+    with os.fdopen(fd, "wb") as file:
+        file.write(data)
+    os.replace(temp_filename, filename)
+
+# Makes real requests and records the responses.
+class RecordingAdapter(requests.adapters.HTTPAdapter):
+    def __init__(self, archive, **kwargs):
+        super().__init__(**kwargs)
+        self.archive = archive
+
+    def send(self, request, stream=False, **kwargs):
+        response = super().send(request, stream=False, **kwargs)
+        self.archive.save(request.method, request.url, request.headers,
+            response.status_code, response.reason, response.headers, response.content)
+        return response
+
+# Answers from the archive without touching the network. Unrecorded requests
+# fail as if the host were unreachable.
+class ReplayAdapter(requests.adapters.BaseAdapter):
+    def __init__(self, archive):
+        super().__init__()
+        self.archive = archive
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        recorded = self.archive.load(request.method, request.url, request.headers)
+        if recorded is None:
+            raise requests.ConnectionError("No recording for %s %s" % (request.method, request.url), request=request)
+        status, reason, headers, body = recorded
+        return _build_response(self, request, status, reason, headers, body)
+
+    def close(self):
+        pass
+
+def _build_response(adapter, request, status, reason, headers, body):
+    response = requests.Response()
+    response.status_code = status
+    response.reason = reason
+    response.headers = requests.structures.CaseInsensitiveDict(headers)
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    response.raw = io.BytesIO(body)
+    response.url = request.url
+    response.request = request
+    response.connection = adapter
+    return response
+
+# Sends everything to a stand-in server (see serve()) instead, with the real
+# URL in a header.
+class StandInAdapter(requests.adapters.HTTPAdapter):
+    def __init__(self, base_url, **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = base_url.rstrip("/")
+
+    def send(self, request, **kwargs):
+        request = request.copy()
+        request.headers[ORIGINAL_URL_HEADER] = request.url
+        request.url = self.base_url + "/"
+        return super().send(request, **kwargs)
+
+    def build_response(self, req, resp):
+        response = super().build_response(req, resp)
+        response.url = req.headers[ORIGINAL_URL_HEADER]
+        return response
+
+# A local HTTP server answering stand-in requests from an archive.
+def serve(archive, host="127.0.0.1", port=8090):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            url = self.headers.get(ORIGINAL_URL_HEADER)
+            recorded = archive.load(self.command, url, self.headers) if url else None
+            if recorded is None:
+                self.send_error(502, "No recording")
+                return
+            status, reason, headers, body = recorded
+            self.send_response(status, reason)
+            for (name, value) in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_HEAD = do_GET
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.serve_forever()
+
+def add_transport_arguments(parser):
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--record", metavar="DIR", help="Record HTTP responses to an archive")
+    group.add_argument("--replay", metavar="DIR", help="Replay HTTP responses from an archive, offline")
+    group.add_argument("--replay-url", metavar="URL", help="Replay HTTP responses from a stand-in server")
+
+# Mounts the chosen transport on a session. Returns True if replaying.
+def init_from_args(args, session):
+    if args.record:
+        adapter = RecordingAdapter(Archive(args.record))
+    elif args.replay:
+        adapter = ReplayAdapter(Archive(args.replay))
+    elif args.replay_url:
+        adapter = StandInAdapter(args.replay_url)
+    else:
+        return False
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return not args.record
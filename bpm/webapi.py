@@ -19,165 +19,307 @@
 ##
 ################################################################################
 
-import json
+import time
 
 import flask
 
-from bpm.database import Session
-from bpm.database import Subreddit, Update, Stylesheet, Image, Emote, EmotePart
+import bpm.api
+import bpm.cache
+import bpm.feed
+import bpm.metrics
+from bpm.api import ENCODINGS
+from bpm.database import Session, session_factory
+from bpm.database import Subreddit, Update
 
 app = flask.Flask(__name__)
 
-# Note: These functions do not omit redundant fields when used as child objects,
-# e.g. we include the subreddit_name all the way down the subreddit -> update ->
-# stylesheet object tree. This is in hopes that dumber clients will have an
-# easier time parsing the output.
-
-# Note: emote_id and part_id are pretty much useless, but maybe someone will
-# find a purpose for them, so they remain in the output. They make a nice
-# identifier.
-
-def _serialize_subreddit(sr, detail_latest=False):
-    data = {}
-    data["subreddit_name"] = sr.subreddit_name
-    data["added"] = sr.added.format()
-    data["latest_update_id"] = sr.latest_update_id
-    if sr.latest_update_id:
-        data["latest_update"] = _serialize_update(sr.latest_update, detail=detail_latest)
-    else:
-        data["latest_update"] = None
-    return data
-
-def _serialize_update(update, detail=False):
-    data = {}
-    data["update_id"] = update.update_id
-    data["subreddit_name"] = update.subreddit_name
-    data["update_seq"] = update.update_seq
-    data["stylesheet_id"] = update.stylesheet_id
-    data["created"] = update.created.format()
-    data["stylesheet"] = _serialize_stylesheet(update.stylesheet, detail=detail)
-    return data
-
-def _serialize_stylesheet(ss, detail=False):
-    data = {}
-    data["stylesheet_id"] = ss.stylesheet_id
-    data["subreddit_name"] = ss.subreddit_name
-    data["stylesheet_seq"] = ss.stylesheet_seq
-    data["downloaded"] = ss.downloaded.format()
-    data["css_hash"] = ss.css_hash
-    if detail:
-        data["images"] = {}
-        for image in ss.images:
-            data["images"][image.name] = _serialize_image(image)
-        data["emotes"] = {}
-        for emote in ss.emotes:
-            data["emotes"][emote.name] = _serialize_emote(emote)
-    return data
-
-def _serialize_image(image):
-    data = {}
-    data["image_id"] = image.image_id
-    data["stylesheet_id"] = image.stylesheet_id
-    data["name"] = image.name
-    data["url"] = image.url
-    data["contains_emotes"] = image.contains_emotes
-    return data
-
-def _serialize_emote(emote):
-    data = {}
-    data["emote_id"] = emote.emote_id
-    data["stylesheet_id"] = emote.stylesheet_id
-    data["name"] = emote.name
-    data["parts"] = []
-    for part in emote.parts:
-        part_data = part.serialize()
-        part_data["part_id"] = part.part_id
-        part_data["emote_id"] = part.emote_id
-        data["parts"].append(part_data)
-    return data
+# Encoded response bodies, keyed by path and ETag. Replace to resize, or with a
+# bpm.cache.DiskCache to share it between processes.
+cache = bpm.cache.ResponseCache()
 
-# Gets a subreddit listing
-@app.route("/subreddits")
-def subreddits():
+# The routes themselves are in bpm.api; these parse Flask's request for them,
+# and turn their replies into responses.
+
+def _conditions():
+    request = flask.request
+    return bpm.api.Conditions(request.full_path, request.accept_encodings, request.if_none_match,
+                              request.if_modified_since, request.range, request.if_range)
+
+def _respond(resource):
+    reply = bpm.api.respond(cache, Session(), resource, _conditions())
+    body = reply.body
+    if not isinstance(body, bytes):
+        body = _stream_with_session(body)
+    response = flask.Response(body, status=reply.status, mimetype=reply.mimetype, headers=reply.headers)
+    if reply.content_length is not None:
+        response.content_length = reply.content_length
+    return response
+
+# Streams a body inside the request context. Newer versions of Flask tear down
+# the app context (removing the scoped session) before a streamed body is
+# generated, so the generator ends up using a session that nothing will close;
+# close it once the body is done, so its connection goes back to the pool from
+# this thread rather than whenever it's garbage collected.
+def _stream_with_session(body):
     s = Session()
-    subreddits = s.query(Subreddit).all()
+    def generate():
+        try:
+            yield from body
+        finally:
+            s.close()
+    return flask.stream_with_context(generate())
 
-    data = {}
-    for sr in subreddits:
-        data[sr.subreddit_name] = _serialize_subreddit(sr, detail_latest=False)
+# The request's session. Its connection is checked out here, up front, so
+# that the wait for one is measured.
+def _session():
+    s = Session()
+    if not s.in_transaction():
+        with bpm.metrics.checkout_timer():
+            s.connection()
+    return s
+
+def _page():
+    return bpm.api.page_args(flask.request.args)
+
+bpm.feed.listen_sessions(session_factory)
 
-    return flask.jsonify(data)
+# Gets a subreddit listing
+@app.route("/subreddits")
+def subreddits():
+    return _respond(bpm.api.subreddits(_session()))
 
 # Gets subreddit details
 @app.route("/r/<string:subreddit_name>")
 def r_subreddit(subreddit_name):
-    s = Session()
-    sr = s.query(Subreddit).get(subreddit_name)
-    data = _serialize_subreddit(sr, detail_latest=True)
-    return flask.jsonify(data)
+    return _respond(bpm.api.subreddit(_session(), subreddit_name))
 
-# Gets a subreddit recent update listing
+# Gets a subreddit update listing, newest first
 @app.route("/r/<string:subreddit_name>/updates")
 def r_subreddit_updates(subreddit_name):
-    s = Session()
-    updates = s.query(Update).filter_by(subreddit_name=subreddit_name).order_by(Update.update_seq.desc()).limit(10).all()
-    data = {"updates": []}
-    for update in updates:
-        data["updates"].append(_serialize_update(update, detail=False))
-    return flask.jsonify(data)
+    return _respond(bpm.api.subreddit_updates(_session(), subreddit_name, _page()))
 
 # Gets an update by ID
 @app.route("/updates/<int:update_id>")
 def update(update_id):
-    s = Session()
-    update = s.query(Update).get(update_id)
-    data = _serialize_update(update, detail=True)
-    return flask.jsonify(data)
+    return _respond(bpm.api.update(_session(), update_id))
 
 # Gets an update by sequence number
 @app.route("/r/<string:subreddit_name>/updates/<int:update_seq>")
 def r_subreddit_update(subreddit_name, update_seq):
-    s = Session()
-    update = s.query(Update).filter_by(subreddit_name=subreddit_name, update_seq=update_seq).one()
-    data = _serialize_update(update, detail=True)
-    return flask.jsonify(data)
+    return _respond(bpm.api.subreddit_update(_session(), subreddit_name, update_seq))
+
+# Gets the differences between two updates, by sequence number
+@app.route("/r/<string:subreddit_name>/updates/<int:old_seq>/diff/<int:new_seq>")
+def r_subreddit_update_diff(subreddit_name, old_seq, new_seq):
+    return _respond(bpm.api.subreddit_update_diff(_session(), subreddit_name, old_seq, new_seq))
+
+# Gets emote changes across all subreddits, newest first. Paged like update
+# listings, but on change_id.
+@app.route("/changes")
+def changes():
+    return _respond(bpm.api.changes(_session(), _page()))
+
+# Gets a subreddit's emote changes, newest first, optionally for one emote
+# (?emote=/name)
+@app.route("/r/<string:subreddit_name>/changes")
+def r_subreddit_changes(subreddit_name):
+    emote_name = flask.request.args.get("emote")
+    return _respond(bpm.api.subreddit_changes(_session(), subreddit_name, emote_name, _page()))
 
-# Gets a subreddit recent stylesheet listing
+# Gets a subreddit stylesheet listing, newest first
 @app.route("/r/<string:subreddit_name>/stylesheets")
 def r_subreddit_stylesheets(subreddit_name):
-    s = Session()
-    stylesheets = s.query(Stylesheet).filter_by(subreddit_name=subreddit_name).order_by(Stylesheet.stylesheet_seq.desc()).limit(10).all()
-    data = {"stylesheets": []}
-    for ss in stylesheets:
-        data["stylesheets"].append(_serialize_stylesheet(ss, detail=False))
-    return flask.jsonify(data)
+    return _respond(bpm.api.subreddit_stylesheets(_session(), subreddit_name, _page()))
 
 # Gets a stylesheet by ID
 @app.route("/stylesheets/<int:stylesheet_id>")
 def stylesheet(stylesheet_id):
-    s = Session()
-    ss = s.query(Stylesheet).get(stylesheet_id)
-    data = _serialize_stylesheet(ss, detail=True)
-    return flask.jsonify(data)
+    return _respond(bpm.api.stylesheet(_session(), stylesheet_id))
 
 # Gets a stylesheet by sequence number
 @app.route("/r/<string:subreddit_name>/stylesheets/<int:stylesheet_seq>")
 def r_subreddit_stylesheet(subreddit_name, stylesheet_seq):
-    s = Session()
-    ss = s.query(Stylesheet).filter_by(subreddit_name=subreddit_name, stylesheet_seq=stylesheet_seq).one()
-    data = _serialize_stylesheet(ss, detail=True)
-    return flask.jsonify(data)
+    return _respond(bpm.api.subreddit_stylesheet(_session(), subreddit_name, stylesheet_seq))
 
-# Gets stylesheet CSS by ID
+# Gets stylesheet CSS by ID, with support for Range requests
 @app.route("/stylesheet/<int:stylesheet_id>/css")
 def stylesheet_css(stylesheet_id):
-    s = Session()
-    ss = s.query(Stylesheet.css).get(stylesheet_id)
-    return flask.Response(ss.css, mimetype="text/css")
+    return _respond(bpm.api.stylesheet_css(_session(), stylesheet_id))
 
-# Gets stylesheet CSS by sequence number
+# Gets stylesheet CSS by sequence number, with support for Range requests
 @app.route("/r/<string:subreddit_name>/stylesheets/<int:stylesheet_seq>/css")
 def r_subreddit_stylesheet_css(subreddit_name, stylesheet_seq):
+    return _respond(bpm.api.subreddit_stylesheet_css(_session(), subreddit_name, stylesheet_seq))
+
+def _tile_url(filename):
+    return flask.url_for("tile", filename=filename)
+
+# Gets the tiles for a stylesheet's sprites
+@app.route("/stylesheets/<int:stylesheet_id>/tiles")
+def stylesheet_tiles(stylesheet_id):
+    return _respond(bpm.api.stylesheet_tiles(_session(), stylesheet_id, _tile_url))
+
+# Gets the tiles for a subreddit's latest stylesheet
+@app.route("/r/<string:subreddit_name>/tiles")
+def r_subreddit_tiles(subreddit_name):
+    return _respond(bpm.api.subreddit_tiles(_session(), subreddit_name, _tile_url))
+
+# Gets a tile image
+@app.route("/tiles/<string:filename>")
+def tile(filename):
+    response = flask.send_file(bpm.api.tile_file(filename), etag=filename)
+    response.headers["Cache-Control"] = bpm.api.IMMUTABLE
+    return response
+
+# Gets details for several subreddits at once
+@app.route("/batch/subreddits")
+def batch_subreddits():
+    names = bpm.api.batch_args(flask.request.args.getlist("name"))
+    return _respond(bpm.api.batch_subreddits(_session(), names))
+
+# Gets several updates by ID
+@app.route("/batch/updates")
+def batch_updates():
+    ids = bpm.api.batch_args(flask.request.args.getlist("id"), int)
+    return _respond(bpm.api.batch_updates(_session(), ids))
+
+# Gets several stylesheets by ID
+@app.route("/batch/stylesheets")
+def batch_stylesheets():
+    ids = bpm.api.batch_args(flask.request.args.getlist("id"), int)
+    return _respond(bpm.api.batch_stylesheets(_session(), ids))
+
+# Searches emote names across all subreddits' latest stylesheets
+@app.route("/emotes/search")
+def emotes_search():
+    query, mode, limit = bpm.api.search_args(flask.request.args)
+    return _respond(bpm.api.emotes_search(_session(), query, mode, limit))
+
+# Long-polls for new updates after ?after=<update_id>. Returns as soon as
+# there are any, or with an empty list after ?timeout= seconds. Pass the
+# returned cursor as the next ?after=. Without ?after=, returns the current
+# cursor immediately.
+@app.route("/feed")
+def feed():
+    s = _session()
+    args = flask.request.args
+    timeout = bpm.api.feed_timeout(args)
+
+    if "after" not in args:
+        updates = []
+        cursor = bpm.api.latest_cursor(s)
+    else:
+        cursor = bpm.api.parse_cursor(args["after"])
+        bpm.feed.start_listener(s.bind)
+        updates = bpm.api.serialize_feed(s, cursor)
+        if not updates:
+            # Don't hold a database connection while we wait.
+            s.close()
+            bpm.feed.broadcaster.wait(cursor, timeout)
+            updates = bpm.api.serialize_feed(s, cursor)
+        if updates:
+            cursor = updates[-1][0]
+
+    response = flask.Response(bpm.api.feed_body(updates, cursor), mimetype="application/json")
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+# Streams new updates as Server-Sent Events, starting after Last-Event-ID or
+# ?after= (or from now). Each event's ID is its update ID.
+@app.route("/feed/events")
+def feed_events():
+    s = _session()
+    after = flask.request.headers.get("Last-Event-ID", flask.request.args.get("after"))
+    if after is None:
+        cursor = bpm.api.latest_cursor(s)
+    else:
+        cursor = bpm.api.parse_cursor(after)
+    bpm.feed.start_listener(s.bind)
+
+    def generate(cursor):
+        deadline = time.monotonic() + bpm.api.FEED_STREAM_TIME
+        while time.monotonic() < deadline:
+            events = []
+            for (update_id, data) in bpm.api.serialize_feed(s, cursor):
+                events.append(bpm.api.feed_event(update_id, data))
+                cursor = update_id
+            s.close()
+
+            if events:
+                yield "".join(events)
+                if len(events) == bpm.api.FEED_BATCH_SIZE:
+                    continue
+
+            latest = bpm.feed.broadcaster.wait(cursor, bpm.api.FEED_HEARTBEAT)
+            if latest is None or latest <= cursor:
+                yield ": keepalive\n\n"
+
+    response = flask.Response(_stream_with_session(generate(cursor)), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+# Fills the response cache with the latest data for every subreddit, in each
+# encoding we serve. Returns the number of responses cached. Run this before
+# forking workers and they all start out with it.
+def warm_cache():
     s = Session()
-    ss = s.query(Stylesheet.css).filter_by(subreddit_name=subreddit_name, stylesheet_seq=stylesheet_seq).one()
-    return flask.Response(ss.css, mimetype="text/css")
+    paths = ["/subreddits"]
+    q = s.query(Subreddit.subreddit_name, Update.stylesheet_id).join(Update, Subreddit.latest_update_id == Update.update_id)
+    for (subreddit_name, stylesheet_id) in q.order_by(Subreddit.subreddit_name):
+        paths.append("/r/%s" % (subreddit_name))
+        paths.append("/stylesheets/%s" % (stylesheet_id))
+    Session.remove()
+
+    count = 0
+    client = app.test_client()
+    for path in paths:
+        for encoding in ENCODINGS:
+            response = client.get(path, headers={"Accept-Encoding": encoding})
+            response.get_data()
+            response.close()
+            if response.status_code == 200:
+                count += 1
+    return count
+
+# Response cache statistics, for every worker (see bpm.metrics)
+def cache_stats():
+    stats = {}
+    for (metric, samples) in bpm.metrics.registry.combined():
+        key = _cache_metrics.get(metric.name)
+        if key is not None:
+            stats[key] = sum(value for (name, labels, value) in samples)
+    return stats
+
+# Gets response cache statistics
+@app.route("/stats/cache")
+def stats_cache():
+    return flask.jsonify(cache_stats())
+
+# Gets request, database and cache metrics, for Prometheus
+@app.route("/metrics")
+def metrics():
+    return flask.Response(bpm.metrics.registry.render(), content_type=bpm.metrics.CONTENT_TYPE)
+
+bpm.metrics.instrument_app(app)
+
+@app.before_request
+def _instrument_engine():
+    bpm.metrics.instrument_engine(Session.get_bind())
+
+def _cache_stat(key):
+    return lambda: [((), cache.stats()[key])]
+
+# Metric name -> stats() key
+_cache_metrics = {}
+
+for (key, type, help) in [
+        ("hits", "counter", "Response cache hits."),
+        ("misses", "counter", "Response cache misses."),
+        ("evictions", "counter", "Response cache entries evicted to make room."),
+        ("entries", "gauge", "Response cache entries."),
+        ("bytes", "gauge", "Response cache size."),
+        ("max_bytes", "gauge", "Response cache size limit.")]:
+    name = "bpm_response_cache_" + key + ("_total" if type == "counter" else "")
+    # A shared cache's size is the same whichever process is asked.
+    bpm.metrics.registry.gauge(name, help, _cache_stat(key), type=type, shared=lambda: cache.shared)
+    _cache_metrics[name] = key
@@ -28,11 +28,22 @@ setup(
     packages=["bpm"],
     scripts=[
         "bin/addsubreddit.py",
+        "bin/asgi.py",
+        "bin/changelog.py",
         "bin/dlimages.py",
         "bin/download.py",
+        "bin/fetch.py",
+        "bin/gcimages.py",
+        "bin/imageinfo.py",
         "bin/initdb.py",
+        "bin/loadtest.py",
         "bin/manualupdate.py",
+        "bin/materialize.py",
         "bin/parse.py",
+        "bin/reindex.py",
+        "bin/replayserver.py",
+        "bin/scheduler.py",
+        "bin/tiles.py",
         "bin/webapi.py"
     ],
     install_requires=[
@@ -47,5 +58,10 @@ setup(
         "requests",
         "SQLAlchemy",
         "tinycss2"
-    ]
+    ],
+    extras_require={
+        "async": ["aiosqlite", "asyncpg", "uvicorn"],
+        "brotli": ["Brotli"],
+        "tiles": ["Pillow"]
+    }
 )